@@ -13,12 +13,16 @@ from phi.tools import Toolkit
 import pandas as pd
 from pandasai import SmartDataframe
 from pandasai.llm.local_llm import LocalLLM
-import subprocess
 import os
-import glob
 import sys
 from pathlib import Path
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules import collector
+
+# Collects in-process, keeping a warm API client per deployment
+online_collector = collector.Collector()
+
 db_url = "postgresql+psycopg://ai:ai@localhost:5532/ai"
 base_path = Path("/home/efi/ShastaChat")
 os.path.dirname(base_path)
@@ -38,17 +42,16 @@ class GetOnlineDevices(Toolkit):
         try:
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             directory = os.path.join(base_path, 'results')
             subfolder = os.path.join(directory, deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*online-devices*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            devices_df = pd.read_json(latest_json_file)
+            devices_df = manifest.read_table(snapshot, 'online-devices')
             
             return str(len(devices_df))
         except Exception as e:
@@ -70,17 +73,16 @@ class GetNeighbors(Toolkit):
         try:
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             directory = os.path.join(base_path, 'results')
             subfolder = os.path.join(directory, deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*neighbors-data*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            devices_df = pd.read_json(latest_json_file)
+            devices_df = manifest.read_table(snapshot, 'neighbors-data')
             print(devices_df)
             return str(len(devices_df))
         except Exception as e:
@@ -97,17 +99,16 @@ class GetNeighbors(Toolkit):
         try:
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             directory = os.path.join(base_path, 'results')
             subfolder = os.path.join(directory, deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*neighbors-data*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            devices_df = pd.read_json(latest_json_file)
+            devices_df = manifest.read_table(snapshot, 'neighbors-data')
             return devices_df
         except Exception as e:
             return {"error": str(e)}
@@ -131,17 +132,16 @@ class AnalyzeDF(Toolkit):
             print("Analyzing data")
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             directory = os.path.join(base_path, 'results')
             subfolder = os.path.join(directory, deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*neighbors-data*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found. Or no cuncurrent data found in directory."
-            latest_json_file = max(json_files, key=os.path.getctime)
-            nr_df = pd.read_json(latest_json_file)
+            nr_df = manifest.read_table(snapshot, 'neighbors-data')
             smart_df = SmartDataframe(nr_df, config = {"llm": LocalLLM(api_base="http://localhost:11434/v1", model="llama2")})
             responce = smart_df.chat(input_question)
             print(responce)
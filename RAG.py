@@ -44,39 +44,28 @@ from pprint import pprint
 import time
 
 import sys
-import glob
 import pandas as pd
+from modules import collector
 #deployments = ["DF", "PROD", "STG", "DEV"]
-files = []
 
     #devices_df = pd.read_json(latest_json_file)
 def load_and_retrieve_docs(deployment):
   
-    # Get the list of files in the directory
+    # Get the latest snapshot of the deployment from its manifest
     subfolder = os.path.join('results', deployment)
-    # Find the latest JSON file with "online-devices" in the file name
-    subfile = os.path.join(subfolder, '*online-devices*.json')
-    json_files = glob.glob(subfile)
-
-    latest_json_file = max(json_files, key=os.path.getctime)
-    files.append(latest_json_file)
-    subfile = os.path.join(subfolder, '*neighbors-data*.json')
-    json_files = glob.glob(subfile)
-
-
-    latest_json_file = max(json_files, key=os.path.getctime)
-    files.append(latest_json_file)
-    subfile = os.path.join(subfolder, '*survey-data*.json')
-    json_files = glob.glob(subfile)
-
-    latest_json_file = max(json_files, key=os.path.getctime)
-    files.append(latest_json_file)
-
-
-    for file_path in files:
-        docs = json.loads(Path(file_path).read_text())
-        df = pd.DataFrame(docs)
-        # Load the files
+    manifest = collector.Manifest(subfolder)
+    snapshot = manifest.latest()
+    if snapshot == None:
+        raise Exception("No snapshot found for deployment %s, collect its data first" % deployment)
+    tables = []
+    for table in ['online-devices', 'neighbors-data', 'survey-data']:
+        if table in snapshot['tables']:
+            tables.append(table)
+
+
+    for table in tables:
+        df = manifest.read_table(snapshot, table)
+        # Load the table
         loader = DataFrameLoader(df, page_content_column="mac")
         docs = loader.load()
 
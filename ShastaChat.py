@@ -9,7 +9,6 @@ from phi.embedder.ollama import OllamaEmbedder
 from phi.vectordb.pgvector import PgVector2
 from phi.knowledge import AssistantKnowledge
 
-import subprocess
 
 #from langchain_community.llms import Ollama
 from pandasai import SmartDataframe
@@ -23,8 +22,11 @@ import time
 
 import sys
 import os
-import glob
 import pandas as pd
+from modules import collector
+
+# Collects in-process, keeping a warm API client per deployment
+online_collector = collector.Collector()
 ollama_llm = LocalLLM(api_base="http://localhost:11434/v1", model="llama3")
 db_url = "postgresql+psycopg://ai:ai@localhost:5532/ai"
 
@@ -43,16 +45,15 @@ class GetOnlineDevices(Toolkit):
         try:
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             subfolder = os.path.join('results', deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*online-devices*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            devices_df = pd.read_json(latest_json_file)
+            devices_df = manifest.read_table(snapshot, 'online-devices')
             
             return str(len(devices_df))
         except Exception as e:
@@ -74,16 +75,15 @@ class GetNeighbors(Toolkit):
         try:
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             subfolder = os.path.join('results', deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*neighbors-data*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            devices_df = pd.read_json(latest_json_file)
+            devices_df = manifest.read_table(snapshot, 'neighbors-data')
             print(devices_df)
             return str(len(devices_df))
         except Exception as e:
@@ -109,16 +109,15 @@ class AnalyzeDF(Toolkit):
             print("Analyzing data")
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             subfolder = os.path.join('results', deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*neighbors-data*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            nr_df = pd.read_json(latest_json_file)
+            nr_df = manifest.read_table(snapshot, 'neighbors-data')
             smart_df = SmartDataframe(nr_df, config = {"llm": ollama_llm})
             responce = smart_df.chat(input_question + " respond in simple verbal text")
             print(responce)
@@ -35,8 +35,11 @@ import json
 import time
 
 import sys
-import glob
 import pandas as pd
+from modules import collector
+
+# Collects in-process, keeping a warm API client per deployment
+online_collector = collector.Collector()
 
 
 #loader = UnstructuredFileLoader()
@@ -59,16 +62,15 @@ class GetOnlineDevices(BaseTool):
         try:
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             subfolder = os.path.join('results', deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*online-devices*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            devices_df = pd.read_json(latest_json_file)
+            devices_df = manifest.read_table(snapshot, 'online-devices')
             
             return str(len(devices_df))
         except Exception as e:
@@ -77,16 +79,15 @@ class GetOnlineDevices(BaseTool):
         try:
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             subfolder = os.path.join('results', deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*online-devices*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            devices_df = pd.read_json(latest_json_file)
+            devices_df = manifest.read_table(snapshot, 'online-devices')
             
             return str(len(devices_df))
         except Exception as e:
@@ -106,16 +107,15 @@ class GetNeighbors(BaseTool):
         try:
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             subfolder = os.path.join('results', deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*neighbors-data*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            devices_df = pd.read_json(latest_json_file)
+            devices_df = manifest.read_table(snapshot, 'neighbors-data')
             print(devices_df)
             return str(len(devices_df))
         except Exception as e:
@@ -141,16 +141,15 @@ class AnalyzeDF(BaseTool):
             print("Analyzing data")
             if new:
                 # Get the latest data
-                subprocess.call([sys.executable, "get-online-devices.py", "-d", deployment]) #, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-            # Get the list of files in the directory
+                online_collector.collect(deployment)
+            # Results dir of the deployment
             subfolder = os.path.join('results', deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*neighbors-data*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            nr_df = pd.read_json(latest_json_file)
+            nr_df = manifest.read_table(snapshot, 'neighbors-data')
             smart_df = SmartDataframe(nr_df, config = {"llm": ollama_llm})
             responce = smart_df.chat(input_question + " respond in simple verbal text")
             print(responce)
@@ -163,15 +162,14 @@ class Analyze(BaseTool):
 
     def _run(self, query:str) -> str:
         try:
-            # Get the list of files in the directory
+            # Results dir of the deployment
             subfolder = os.path.join('results', deployment)
-            # Find the latest JSON file with "neighbors-data" in the file name
-            subfile = os.path.join(subfolder, '*neighbors-data*.json')
-            json_files = glob.glob(subfile)
-            if not json_files:  # Check if json_files is empty
+            # Find the latest snapshot in the manifest
+            manifest = collector.Manifest(subfolder)
+            snapshot = manifest.latest()
+            if snapshot == None:
                 return "No online devices found"
-            latest_json_file = max(json_files, key=os.path.getctime)
-            nr_df = pd.read_json(latest_json_file)
+            nr_df = manifest.read_table(snapshot, 'neighbors-data')
             return query
         except Exception as e:
             return {"error": str(e)}
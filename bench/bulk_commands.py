@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+# Compare a serial update_fw()/cmd_status() loop with API.bulk_update_fw()
+# against the fake controller, on the connected devices of the LOCAL
+# deployment (see bench/collector.py for the config it needs).
+#
+#   python3 bench/bulk_commands.py [-f DF] [-c 2] [-w 16] [-n 40]
+
+import sys
+import os
+import json
+import time
+import argparse
+
+import fake_controller
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(TOP_DIR)
+sys.path.insert(0, TOP_DIR)
+
+from modules import cloudsdk
+
+parser = argparse.ArgumentParser(description="Bulk command benchmark")
+parser.add_argument('-f', '--fixtures', default="DF", action='store', help="Deployment whose cache/ fixtures to serve")
+parser.add_argument('-l', '--latency', type=float, default=0.02, action='store', help="Mean response latency in seconds")
+parser.add_argument('-c', '--cmd-time', type=float, default=2, action='store', help="Mean time for a command to complete in seconds")
+parser.add_argument('-w', '--window', type=int, default=cloudsdk.BULK_WINDOW, action='store', help="Commands in flight at once")
+parser.add_argument('-n', '--num', type=int, default=40, action='store', help="Number of targets")
+parser.add_argument('-s', '--serial', action='store_true', help="Also time the serial loop")
+args = parser.parse_args()
+
+f = open("config/clouds.json")
+port = json.load(f)['LOCAL']['owgw']['port']
+f.close()
+srv = fake_controller.start(port, fixtures=args.fixtures, latency=args.latency, cmd_time=args.cmd_time)
+
+capi = cloudsdk.API(deployment="LOCAL", verbose=False)
+pdata = cloudsdk.ProvData(capi, verbose=False, no_cache=True)
+targets = capi.matching_targets(capi.iter_devices(verbose=False), pdata)[:args.num]
+print("%d targets, command time ~%.1f s, latency %.0f ms" % (len(targets), args.cmd_time, args.latency * 1000))
+
+if (args.serial):
+    start_tm = time.time()
+    for target in targets:
+        status = capi.update_fw(target['mac'], "http://fw.example/fw.bin")
+        while (capi.cmd_status(target['mac'], status['UUID'])['completed'] == 0):
+            time.sleep(1)
+    print("serial: %.1f s" % (time.time() - start_tm))
+
+bulk = capi.bulk_update_fw(targets, "http://fw.example/fw.bin", window=args.window, verbose=False)
+print("bulk: " + bulk.summary())
+print("   -> %d status polls for %d commands" % (bulk.poll_calls, len(targets)))
+capi.close()
+srv.shutdown()
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+# Measure get-online-devices.py throughput against the fake controller,
+# reproducibly and without a live deployment. Runs the collector on the
+# LOCAL deployment (see config/clouds.json, and add LOCAL credentials to
+# config/PRIV-creds.json as in the example file).
+#
+#   python3 bench/collector.py [-f DF] [-l 0.05] [-e 0.01] [-r 50] [-j 8]
+
+import sys
+import os
+import json
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+import fake_controller
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description="Collector throughput benchmark")
+parser.add_argument('-f', '--fixtures', default="DF", action='store', help="Deployment whose cache/ fixtures to serve")
+parser.add_argument('-l', '--latency', type=float, default=0.05, action='store', help="Mean response latency in seconds")
+parser.add_argument('-e', '--error-rate', type=float, default=0, action='store', help="Fraction of requests failing with 500")
+parser.add_argument('-r', '--rate-limit', type=float, default=0, action='store', help="Requests/sec allowed before 429s (0 is unlimited)")
+parser.add_argument('-j', '--jobs', action='store', help="Collector parallel stats fetches (default is the collector's)")
+args = parser.parse_args()
+
+f = open(os.path.join(TOP_DIR, "config/clouds.json"))
+port = json.load(f)['LOCAL']['owgw']['port']
+f.close()
+
+srv = fake_controller.start(port, fixtures=args.fixtures, cache_dir=os.path.join(TOP_DIR, "cache"), latency=args.latency,
+                            error_rate=args.error_rate, rate_limit=args.rate_limit)
+connected = len([ d for d in srv.devices if d['connected'] ])
+print("Fake controller: %s fixtures, %d devices (%d connected), latency %.0f ms, error rate %.1f%%, rate limit %s"
+        % (args.fixtures, len(srv.devices), connected, args.latency * 1000, args.error_rate * 100,
+           ("%.0f req/s" % args.rate_limit) if args.rate_limit > 0 else "none"))
+
+cmd = [ sys.executable, "get-online-devices.py", "-d", "LOCAL", "-O", tempfile.mkdtemp() ]
+if (args.jobs):
+    cmd += [ "-j", args.jobs ]
+start_tm = datetime.now()
+res = subprocess.run(cmd, cwd=TOP_DIR, capture_output=True, text=True)
+took = (datetime.now() - start_tm).total_seconds()
+if (res.returncode != 0):
+    print(res.stdout[-2000:] + res.stderr[-2000:])
+    print("ERROR: collector exited with %d" % res.returncode)
+    exit(1)
+
+for line in res.stdout.splitlines():
+    if ("devices/sec" in line):
+        print(line.strip())
+stats = srv.get_stats()
+print("   -> run took %.2f s: %d requests, %d connections, %d errors, %d throttled"
+        % (took, stats['requests'], stats['connections'], stats['errors'], stats['throttled']))
+srv.shutdown()
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+# Local stand-in for the owsec/owgw/owprov services, serving the recorded
+# cache/<deployment>-Devices.json and cache/<deployment>-ProvData.json
+# fixtures plus synthesized device statistics. Script and FW upgrade commands
+# are accepted and complete after a random delay of around cmd_time secs. Latency, error rate and rate
+# limiting are configurable so collector throughput can be measured offline.
+#
+#   python3 bench/fake_controller.py -f DF -p 16000 --latency 0.05
+#
+# then point a deployment in config/clouds.json at it, e.g. the LOCAL one:
+#   "LOCAL": { "owsec": { "host": "127.0.0.1", "port": 16000, "scheme": "http" }, ... }
+
+import os
+import json
+import time
+import gzip
+import random
+import argparse
+import threading
+import uuid
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BANDS = [ "2G", "5G", "6G" ]
+CHANNELS = { "2G": [ 1, 6, 11 ], "5G": [ 36, 52, 100, 149 ], "6G": [ 5, 37, 69 ] }
+WIDTHS = { "2G": 20, "5G": 80, "6G": 160 }
+
+# Synthesize a statistics document for a device. The same MAC always gives
+# the same document (apart from localtime), so runs are reproducible
+def synth_stats(mac, now = None):
+    rnd = random.Random(mac)
+    if (now == None):
+        now = int(time.time())
+
+    mem_total = 256 * 1024 * 1024
+    stats = {
+        'unit': {
+            'localtime': now - rnd.choice([ 5, 10, 30, 60, 300 ]),
+            'uptime': rnd.randint(600, 90 * 86400),
+            'cpu_load': [ rnd.randint(0, 100) ],
+            'load': [ rnd.random() * 2, rnd.random() * 2, rnd.random() * 2 ],
+            'memory': { 'total': mem_total, 'free': int(mem_total * rnd.uniform(0.1, 0.7)) }
+        },
+        'interfaces': [],
+        'radios': [],
+        'rrm-info': [],
+        'link-state': { 'upstream': { 'WAN': { 'carrier': 1, 'speed': rnd.choice([ 1000, 2500 ]), 'duplex': "full" } } }
+    }
+
+    clients = []
+    ssids = []
+    for band in BANDS[:rnd.randint(2, 3)]:
+        assocs = []
+        for i in range(rnd.randint(0, 12)):
+            cmac = "%02x:%02x:%02x:%02x:%02x:%02x" % tuple([ rnd.randint(0, 255) for x in range(6) ])
+            clients.append(cmac)
+            assocs.append({
+                'station': cmac,
+                'connected': rnd.randint(10, 86400),
+                'rssi': rnd.randint(-85, -35),
+                'ack_signal_avg': rnd.randint(-85, -35),
+                'rx_packets': rnd.randint(0, 10**7),
+                'rx_bytes': rnd.randint(0, 10**10),
+                'tx_packets': rnd.randint(0, 10**7),
+                'tx_bytes': rnd.randint(0, 10**10),
+                'rx_rate': { 'bitrate': rnd.randint(6000, 1200000) },
+                'tx_rate': { 'bitrate': rnd.randint(6000, 1200000) }
+            })
+        ssids.append({ 'band': band, 'ssid': "fake-" + band.lower(), 'associations': assocs })
+    stats['interfaces'].append({ 'name': "up0v0", 'vlan_id': 1, 'ssids': ssids })
+
+    for band in BANDS[:len(ssids)]:
+        radio = { 'band': [ band ], 'channel': rnd.choice(CHANNELS[band]), 'channel_width': WIDTHS[band], 'survey': [], 'neighbors': {} }
+        for chan in CHANNELS[band]:
+            agg = { 'active_ms': 900000, 'busy_ms': rnd.randint(0, 900000), 'busy_self_ms': rnd.randint(0, 90000),
+                    'busy_tx_ms': rnd.randint(0, 90000), 'num_samples': 15 }
+            radio['survey'].append({
+                'on-chan': (chan == radio['channel']), 'channel': chan, 'noise_floor': rnd.randint(-100, -80),
+                'active_ms': 60000, 'busy_ms': rnd.randint(0, 60000), 'busy_self_ms': rnd.randint(0, 6000),
+                'busy_tx_ms': rnd.randint(0, 6000), 'last_on_chan_secs_go': rnd.randint(0, 600),
+                'rrm_airtime_pct': rnd.randint(0, 100), 'agg_15m': agg
+            })
+        for n in range(rnd.randint(0, 6)):
+            ssid = "neighbor-%d" % rnd.randint(0, 20)
+            radio['neighbors'].setdefault(ssid, []).append({
+                'bssid': "%02x:%02x:%02x:%02x:%02x:%02x" % tuple([ rnd.randint(0, 255) for x in range(6) ]),
+                'in_network': (rnd.random() < 0.3), 'channel': rnd.choice(CHANNELS[band]),
+                'rssi': rnd.randint(-95, -40), 'last_seen_secs_ago': rnd.randint(0, 300)
+            })
+        stats['radios'].append(radio)
+
+    for cmac in clients:
+        steer = {}
+        for st in [ 'upsteer', 'sticky', 'downsteer' ]:
+            steer[st] = {}
+            for kt in [ 'btm', 'legacy' ]:
+                total = rnd.randint(0, 5)
+                success = rnd.randint(0, total)
+                steer[st][kt] = { 'total': total, 'success': success, 'fail': total - success }
+        stats['rrm-info'].append({
+            'mac': cmac, 'state': rnd.randint(0, 5), 'supported_bands': rnd.randint(1, 7),
+            'active': (rnd.random() < 0.5), 'pps_rx': rnd.randint(0, 100), 'stats': steer, 'wnm': (rnd.random() < 0.5),
+            'rrm': { 'beacon_active_measure': True, 'beacon_passive_measure': False, 'beacon_table_measure': False,
+                     'link_measure': True, 'statistics_measure': False }
+        })
+    return stats
+
+class FakeController(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Init the fake controller, seeded from the fixtures of a deployment
+    def __init__(self, address, fixtures = "DF", cache_dir = "cache", latency = 0, error_rate = 0, rate_limit = 0, cmd_time = 2):
+        super().__init__(address, FakeHandler)
+        self.latency    = latency
+        self.cmd_time   = cmd_time
+        self.commands   = {}
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.lock       = threading.Lock()
+        self.tokens     = rate_limit
+        self.last       = time.monotonic()
+        self.requests   = 0
+        self.errors     = 0
+        self.throttled  = 0
+        self.connections = 0
+
+        f = open(os.path.join(cache_dir, "%s-Devices.json" % fixtures))
+        self.devices = json.load(f)
+        f.close()
+        f = open(os.path.join(cache_dir, "%s-ProvData.json" % fixtures))
+        prov_data = json.load(f)
+        f.close()
+        self.inventory = prov_data['inventory']
+        self.venues    = prov_data['venues']
+        self.entities  = prov_data['entities']
+        self.macs      = set([ d['serialNumber'] for d in self.devices ])
+
+    def get_request(self):
+        req = super().get_request()
+        with self.lock:
+            self.connections += 1
+        return req
+
+    # Token bucket of rate_limit req/s (1 sec burst). Returns the number of
+    # seconds the client should wait, or 0 if the request is allowed
+    def take_token(self):
+        if (self.rate_limit <= 0):
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.last) * self.rate_limit)
+            self.last = now
+            if (self.tokens >= 1):
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate_limit
+
+    # Record a command against a device, completing after delay secs
+    def new_command(self, mac, command, delay):
+        cmd = { 'UUID': str(uuid.uuid4()), 'serialNumber': mac, 'command': command,
+                'submitted': int(time.time()), 'due': time.time() + delay }
+        with self.lock:
+            self.commands[cmd['UUID']] = cmd
+        return cmd
+
+    # Command record as owgw returns it
+    def get_command(self, cmd_uuid):
+        with self.lock:
+            cmd = self.commands.get(cmd_uuid)
+        if (cmd == None):
+            return None
+        done = (time.time() >= cmd['due'])
+        return { 'UUID': cmd['UUID'], 'serialNumber': cmd['serialNumber'], 'command': cmd['command'],
+                 'submitted': cmd['submitted'], 'status': "completed" if done else "pending",
+                 'completed': int(cmd['due']) if done else 0, 'errorCode': 0, 'errorText': "" }
+
+    # Counters since start
+    def get_stats(self):
+        with self.lock:
+            return { 'requests': self.requests, 'connections': self.connections,
+                     'errors': self.errors, 'throttled': self.throttled }
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer the reply so headers and body go out in one segment
+    wbufsize = 65536
+
+    def send_json(self, code, body, headers = {}):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        if ('gzip' in self.headers.get('Accept-Encoding', "") and len(data) > 512):
+            data = gzip.compress(data, 6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_page(self, query, key, items):
+        if ('countOnly' in query):
+            return self.send_json(200, { 'count': len(items) })
+        limit = int(query.get('limit', [ 100 ])[0])
+        offset = int(query.get('offset', [ 0 ])[0])
+        self.send_json(200, { key: items[offset:offset + limit] })
+
+    def handle_request(self):
+        srv = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        body = {}
+        if (length > 0):
+            body = json.loads(self.rfile.read(length) or b"{}")
+        with srv.lock:
+            srv.requests += 1
+
+        wait = srv.take_token()
+        if (wait > 0):
+            with srv.lock:
+                srv.throttled += 1
+            return self.send_json(429, { 'ErrorCode': 429, 'ErrorDescription': "Too many requests" },
+                                  { 'Retry-After': "%.3f" % wait })
+        if (srv.latency > 0):
+            time.sleep(random.uniform(0.5, 1.5) * srv.latency)
+        if (srv.error_rate > 0 and random.random() < srv.error_rate):
+            with srv.lock:
+                srv.errors += 1
+            return self.send_json(500, { 'ErrorCode': 500, 'ErrorDescription': "Internal error" })
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        if (url.path == "/api/v1/oauth2"):
+            return self.send_json(200, { 'access_token': "fake-%032x" % random.getrandbits(128) })
+        if (url.path == "/api/v1/devices"):
+            if ('connectionStatistics' in query):
+                connected = [ d for d in srv.devices if d['connected'] ]
+                return self.send_json(200, { 'connectedDevices': len(connected), 'averageConnectionTime': 3600 })
+            return self.send_page(query, 'devicesWithStatus', srv.devices)
+        if (url.path == "/api/v1/inventory"):
+            return self.send_page(query, 'taglist', srv.inventory)
+        if (url.path == "/api/v1/venue"):
+            return self.send_page(query, 'venues', srv.venues)
+        if (url.path == "/api/v1/entity"):
+            return self.send_page(query, 'entities', srv.entities)
+        if (len(parts) == 5 and parts[:3] == [ "api", "v1", "device" ] and parts[4] == "statistics"):
+            if (parts[3] not in srv.macs):
+                return self.send_json(404, { 'ErrorCode': 404, 'ErrorDescription': "No such device" })
+            return self.send_json(200, synth_stats(parts[3]))
+        if (len(parts) == 5 and parts[:3] == [ "api", "v1", "device" ] and parts[4] in [ "script", "upgrade" ]):
+            if (parts[3] not in srv.macs):
+                return self.send_json(404, { 'ErrorCode': 404, 'ErrorDescription': "No such device" })
+            if (parts[4] == "script" and not body.get('deferred')):
+                delay = 0
+            else:
+                delay = random.uniform(0.5, 1.5) * srv.cmd_time
+            cmd = srv.new_command(parts[3], parts[4], delay)
+            return self.send_json(200, { 'UUID': cmd['UUID'], 'serialNumber': parts[3],
+                                         'results': { 'status': { 'error': 0, 'resultCode': 0, 'text': "Success" } } })
+        if (len(parts) == 4 and parts[:3] == [ "api", "v1", "command" ]):
+            cmd = srv.get_command(parts[3])
+            if (cmd == None):
+                return self.send_json(404, { 'ErrorCode': 404, 'ErrorDescription': "No such command" })
+            return self.send_json(200, cmd)
+        self.send_json(404, { 'ErrorCode': 404, 'ErrorDescription': "Unknown endpoint" })
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+    def log_message(self, format, *args):
+        return
+
+# Start a fake controller on a background thread, returns the server
+def start(port = 0, **kwargs):
+    srv = FakeController(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake owsec/owgw/owprov controller")
+    parser.add_argument('-f', '--fixtures', default="DF", action='store', help="Deployment whose cache/ fixtures to serve")
+    parser.add_argument('-p', '--port', type=int, default=16000, action='store', help="Port to listen on")
+    parser.add_argument('-l', '--latency', type=float, default=0, action='store', help="Mean response latency in seconds")
+    parser.add_argument('-e', '--error-rate', type=float, default=0, action='store', help="Fraction of requests failing with 500")
+    parser.add_argument('-r', '--rate-limit', type=float, default=0, action='store', help="Requests/sec allowed before 429s (0 is unlimited)")
+    parser.add_argument('-c', '--cmd-time', type=float, default=2, action='store', help="Mean time for a command to complete in seconds")
+    args = parser.parse_args()
+
+    srv = FakeController(("127.0.0.1", args.port), fixtures=args.fixtures, latency=args.latency,
+                         error_rate=args.error_rate, rate_limit=args.rate_limit, cmd_time=args.cmd_time)
+    print("Serving %s fixtures on http://127.0.0.1:%d (%d devices)" % (args.fixtures, args.port, len(srv.devices)))
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(srv.get_stats()))
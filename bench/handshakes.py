@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+# Count connection handshakes per run of API calls, with and without the
+# keep-alive connection pool, against a local HTTP/1.1 server.
+#
+#   python3 bench/handshakes.py [-n CALLS]
+
+import sys
+import os
+import json
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import cloudsdk
+
+class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    accepted = 0
+
+    def get_request(self):
+        req = super().get_request()
+        self.accepted += 1
+        return req
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer the reply so headers and body go out in one segment
+    wbufsize = 65536
+
+    def reply(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if (length > 0):
+            self.rfile.read(length)
+        if (self.path.startswith("/api/v1/oauth2")):
+            body = { 'access_token': "bench-token-0123456789" }
+        else:
+            body = { 'count': 1234 }
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = reply
+    do_POST = reply
+
+    def log_message(self, format, *args):
+        return
+
+def run(server, pool_size, calls):
+    start = server.accepted
+    capi = cloudsdk.API(deployment="BENCH", verbose=False, pool_size=pool_size)
+    start_tm = datetime.now()
+    for i in range(calls):
+        capi.get_device_count()
+    took = (datetime.now() - start_tm).total_seconds()
+    capi.close()
+    return (server.accepted - start), took
+
+parser = argparse.ArgumentParser(description="Keep-alive handshake benchmark")
+parser.add_argument('-n', '--calls', type=int, default=500, action='store', help="API calls per run")
+args = parser.parse_args()
+
+server = CountingServer(("127.0.0.1", 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+port = server.server_address[1]
+
+tmpdir = tempfile.mkdtemp()
+svc = { 'host': "127.0.0.1", 'port': port, 'scheme': "http" }
+cloudsdk.CLOUD_CONFIG = os.path.join(tmpdir, "clouds.json")
+cloudsdk.CRED_CONFIG  = os.path.join(tmpdir, "creds.json")
+cloudsdk.CACHE_CONFIG = os.path.join(tmpdir, "auth-cache.json")
+with open(cloudsdk.CLOUD_CONFIG, "w") as outfile:
+    json.dump({ 'BENCH': { 'owsec': svc, 'owgw': svc, 'owprov': svc } }, outfile)
+with open(cloudsdk.CRED_CONFIG, "w") as outfile:
+    json.dump({ 'BENCH': { 'userId': "bench", 'password': "bench" } }, outfile)
+
+print("%d API calls per run" % args.calls)
+for label, pool_size in [("before (no keep-alive)", 0), ("after  (pool size %d)" % cloudsdk.POOL_SIZE, None)]:
+    handshakes, took = run(server, pool_size, args.calls)
+    print("   -> %s: %5d handshakes, %6.0f ms" % (label, handshakes, took * 1000))
+
+server.shutdown()
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+# Time ProvData lookups against the recorded cache/<deployment>-ProvData.json
+# fixtures: indexed lookups vs the old linear scans, for the same lookups a
+# collection run does per device (inventory -> venue -> entity).
+#
+#   python3 bench/provdata_lookup.py [-d PROD] [-r ROUNDS]
+
+import sys
+import os
+import json
+import argparse
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import cloudsdk
+
+# Stands in for cloudsdk.API, serving ProvData from a fixture file
+class FixtureAPI:
+    def __init__(self, deployment):
+        self.deployment = deployment
+
+    def load_cache(self, name, revalidate = None, max_stale = None):
+        f = open("cache/%s-%s.json" % (self.deployment, name))
+        data = json.load(f)
+        f.close()
+        return data
+
+# The lookups as they were before indexing
+def linear_lookup(pdata, mac):
+    inv = None
+    for i in pdata.inventory:
+        if ('serialNumber' in i and i['serialNumber'] == mac):
+            inv = i
+            break
+    if (inv == None or 'venue' not in inv):
+        return None
+    venue = None
+    for v in pdata.venues:
+        if ('id' in v and v['id'] == inv['venue']):
+            venue = v
+            break
+    if (venue == None):
+        return None
+    for e in pdata.entities:
+        if ('id' in e and e['id'] == venue['entity']):
+            return (inv['name'], venue['name'], e['name'])
+    return None
+
+def indexed_lookup(pdata, mac):
+    inv = pdata.get_inventory_by_mac(mac)
+    if (inv == None or 'venue' not in inv):
+        return None
+    venue = pdata.get_venue_by_uuid(inv['venue'])
+    if (venue == None):
+        return None
+    e = pdata.get_entity_by_uuid(venue['entity'])
+    if (e == None):
+        return None
+    return (inv['name'], venue['name'], e['name'])
+
+def timed(fn, pdata, macs, rounds):
+    start_tm = datetime.now()
+    for r in range(rounds):
+        results = [ fn(pdata, mac) for mac in macs ]
+    took = (datetime.now() - start_tm).total_seconds()
+    return results, took
+
+parser = argparse.ArgumentParser(description="ProvData lookup benchmark")
+parser.add_argument('-d', '--deployment', default="PROD", action='store', help="Deployment fixture to load")
+parser.add_argument('-r', '--rounds', type=int, default=20, action='store', help="Lookup rounds over all MACs")
+args = parser.parse_args()
+
+pdata = cloudsdk.ProvData(FixtureAPI(args.deployment.upper()), verbose=False)
+macs = [ i['serialNumber'] for i in pdata.inventory if 'serialNumber' in i ]
+# Include misses, which are the worst case for a linear scan
+macs += [ "000000%06x" % n for n in range(len(macs) // 10) ]
+lookups = len(macs) * args.rounds
+
+print("%s: %d inventory, %d venues, %d entities; %d lookups"
+        % (args.deployment.upper(), len(pdata.inventory), len(pdata.venues), len(pdata.entities), lookups))
+linear, linear_tm = timed(linear_lookup, pdata, macs, args.rounds)
+indexed, indexed_tm = timed(indexed_lookup, pdata, macs, args.rounds)
+if (linear != indexed):
+    print("ERROR: indexed lookups differ from linear scans")
+    exit(1)
+print("   -> linear:  %8.1f ms (%6.2f us/lookup)" % (linear_tm * 1000, linear_tm * 1e6 / lookups))
+print("   -> indexed: %8.1f ms (%6.2f us/lookup)" % (indexed_tm * 1000, indexed_tm * 1e6 / lookups))
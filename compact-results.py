@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import argparse
+
+sys.path.append('modules/')
+sys.path.append('config/')
+
+from modules import retention
+from modules.retention import RETENTION
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Compact historical collection results")
+parser.add_argument('-d', '--deployment', action='append',
+                    help="Compact results/<deployment> (repeat or comma separate for several)")
+parser.add_argument('-O', '--outdir', action='append', help='Compact this output dir (repeat for several)')
+parser.add_argument('-f', '--full-days', type=int, default=RETENTION['full_days'], action='store',
+                    help="Keep snapshots as written for this many days (default is %d)" % RETENTION['full_days'])
+parser.add_argument('-D', '--day-days', type=int, default=RETENTION['day_days'], action='store',
+                    help="Keep day archives for this many days before merging them by month (default is %d)" % RETENTION['day_days'])
+parser.add_argument('-M', '--keep-months', type=int, default=RETENTION['keep_months'], action='store',
+                    help="Drop month archives older than this many months (default is to keep them)")
+args = parser.parse_args()
+
+outdirs = []
+for d in (args.deployment or []):
+    outdirs += [ "results/%s" % x.strip().upper() for x in d.split(",") if x.strip() ]
+outdirs += (args.outdir or [])
+if (len(outdirs) == 0):
+    parser.error("give at least one deployment or output dir")
+
+policy = { 'full_days': args.full_days, 'day_days': args.day_days, 'keep_months': args.keep_months }
+for outdir in outdirs:
+    if (not os.path.isdir(outdir)):
+        print("%s: no such dir, skipping" % outdir)
+        continue
+    retention.compact(outdir, policy)
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+import sys
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.append('modules/')
+sys.path.append('config/')
+
+import pandas
+
+from modules import collector
+from modules import timeseries
+from modules.timeseries import TS_GAUGES, TS_LAST
+
+# Parse a time: a number of days back ("7d"), hours back ("12h") or an ISO date/time
+def parseTime(value):
+    if (value == None):
+        return None
+    if (value[-1:] in "dh" and value[:-1].isdigit()):
+        unit = 'days' if value[-1] == "d" else 'hours'
+        return datetime.now() - timedelta(**{ unit: int(value[:-1]) })
+    return datetime.fromisoformat(value)
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Device metrics over time")
+parser.add_argument('-d', '--deployment', action='store', help="Use results/<deployment>")
+parser.add_argument('-O', '--outdir', action='store', help='Use this output dir')
+parser.add_argument('metric', nargs='?', default="mem_used_pct", choices=(TS_GAUGES + TS_LAST),
+                    help="Metric to show (default is mem_used_pct)")
+parser.add_argument('-s', '--since', default="7d", action='store', help="Start of the range: 7d, 12h or an ISO time (default is 7d)")
+parser.add_argument('-u', '--until', action='store', help="End of the range (default is now)")
+parser.add_argument('-r', '--resolution', default="1h", choices=[ "raw", "1h", "1d" ], help="Resolution (default is 1h)")
+parser.add_argument('-b', '--by', default="venue", choices=timeseries.TS_TAGS, help="Group by (default is venue)")
+parser.add_argument('-a', '--agg', default="mean", choices=[ "mean", "min", "max", "median", "sum", "count" ],
+                    help="Aggregation across each group (default is mean)")
+parser.add_argument('-m', '--mac', action='store', help="Only this device")
+parser.add_argument('-v', '--venue', action='store', help="Only this venue")
+parser.add_argument('-o', '--org', action='store', help="Only this org")
+parser.add_argument('-g', '--growth', action='store_true', help="Show the change over the range per group instead")
+parser.add_argument('-n', '--top', type=int, default=20, action='store', help="Groups to show with -g (default is 20)")
+parser.add_argument('-B', '--backfill', action='store_true', help="First load the snapshots taken before the store existed")
+args = parser.parse_args()
+
+if (args.outdir):
+    outdir = args.outdir
+elif (args.deployment):
+    outdir = "results/%s" % (args.deployment.upper())
+else:
+    parser.error("give a deployment or output dir")
+
+store = timeseries.DeviceMetrics(outdir)
+if (args.backfill):
+    print("Loaded %d snapshots into %s" % (store.backfill(collector.Manifest(outdir)), store.root))
+
+since = parseTime(args.since)
+until = parseTime(args.until)
+filters = { 'mac': args.mac, 'venue': args.venue, 'org': args.org }
+pandas.set_option('display.width', 200)
+pandas.set_option('display.max_columns', 20)
+if (args.growth):
+    growth = store.growth(args.metric, args.by, args.resolution, since, until, **filters)
+    print(growth.head(args.top).to_string())
+else:
+    series = store.aggregate(args.metric, args.by, args.resolution, since, until, args.agg, **filters)
+    print(series.to_string())
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+# Anomaly detection across collection runs. Each device has an exponentially
+# weighted mean and variance per metric (cpu, memory, client count, and the
+# noise floor and busy airtime of each band's operating channel), kept in
+# <outdir>/anomaly-baseline.parquet. A snapshot is scored against the
+# baselines in one vectorized pass (z-scores over a devices x metrics
+# matrix), then folded into them. Scoring starts once a device has
+# ANOMALY_WARMUP samples
+
+import os
+
+import numpy
+import pandas
+
+from modules.collector import pyarrow
+from modules.timeseries import writeFrame
+
+# Device metrics from the online devices table, and per band ones from the
+# on-channel survey rows
+ANOMALY_DEVICE_METRICS = [ 'cpu_busy_pct', 'cpu_load_1m', 'mem_used_pct', 'num_assocs' ]
+ANOMALY_BANDS = [ '2g', '5g', '6g' ]
+ANOMALY_METRICS = ANOMALY_DEVICE_METRICS + [ "%s_%s" % (m, b) for m in ['noise_floor', 'busy_pct'] for b in ANOMALY_BANDS ]
+
+# Smallest standard deviation per metric kind, so that a device that never
+# moved is not flagged for a tiny change
+ANOMALY_MIN_STD = { 'cpu_busy_pct': 5.0, 'cpu_load_1m': 0.25, 'mem_used_pct': 2.0, 'num_assocs': 2.0,
+                    'noise_floor': 2.0, 'busy_pct': 5.0 }
+
+ANOMALY_ALPHA = 0.1
+ANOMALY_WARMUP = 10
+ANOMALY_Z = 4.0
+ANOMALY_BASELINE = "anomaly-baseline.parquet"
+ANOMALY_DIR = "anomalies"
+
+# Anomalies get-online-devices.py prints, the rest are in the CSV
+ANOMALY_SHOW = 10
+
+# Device x metric matrix of a snapshot written under prefix, indexed by mac
+def snapshotMetrics(prefix):
+    devices = readTable(prefix, "online-devices", [ 'mac', 'name', 'org', 'venue' ] + ANOMALY_DEVICE_METRICS)
+    devices = devices.drop_duplicates('mac').set_index('mac')
+    metrics = devices[ANOMALY_DEVICE_METRICS].apply(pandas.to_numeric, errors='coerce').astype("float64")
+
+    survey = readTable(prefix, "survey-data", [ 'mac', 'band', 'on-chan', 'noise_floor', 'agg_15m_active_ms', 'agg_15m_busy_ms' ])
+    survey = survey[survey['on-chan'].astype(str) == "True"]
+    active = pandas.to_numeric(survey['agg_15m_active_ms'], errors='coerce')
+    survey = survey.assign(noise_floor=pandas.to_numeric(survey['noise_floor'], errors='coerce'),
+                           busy_pct=(100.0 * pandas.to_numeric(survey['agg_15m_busy_ms'], errors='coerce') / active.where(active > 0)))
+    by_band = survey.groupby([ 'mac', 'band' ])[[ 'noise_floor', 'busy_pct' ]].mean()
+
+    # -1 stands for unknown in the collector's records
+    metrics = metrics.mask(metrics < 0)
+    by_band['busy_pct'] = by_band['busy_pct'].mask(by_band['busy_pct'] < 0)
+    by_band = by_band.unstack('band')
+    by_band.columns = [ "%s_%s" % (m, b) for m, b in by_band.columns ]
+    metrics = metrics.join(by_band).reindex(columns=ANOMALY_METRICS).astype("float64")
+    return metrics, devices[[ 'name', 'org', 'venue' ]]
+
+# Read columns of a snapshot table, from Parquet if there is one
+def readTable(prefix, name, columns):
+    if (os.path.exists("%s-%s.parquet" % (prefix, name))):
+        return pandas.read_parquet("%s-%s.parquet" % (prefix, name), columns=columns)
+    df = pandas.read_json("%s-%s.ndjson" % (prefix, name), lines=True, dtype=False)
+    return df.reindex(columns=columns)
+
+#==================================================================================================================
+
+class AnomalyDetector:
+    # Init the detector of a collector output dir, loading its baselines
+    def __init__(self, outdir, alpha = ANOMALY_ALPHA, warmup = ANOMALY_WARMUP, z = ANOMALY_Z):
+        if (pyarrow == None):
+            raise Exception("[anomaly] Error: anomaly detection requires pyarrow")
+        self.outdir = outdir
+        self.alpha  = alpha
+        self.warmup = warmup
+        self.z      = z
+        self.fn     = os.path.join(outdir, ANOMALY_BASELINE)
+        self.min_std = numpy.array([ ANOMALY_MIN_STD[m.rsplit("_", 1)[0] if m[-2:] in ANOMALY_BANDS else m] for m in ANOMALY_METRICS ])
+        self.load()
+
+    # Load the baselines: mean, var and sample count per device and metric
+    def load(self):
+        if (os.path.exists(self.fn)):
+            df = pandas.read_parquet(self.fn).set_index('mac')
+        else:
+            df = pandas.DataFrame(index=pandas.Index([], name='mac', dtype="str"))
+        self.mean = df.reindex(columns=[ m + "_mean" for m in ANOMALY_METRICS ]).set_axis(ANOMALY_METRICS, axis=1).astype("float64")
+        self.var  = df.reindex(columns=[ m + "_var" for m in ANOMALY_METRICS ]).set_axis(ANOMALY_METRICS, axis=1).astype("float64")
+        self.n    = df.reindex(columns=[ m + "_n" for m in ANOMALY_METRICS ]).set_axis(ANOMALY_METRICS, axis=1).fillna(0).astype("int64")
+
+    # Save the baselines
+    def save(self):
+        df = pandas.concat([ self.mean.add_suffix("_mean"), self.var.add_suffix("_var"), self.n.add_suffix("_n") ], axis=1)
+        writeFrame(self.fn, df.reset_index())
+
+    # Score a device x metric matrix against the baselines, then fold it
+    # into them. Returns the anomalies, largest |z| first
+    def score(self, metrics, info = None):
+        macs = self.mean.index.union(metrics.index).rename('mac')
+        mean = self.mean.reindex(macs).to_numpy()
+        var  = self.var.reindex(macs).to_numpy()
+        n    = self.n.reindex(macs, fill_value=0).to_numpy()
+        x    = metrics.reindex(index=macs, columns=ANOMALY_METRICS).to_numpy()
+        seen = ~numpy.isnan(x)
+        base = mean
+
+        std = numpy.sqrt(numpy.fmax(var, self.min_std ** 2))
+        with numpy.errstate(invalid='ignore'):
+            z = numpy.where(seen & (n >= self.warmup), (x - mean) / std, numpy.nan)
+
+        # EWMA update. Until 1/n drops below alpha this is the running mean and
+        # variance, so young baselines are not dominated by their first sample
+        a = numpy.fmax(self.alpha, 1.0 / (n + 1))
+        with numpy.errstate(invalid='ignore'):
+            delta = x - numpy.nan_to_num(mean)
+            mean = numpy.where(seen, numpy.nan_to_num(mean) + a * delta, mean)
+            var = numpy.where(seen, (1 - a) * (numpy.nan_to_num(var) + a * delta * delta), var)
+        n = n + seen
+        self.mean = pandas.DataFrame(mean, index=macs, columns=ANOMALY_METRICS)
+        self.var  = pandas.DataFrame(var, index=macs, columns=ANOMALY_METRICS)
+        self.n    = pandas.DataFrame(n, index=macs, columns=ANOMALY_METRICS)
+
+        rows, cols = numpy.nonzero(numpy.abs(numpy.nan_to_num(z)) >= self.z)
+        found = pandas.DataFrame({ 'mac': macs[rows], 'metric': numpy.array(ANOMALY_METRICS)[cols],
+                                   'value': x[rows, cols], 'baseline': base[rows, cols], 'std': std[rows, cols],
+                                   'z': z[rows, cols] })
+        if (info is not None):
+            found = found.join(info, on='mac')
+        order = numpy.argsort(-numpy.abs(found['z'].to_numpy()), kind='stable')
+        return found.iloc[order].reset_index(drop=True)
+
+    # Score the snapshot written under prefix, save the baselines and the
+    # anomalies (to <outdir>/anomalies/<snapshot>.csv, removed by retention
+    # once the snapshot is in a month archive). Returns the anomalies
+    def run_snapshot(self, prefix):
+        metrics, info = snapshotMetrics(prefix)
+        found = self.score(metrics, info)
+        self.save()
+        if (len(found) > 0):
+            os.makedirs(os.path.join(self.outdir, ANOMALY_DIR), exist_ok=True)
+            found.to_csv(os.path.join(self.outdir, ANOMALY_DIR, os.path.basename(prefix) + ".csv"), index=False)
+        return found
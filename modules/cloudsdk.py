@@ -3,36 +3,582 @@
 import sys
 import os
 import time
+import select
+import threading
 import http.client
 import json
 import csv
-from datetime import datetime, timedelta
+import zlib
+import gzip
+import marshal
+import re
+import tempfile
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append('config/')
 CLOUD_CONFIG = "config/clouds.json"
 CRED_CONFIG  = "config/PRIV-creds.json"
 CACHE_CONFIG = "config/PRIV-auth-cache.json"
 GET_LIMIT    = 75
 CACHE_TIME   = 120
+CACHE_DIR    = "cache"
+CACHE_LRU_SIZE = 16
+
+# Per-resource cache lifetime in secs (CACHE_TIME if not listed), and how long
+# past that a stale entry may still be served while it is reloaded. Callers
+# that can live with older data pass a longer max_stale
+CACHE_TTL    = { 'ProvData': 120, 'Devices': 120 }
+CACHE_STALE  = { 'ProvData': 300, 'Devices': 300 }
+
+# Upper bounds (secs) of the API call latency histogram buckets
+METRICS_BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 ]
+
+# Cache files are zlib compressed marshal data, tagged with the marshal version
+CACHE_MAGIC  = b"CSDKC" + bytes([ marshal.version ])
+POOL_SIZE    = 4
+LOAD_WORKERS = 4
+RATE_RETRIES = 3
+
+# Default rate limit per service (requests/sec). Override per service in the
+# cloud config with a "rate_limit" object using the same keys
+RATE_LIMIT   = { 'rate': 20, 'burst': 10, 'min_rate': 1, 'max_rate': 100, 'step': 0.5 }
+POOL_IDLE    = 30
+
+# Bulk commands: at most BULK_WINDOW commands in flight at once. Canary waves
+# of BULK_WAVES sizes run to completion before the rest, and the rollout stops
+# if more than BULK_MAX_FAIL of a wave did not complete
+BULK_WINDOW  = 16
+BULK_WAVES   = [ 1, 10 ]
+BULK_MAX_FAIL = 0.2
+
+# Command status polling: first wait, backoff factor and max wait between
+# polling rounds, and how long a command may take before it is given up on
+BULK_POLL    = { 'interval': 1, 'factor': 2, 'max_interval': 30, 'timeout': 900 }
+CMD_FAILED   = [ "failed", "expired", "timedout", "cancelled" ]
+
+# Errors that mean a kept-alive connection was dropped by the other end
+CONN_RESET_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                     http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+
+# Progress lines may come from several threads at once (e.g. ProvData loads
+# its collections in parallel), so each line is written whole under one lock
+PRINT_LOCK = threading.Lock()
+
+def printLine(line):
+    with PRINT_LOCK:
+        sys.stdout.write(line + "\n")
+
+class ConnectionPool:
+    # Init pool of keep-alive connections to a single service
+    def __init__(self, host, port, size = POOL_SIZE, use_ssl = True, idle_time = POOL_IDLE):
+        self.host      = host
+        self.port      = port
+        self.size      = size
+        self.use_ssl   = use_ssl
+        self.idle_time = idle_time
+        self.idle      = []
+        self.lock      = threading.Lock()
+        self.connects  = 0
+        self.reuses    = 0
+        self.resets    = 0
+
+    # Open a new connection (one TCP + TLS handshake)
+    def new_conn(self):
+        if (self.use_ssl):
+            conn = http.client.HTTPSConnection(self.host, self.port)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port)
+        with self.lock:
+            self.connects += 1
+        return conn
+
+    # Check an idle connection is still usable: the socket must be open and
+    # must not be readable, as that means the server closed it (or sent junk)
+    def is_healthy(self, conn, last_used):
+        if (conn.sock == None):
+            return False
+        if ((time.monotonic() - last_used) > self.idle_time):
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return (len(readable) == 0)
+
+    # Get a connection: reuse a healthy idle one if possible, else open one.
+    # Returns (conn, reused)
+    def acquire(self):
+        while (True):
+            with self.lock:
+                if (len(self.idle) == 0):
+                    break
+                conn, last_used = self.idle.pop()
+            if (self.is_healthy(conn, last_used)):
+                with self.lock:
+                    self.reuses += 1
+                return conn, True
+            conn.close()
+        return self.new_conn(), False
+
+    # Return a connection to the pool, or close it if the pool is full
+    def release(self, conn):
+        with self.lock:
+            if (conn.sock != None and len(self.idle) < self.size):
+                self.idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    # Drop a connection that failed
+    def discard(self, conn):
+        conn.close()
+        with self.lock:
+            self.resets += 1
+
+    # Close all idle connections
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn, _ in idle:
+            conn.close()
+
+    # Connection counters for this pool
+    def get_stats(self):
+        with self.lock:
+            return { 'connects': self.connects, 'reuses': self.reuses, 'resets': self.resets, 'idle': len(self.idle) }
+
+# Wraps a response to count the (compressed) bytes read from the wire
+class CountingReader:
+    def __init__(self, raw):
+        self.raw   = raw
+        self.count = 0
+
+    def read(self, size = -1):
+        data = self.raw.read(size)
+        self.count += len(data)
+        return data
+
+# Read a response body, returns (body, bytes on the wire). A gzip encoded body
+# is decompressed as it is read off the socket, so the compressed copy is
+# never held in memory in full
+def read_body(res):
+    if (res.getheader('Content-Encoding', "").lower() != "gzip"):
+        data = res.read()
+        return data, len(data)
+    wire = CountingReader(res)
+    with gzip.GzipFile(fileobj=wire) as gz:
+        data = gz.read()
+    # Drain anything after the gzip stream so the connection can be reused
+    wire.read()
+    return data, wire.count
+
+#==================================================================================================================
+
+class RateLimiter:
+    # Init adaptive token bucket. The rate is cut in half whenever the
+    # service pushes back (429/5xx) and grows by 'step' req/s per successful
+    # call, so it settles near the highest rate the service accepts
+    def __init__(self, rate, burst, min_rate, max_rate, step):
+        self.rate     = float(rate)
+        self.burst    = float(burst)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.step     = float(step)
+        self.tokens   = float(burst)
+        self.last     = time.monotonic()
+        self.blocked_until = 0
+        self.lock     = threading.Lock()
+        self.waited   = 0.0
+        self.throttled = 0
+
+    # Wait for a token
+    def acquire(self):
+        while (True):
+            with self.lock:
+                now = time.monotonic()
+                if (now < self.blocked_until):
+                    wait = self.blocked_until - now
+                else:
+                    # No tokens are earned while blocked
+                    since = max(self.last, self.blocked_until)
+                    self.tokens = min(self.burst, self.tokens + (now - since) * self.rate)
+                    self.last = now
+                    if (self.tokens >= 1):
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+    # Service handled the call fine: speed up
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+    # Service pushed back: slow down, and stop completely for retry_after secs if given
+    def on_throttle(self, retry_after = None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.last = time.monotonic()
+            self.throttled += 1
+            if (retry_after != None and retry_after > 0):
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    # Limiter counters
+    def get_stats(self):
+        with self.lock:
+            return { 'rate': round(self.rate, 2), 'throttled': self.throttled, 'waited': round(self.waited, 3) }
+
+# Parse a Retry-After header (delay in seconds or an HTTP date) into seconds
+def parse_retry_after(value):
+    if (value == None):
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (when - datetime.now(when.tzinfo)).total_seconds())
+
+#==================================================================================================================
+
+class Cache:
+    # Init two-level cache: an in-process LRU of decoded entries in front of
+    # compressed files in cache_dir. Entries are shared, treat them as read-only
+    def __init__(self, cache_dir = CACHE_DIR, lru_size = CACHE_LRU_SIZE):
+        self.cache_dir = cache_dir
+        self.lru_size  = lru_size
+        self.lru       = OrderedDict()
+        self.reloading = set()
+        self.lock      = threading.Lock()
+
+    def path(self, key, ext):
+        return os.path.join(self.cache_dir, "%s.%s" % (key, ext))
+
+    # Get (data, age in secs) of an entry, or (None, None) if there is none
+    def get(self, key):
+        try:
+            f = open(self.path(key, "bin"), "rb")
+        except FileNotFoundError:
+            return self.get_json(key)
+        with f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            with self.lock:
+                ent = self.lru.get(key)
+                if (ent != None and ent[0] == mtime):
+                    self.lru.move_to_end(key)
+                    return ent[1], (time.time() - mtime)
+            blob = f.read()
+        if (not blob.startswith(CACHE_MAGIC)):
+            return None, None
+        try:
+            data = marshal.loads(zlib.decompress(blob[len(CACHE_MAGIC):]))
+        except (zlib.error, ValueError, EOFError, TypeError):
+            return None, None
+        self.remember(key, mtime, data)
+        return data, (time.time() - mtime)
+
+    # Get an entry from a plain JSON cache file, as written by older versions
+    def get_json(self, key):
+        try:
+            f = open(self.path(key, "json"))
+        except FileNotFoundError:
+            return None, None
+        with f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            data = json.load(f)
+        return data, (time.time() - mtime)
+
+    # Store an entry. The file is written under a temp name and renamed into
+    # place, so concurrent readers see either the old or the new entry
+    def put(self, key, data):
+        blob = CACHE_MAGIC + zlib.compress(marshal.dumps(data), 1)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_fn = tempfile.mkstemp(dir=self.cache_dir, prefix=".%s." % key, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                outfile.write(blob)
+            os.replace(tmp_fn, self.path(key, "bin"))
+        except BaseException:
+            os.unlink(tmp_fn)
+            raise
+        self.remember(key, os.path.getmtime(self.path(key, "bin")), data)
+
+    def remember(self, key, mtime, data):
+        with self.lock:
+            self.lru[key] = (mtime, data)
+            self.lru.move_to_end(key)
+            while (len(self.lru) > self.lru_size):
+                self.lru.popitem(last=False)
+
+    # Take the reload lock for an entry, so only one thread of this process
+    # reloads it. The lock is held in memory, so it is gone with the process
+    # even if the reloading thread never finishes; the reloaded entry is
+    # written atomically by put(), so concurrent reloads by other processes
+    # are harmless
+    def lock_reload(self, key):
+        with self.lock:
+            if (key in self.reloading):
+                return False
+            self.reloading.add(key)
+            return True
+
+    def unlock_reload(self, key):
+        with self.lock:
+            self.reloading.discard(key)
+
+# Cache shared by all API instances in this process
+shared_cache = Cache()
+
+#==================================================================================================================
+
+# Path segments replaced by a placeholder in endpoint templates
+ENDPOINT_PARAMS = [ (re.compile(r"^[0-9a-fA-F]{12}$"), "{mac}"),
+                    (re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$"), "{uuid}"),
+                    (re.compile(r"^[0-9]+$"), "{id}") ]
+
+# Turn a request URI into its endpoint template: MACs, UUIDs and numbers in the
+# path become placeholders and query parameters keep their names only, e.g.
+# /api/v1/device/{mac}/statistics?lastOnly
+def endpoint_template(uri):
+    path, _, query = uri.partition("?")
+    segs = []
+    for seg in path.split("/"):
+        for pattern, name in ENDPOINT_PARAMS:
+            if (pattern.match(seg)):
+                seg = name
+                break
+        segs.append(seg)
+    template = "/".join(segs)
+    if (query):
+        template += "?" + "&".join(sorted([ q.partition("=")[0] for q in query.split("&") ]))
+    return template
+
+# Escape a Prometheus label value
+def prom_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class Metrics:
+    # Init per endpoint call metrics, labelled by service and endpoint template
+    def __init__(self, deployment):
+        self.deployment = deployment
+        self.lock       = threading.Lock()
+        self.endpoints  = {}
+
+    # Record one API call
+    def record(self, svc, endpoint, latency, wire_bytes, body_bytes, retries, error, decode_secs = 0):
+        with self.lock:
+            m = self.endpoints.get((svc, endpoint))
+            if (m == None):
+                m = { 'calls': 0, 'errors': 0, 'retries': 0, 'wire_bytes': 0, 'body_bytes': 0,
+                      'latency_sum': 0.0, 'latency_max': 0.0, 'decode_secs': 0.0,
+                      'buckets': [ 0 ] * (len(METRICS_BUCKETS) + 1) }
+                self.endpoints[(svc, endpoint)] = m
+            m['calls'] += 1
+            m['retries'] += retries
+            m['wire_bytes'] += wire_bytes
+            m['body_bytes'] += body_bytes
+            m['latency_sum'] += latency
+            m['latency_max'] = max(m['latency_max'], latency)
+            m['decode_secs'] += decode_secs
+            if (error):
+                m['errors'] += 1
+            i = 0
+            while (i < len(METRICS_BUCKETS) and latency > METRICS_BUCKETS[i]):
+                i += 1
+            m['buckets'][i] += 1
+
+    # Get a copy of all metrics as a list of dicts, slowest endpoints (by
+    # total time) first
+    def get(self):
+        with self.lock:
+            items = [ dict(m, service=svc, endpoint=ep, buckets=list(m['buckets']))
+                      for (svc, ep), m in self.endpoints.items() ]
+        items.sort(key=lambda m: m['latency_sum'], reverse=True)
+        return items
+
+    # Metrics as a JSON document
+    def to_json(self):
+        return json.dumps({ 'deployment': self.deployment, 'buckets': METRICS_BUCKETS, 'endpoints': self.get() }, indent=2)
+
+    # Metrics in Prometheus text exposition format
+    def to_prometheus(self):
+        items = self.get()
+        lines = []
+        counters = [ ('calls', "cloudsdk_calls_total", "API calls"),
+                     ('errors', "cloudsdk_errors_total", "API calls that failed or returned an error status"),
+                     ('retries', "cloudsdk_retries_total", "API call retries after 429/5xx responses"),
+                     ('wire_bytes', "cloudsdk_response_wire_bytes_total", "Response body bytes received"),
+                     ('body_bytes', "cloudsdk_response_body_bytes_total", "Response body bytes after decompression"),
+                     ('decode_secs', "cloudsdk_decode_seconds_total", "Time spent decoding JSON responses") ]
+        for key, name, desc in counters:
+            lines.append("# HELP %s %s" % (name, desc))
+            lines.append("# TYPE %s counter" % name)
+            for m in items:
+                labels = 'deployment="%s",service="%s",endpoint="%s"' % (prom_label(self.deployment), prom_label(m['service']), prom_label(m['endpoint']))
+                lines.append("%s{%s} %s" % (name, labels, m[key]))
+
+        name = "cloudsdk_call_duration_seconds"
+        lines.append("# HELP %s API call latency, including retries" % name)
+        lines.append("# TYPE %s histogram" % name)
+        for m in items:
+            labels = 'deployment="%s",service="%s",endpoint="%s"' % (prom_label(self.deployment), prom_label(m['service']), prom_label(m['endpoint']))
+            cumulative = 0
+            for le, cnt in zip(METRICS_BUCKETS + [ "+Inf" ], m['buckets']):
+                cumulative += cnt
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, le, cumulative))
+            lines.append("%s_sum{%s} %s" % (name, labels, m['latency_sum']))
+            lines.append("%s_count{%s} %d" % (name, labels, m['calls']))
+        return "\n".join(lines) + "\n"
+
+    # Write metrics to a file: Prometheus text, or JSON if the name ends in .json
+    def dump(self, fn):
+        if (fn.endswith(".json")):
+            text = self.to_json()
+        else:
+            text = self.to_prometheus()
+        with open(fn, "w") as outfile:
+            outfile.write(text)
+
+    # Summary table of the endpoints that took the most time
+    def summary(self, top = 10):
+        lines = [ "%-7s %-55s %6s %8s %8s %8s %6s %6s %10s" % ("svc", "endpoint", "calls", "total s", "avg ms", "max ms", "retry", "errors", "KB rcvd") ]
+        for m in self.get()[:top]:
+            lines.append("%-7s %-55s %6d %8.2f %8.1f %8.1f %6d %6d %10.1f" %
+                         (m['service'], m['endpoint'][:55], m['calls'], m['latency_sum'], (m['latency_sum'] * 1000 / m['calls']),
+                          m['latency_max'] * 1000, m['retries'], m['errors'], m['wire_bytes'] / 1024))
+        return "\n".join(lines)
+
+#==================================================================================================================
 
 class API:
+    # Send a request over a pooled connection, returns the response, its
+    # (decompressed) body and the number of bytes received for the body
+    def send_request(self, pool, method, uri, body, headers):
+        # A reused connection may have been closed by the server since it was
+        # last used: retry on a fresh connection if so. Once the request was
+        # sent only a GET is retried, as the server may have acted on it
+        while (True):
+            conn, reused = pool.acquire()
+            sent = False
+            try:
+                conn.request(method, uri, body, headers)
+                sent = True
+                res = conn.getresponse()
+                data, wire_bytes = read_body(res)
+            except CONN_RESET_ERRORS:
+                pool.discard(conn)
+                if (reused and (not sent or method == "GET")):
+                    continue
+                raise
+            except Exception:
+                pool.discard(conn)
+                raise
+            break
+
+        if (res.will_close):
+            conn.close()
+        else:
+            pool.release(conn)
+        return res, data, wire_bytes
+
     # Make an API call
-    def api_call(self, svc, method, uri, payload = {}, headers = None):
+    def api_call(self, svc, method, uri, payload = {}, headers = None, decode = True):
         if (svc not in self.cloud_svcs):
             raise Exception("[cloudsdk] api_call Error: svc \"%s\" is unknown" % svc)
     
-        conn = http.client.HTTPSConnection(self.cloud_svcs[svc]["host"], self.cloud_svcs[svc]["port"])
+        pool = self.pools[svc]
+        limiter = self.limiters[svc]
+        method = method.upper()
         if (headers == None):
             headers = self.headers
-    
-        conn.request(method.upper(), uri, json.dumps(payload), headers)
-        res = conn.getresponse()
-        return json.loads(res.read())
+        # Send body as bytes so http.client writes it together with the headers
+        body = json.dumps(payload).encode()
+
+        # Back off and retry when the service pushes back. Only GETs are
+        # retried on 5xx: a POST may already have been acted on
+        endpoint = endpoint_template(uri)
+        start_tm = time.perf_counter()
+        wire_total = 0
+        tries = 0
+        try:
+            while (True):
+                limiter.acquire()
+                res, data, wire_bytes = self.send_request(pool, method, uri, body, headers)
+                wire_total += wire_bytes
+                if (res.status == 429 or res.status >= 500):
+                    limiter.on_throttle(parse_retry_after(res.getheader('Retry-After')))
+                    tries += 1
+                    if (tries <= RATE_RETRIES and (res.status == 429 or method == "GET")):
+                        continue
+                else:
+                    limiter.on_success()
+                break
+        except Exception:
+            self.metrics.record(svc, endpoint, time.perf_counter() - start_tm, wire_total, 0, tries, True)
+            raise
+        latency = time.perf_counter() - start_tm
+        if (not decode):
+            # The caller decodes the body (e.g. on another process)
+            self.metrics.record(svc, endpoint, latency, wire_total, len(data), min(tries, RATE_RETRIES), (res.status >= 400), 0.0)
+            return data
+
+        decode_tm = time.perf_counter()
+        try:
+            resp = json.loads(data)
+        finally:
+            decode_secs = time.perf_counter() - decode_tm
+            self.metrics.record(svc, endpoint, latency, wire_total, len(data), min(tries, RATE_RETRIES),
+                                (res.status >= 400), decode_secs)
+        return resp
+
+    # Get transfer counters per service: bytes received on the wire vs after
+    # decompression, and time spent decoding JSON
+    def get_transfer_stats(self):
+        stats = { svc: { 'calls': 0, 'wire_bytes': 0, 'body_bytes': 0, 'decode_secs': 0.0 } for svc in self.cloud_svcs }
+        for m in self.metrics.get():
+            ts = stats[m['service']]
+            for k in ts.keys():
+                ts[k] += m[k]
+        for ts in stats.values():
+            if (ts['body_bytes'] > 0):
+                ts['ratio'] = round(ts['wire_bytes'] / ts['body_bytes'], 3)
+        return stats
+
+    # Get per endpoint call metrics (see Metrics)
+    def get_metrics(self):
+        return self.metrics.get()
+
+    # Get rate limiter state per service
+    def get_rate_stats(self):
+        return { svc: limiter.get_stats() for svc, limiter in self.limiters.items() }
+
+    # Get connection pool counters per service
+    def get_pool_stats(self):
+        return { svc: pool.get_stats() for svc, pool in self.pools.items() }
+
+    # Close all pooled connections
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
 
     # Init CloudSDK API class
-    def __init__(self, deployment = "DF", verbose = True):
+    def __init__(self, deployment = "DF", verbose = True, pool_size = None, load_workers = LOAD_WORKERS, cache = None):
         self.cloud_conf = {}
         self.cloud_svcs = {}
-        self.headers    = { 'Content-Type': 'application/json' }
+        self.pools      = {}
+        self.limiters   = {}
+        self.load_workers = load_workers
+        if (cache == None):
+            cache = shared_cache
+        self.cache      = cache
+        self.headers    = { 'Content-Type': 'application/json', 'Accept-Encoding': 'gzip' }
 
         # Load cloud config
         if (not os.path.exists(CLOUD_CONFIG)):
@@ -47,6 +593,21 @@ class API:
             raise Exception("[cloudsdk] Error: deployment \"%s\" not found in %s" % (deployment, CLOUD_CONFIG))
         self.deployment = deployment
         self.cloud_svcs = cloud_conf[deployment]
+        self.metrics    = Metrics(deployment)
+
+        # One keep-alive connection pool and rate limiter per service. Pool size
+        # can be set per service in the cloud config, or overridden for all
+        # services here
+        for svc, svc_conf in self.cloud_svcs.items():
+            if (pool_size != None):
+                size = pool_size
+            else:
+                size = svc_conf.get("pool_size", POOL_SIZE)
+            use_ssl = (svc_conf.get("scheme", "https") == "https")
+            self.pools[svc] = ConnectionPool(svc_conf["host"], svc_conf["port"], size, use_ssl)
+            rate_conf = dict(RATE_LIMIT)
+            rate_conf.update(svc_conf.get("rate_limit", {}))
+            self.limiters[svc] = RateLimiter(**rate_conf)
     
         # Get Auth Token
         token = None
@@ -92,9 +653,9 @@ class API:
         return self.api_call("owgw", "GET", uri)
 
     # Get last state message of a given MAC address
-    def get_device_stats(self, mac):
+    def get_device_stats(self, mac, raw = False):
         uri = "/api/v1/device/%s/statistics?lastOnly=true" % (mac)
-        return self.api_call("owgw", "GET", uri)
+        return self.api_call("owgw", "GET", uri, decode=(not raw))
     
     # Get total device count
     def get_device_count(self):
@@ -160,56 +721,111 @@ class API:
             return None
         return resp['entities']
 
+    # Fetch the pages of a collection, yielding each page (a list of records)
+    # in offset order as it arrives. The total comes from the count call
+    # unless given. Pages of GET_LIMIT are fetched concurrently but at most
+    # load_workers are in flight, so memory is bounded by the page size rather
+    # than the collection size. A page that fails is yielded as None, which
+    # ends the iteration
+    def iter_pages(self, label, count_fn, page_fn, verbose = True, limit = None, count = None):
+        if (count == None):
+            count = count_fn()
+        if (count <= 0):
+            if (verbose):
+                printLine("[cloudsdk] -> Loading %s: %d total" % (label, count))
+            return
+        if (limit != None and limit < count):
+            total = limit
+        else:
+            total = count
+        if (verbose):
+            printLine("[cloudsdk] -> Loading %s: %d total, fetching %d at a time" % (label, count, GET_LIMIT))
+
+        def fetch_page(offset):
+            start_tm = datetime.now()
+            page = page_fn(min(offset + GET_LIMIT, total) - offset, offset)
+            return page, (datetime.now() - start_tm).total_seconds()
+
+        # Progress is reported here as the pages are yielded, in offset order,
+        # not from the fetch threads
+        def next_page():
+            offset, future = pending.popleft()
+            page, fetch_tm = future.result()
+            if (verbose):
+                if (page == None):
+                    result = "failed"
+                else:
+                    result = "done (took %4.0f ms)" % ((fetch_tm * 1000))
+                printLine("[cloudsdk]    -> Fetching %-9s %3d to %3d....%s" % (label, (offset+1), min(offset + GET_LIMIT, total), result))
+            return page
+
+        executor = ThreadPoolExecutor(max_workers=self.load_workers)
+        pending = deque()
+        try:
+            for offset in range(0, total, GET_LIMIT):
+                pending.append((offset, executor.submit(fetch_page, offset)))
+                if (len(pending) >= self.load_workers):
+                    page = next_page()
+                    yield page
+                    if (page == None):
+                        return
+            while (len(pending) > 0):
+                page = next_page()
+                yield page
+                if (page == None):
+                    return
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # Iterate over the records of a collection as the pages arrive
+    def iter_records(self, label, count_fn, page_fn, verbose = True, limit = None, count = None):
+        for page in self.iter_pages(label, count_fn, page_fn, verbose, limit, count):
+            if (page == None):
+                raise Exception("[cloudsdk] Error: failed to load %s from %s" % (label, self.deployment))
+            yield from page
+
+    # Iterate over all devices (not cached), pass count if already known
+    def iter_devices(self, verbose = True, limit = None, count = None):
+        return self.iter_records("devices", self.get_device_count, self.get_devices, verbose, limit, count)
+
+    # Iterate over all inventory
+    def iter_inventory(self, verbose = True, limit = None, count = None):
+        return self.iter_records("inventory", self.get_inventory_count, self.get_inventory, verbose, limit, count)
+
+    # Iterate over all venues
+    def iter_venues(self, verbose = True, limit = None, count = None):
+        return self.iter_records("venues", self.get_venue_count, self.get_venues, verbose, limit, count)
+
+    # Iterate over all entities
+    def iter_entities(self, verbose = True, limit = None, count = None):
+        return self.iter_records("entities", self.get_entity_count, self.get_entities, verbose, limit, count)
+
+    # Load a whole collection into a list, None if it is empty or a page failed
+    def load_all(self, label, count_fn, page_fn, verbose = True, limit = None):
+        count = count_fn()
+        items = []
+        for page in self.iter_pages(label, count_fn, page_fn, verbose, limit, count):
+            if (page == None):
+                return None
+            items.extend(page)
+        if (count <= 0):
+            return None
+        return items
+
     # Load all devices
-    def load_all_devices(self, verbose = True, limit = None, no_cache = None):
+    def load_all_devices(self, verbose = True, limit = None, no_cache = None, max_stale = None):
         # Check if we can use cache
         if (not no_cache):
-            devices = self.load_cache("Devices")
+            reload = lambda: self.load_all("devices", self.get_device_count, self.get_devices, False, limit)
+            devices = self.load_cache("Devices", revalidate=reload, max_stale=max_stale)
             if (devices):
                 if (verbose):
                     print("[cloudsdk] -> Loaded devices cache: %d total" % len(devices))
                 return devices
 
-        if (verbose):
-            print("[cloudsdk] -> Loading Device Count....", end="")
-        dev_count = self.get_device_count()
-        if (dev_count <= 0):
-            if (verbose):
-                print("%d total" % dev_count)
+        devices = self.load_all("devices", self.get_device_count, self.get_devices, verbose, limit)
+        if (devices == None):
             return None
-        if (verbose):
-            print("%d total, fetching %d at a time" % (dev_count, GET_LIMIT))
-
-        if (limit != None):
-            left = limit
-        else:
-            left = dev_count
-        left = dev_count
-        offset = 0
-        devices = []
-        while (left > 0):
-            if (verbose):
-                if (left > GET_LIMIT):
-                    end_cnt = offset + GET_LIMIT
-                else:
-                    end_cnt = offset + left
-                print("[cloudsdk]    -> Fetching devices   %3d to %3d...." % ((offset+1), end_cnt), end="")
-            start_tm = datetime.now()
-            devs = self.get_devices(GET_LIMIT, offset)
-            end_tm = datetime.now()
-            if (devs == None):
-                if (verbose):
-                    print("failed")
-                return None
-            if (verbose):
-                fetch_tm = (end_tm - start_tm).total_seconds()
-                print("done (took %4.0f ms)" % ((fetch_tm * 1000)))
-            offset += len(devs)
-            left   -= len(devs)
-            for d in devs:
-                devices.append(d)
-            if (left > 0):
-                time.sleep(0.2)
 
         # Store in cache
         self.save_cache("Devices", devices)
@@ -218,135 +834,15 @@ class API:
 
     # Load all inventory
     def load_all_inventory(self, verbose = True, limit=None):
-        if (verbose):
-            print("[cloudsdk] -> Loading Inventory Count....", end="")
-        inv_count = self.get_inventory_count()
-        if (inv_count <= 0):
-            if (verbose):
-                print("%d total" % inv_count)
-            return None
-        if (verbose):
-            print("%d total, fetching %d at a time" % (inv_count, GET_LIMIT))
-
-        if (limit != None):
-            left = limit
-        else:
-            left = inv_count
-        offset = 0
-        inventory = []
-        while (left > 0):
-            if (verbose):
-                if (left > GET_LIMIT):
-                    end_cnt = offset + GET_LIMIT
-                else:
-                    end_cnt = offset + left
-                print("[cloudsdk]    -> Fetching inventory %3d to %3d...." % ((offset+1), end_cnt), end="")
-            start_tm = datetime.now()
-            inv = self.get_inventory(GET_LIMIT, offset)
-            end_tm = datetime.now()
-            if (inv == None):
-                if (verbose):
-                    print("failed")
-                return None
-            if (verbose):
-                fetch_tm = (end_tm - start_tm).total_seconds()
-                print("done (took %4.0f ms)" % ((fetch_tm * 1000)))
-            offset += len(inv)
-            left   -= len(inv)
-            for i in inv:
-                inventory.append(i)
-            if (left > 0):
-                time.sleep(0.2)
-
-        return inventory
+        return self.load_all("inventory", self.get_inventory_count, self.get_inventory, verbose, limit)
 
     # Load all venues
     def load_all_venues(self, verbose = True, limit = None):
-        if (verbose):
-            print("[cloudsdk] -> Loading Venue Count....", end="")
-        v_count = self.get_venue_count()
-        if (v_count <= 0):
-            if (verbose):
-                print("%d total" % v_count)
-            return None
-        if (verbose):
-            print("%d total, fetching %d at a time" % (v_count, GET_LIMIT))
-
-        if (limit != None):
-            left = limit
-        else:
-            left = v_count
-        offset = 0
-        venues = []
-        while (left > 0):
-            if (verbose):
-                if (left > GET_LIMIT):
-                    end_cnt = offset + GET_LIMIT
-                else:
-                    end_cnt = offset + left
-                print("[cloudsdk]    -> Fetching venues    %3d to %3d...." % ((offset+1), end_cnt), end="")
-            start_tm = datetime.now()
-            vens = self.get_venues(GET_LIMIT, offset)
-            end_tm = datetime.now()
-            if (vens == None):
-                if (verbose):
-                    print("failed")
-                return None
-            if (verbose):
-                fetch_tm = (end_tm - start_tm).total_seconds()
-                print("done (took %4.0f ms)" % ((fetch_tm * 1000)))
-            offset += len(vens)
-            left   -= len(vens)
-            for v in vens:
-                venues.append(v)
-            if (left > 0):
-                time.sleep(0.2)
-
-        return venues
+        return self.load_all("venues", self.get_venue_count, self.get_venues, verbose, limit)
 
     # Load all entities
     def load_all_entities(self, verbose = True, limit = None):
-        if (verbose):
-            print("[cloudsdk] -> Loading Entity Count....", end="")
-        e_count = self.get_entity_count()
-        if (e_count <= 0):
-            if (verbose):
-                print("%d total" % e_count)
-            return None
-        if (verbose):
-            print("%d total, fetching %d at a time" % (e_count, GET_LIMIT))
-
-        if (limit != None):
-            left = limit
-        else:
-            left = e_count
-        offset = 0
-        entities = []
-        while (left > 0):
-            if (verbose):
-                if (left > GET_LIMIT):
-                    end_cnt = offset + GET_LIMIT
-                else:
-                    end_cnt = offset + left
-                print("[cloudsdk]    -> Fetching entities  %3d to %3d...." % ((offset+1), end_cnt), end="")
-            start_tm = datetime.now()
-            ents = self.get_entities(GET_LIMIT, offset)
-            end_tm = datetime.now()
-            if (ents == None):
-                if (verbose):
-                    print("failed")
-                return None
-            if (verbose):
-                fetch_tm = (end_tm - start_tm).total_seconds()
-                print("done (took %4.0f ms)" % ((fetch_tm * 1000)))
-            offset += len(ents)
-            left   -= len(ents)
-            for e in ents:
-                entities.append(e)
-            if (left > 0):
-                time.sleep(0.2)
-
-        return entities
+        return self.load_all("entities", self.get_entity_count, self.get_entities, verbose, limit)
 
     # Run a script (base64 encoded) on the given MAC
     def run_script(self, mac, b64script, deferred = False):
@@ -361,7 +857,10 @@ class API:
         resp = self.api_call("owgw", "POST", uri, payload)
         if ('results' not in resp or 'status' not in resp['results']):
             return None
-        return resp['results']['status']
+        status = resp['results']['status']
+        if ('UUID' in resp):
+            status['UUID'] = resp['UUID']
+        return status
 
     # Initiate a FW update */
     def update_fw(self, mac, fw_url, keep_redirector = True):
@@ -386,28 +885,58 @@ class API:
         uri = "/api/v1/command/%s?serialNumber=%s" % (cmd_uuid, mac)
         return self.api_call("owgw", "GET", uri)
 
-    def load_cache(self, name):
-        cfn = "cache/%s-%s.json" % (self.deployment, name)
-        if (not os.path.exists(cfn)):
+    # Run a script on many targets (see BulkCommand). Deferred scripts are
+    # polled until they complete
+    def bulk_run_script(self, targets, b64script, deferred = False, **kwargs):
+        start = lambda target: self.run_script(target['mac'], b64script, deferred)
+        bulk = BulkCommand(self, "script", start, poll=deferred, **kwargs)
+        bulk.run(targets)
+        return bulk
+
+    # Update FW on many targets (see BulkCommand), polling each upgrade
+    # command until it completes
+    def bulk_update_fw(self, targets, fw_url, keep_redirector = True, **kwargs):
+        start = lambda target: self.update_fw(target['mac'], fw_url, keep_redirector)
+        bulk = BulkCommand(self, "upgrade", start, poll=True, **kwargs)
+        bulk.run(targets)
+        return bulk
+
+    # Get a cached resource if it is within its TTL. If it is stale but within
+    # max_stale secs past that (CACHE_STALE by default) and a revalidate
+    # function is given, the stale data is returned right away while
+    # revalidate() reloads it in the background (stale-while-revalidate). The
+    # reload thread is not a daemon, so a short-lived script waits for it to
+    # save the reloaded entry before exiting
+    def load_cache(self, name, revalidate = None, max_stale = None):
+        key = "%s-%s" % (self.deployment, name)
+        cache_data, age = self.cache.get(key)
+        if (not cache_data):
             return None
 
-        mts = os.path.getmtime(cfn)
-        last_modified = datetime.fromtimestamp(mts)
-        if ((datetime.now() - last_modified) > timedelta(seconds=CACHE_TIME)):
+        ttl = CACHE_TTL.get(name, CACHE_TIME)
+        if (age <= ttl):
+            return cache_data
+        if (max_stale == None):
+            max_stale = CACHE_STALE.get(name, 0)
+        if (revalidate == None or age > (ttl + max_stale)):
             return None
 
-        f = open(cfn)
-        cache_data = json.load(f)
-        f.close()
+        if (self.cache.lock_reload(key)):
+            def reload():
+                try:
+                    data = revalidate()
+                    if (data):
+                        self.save_cache(name, data)
+                finally:
+                    self.cache.unlock_reload(key)
+            threading.Thread(target=reload).start()
         return cache_data
 
     def save_cache(self, name, data):
-        cfn = "cache/%s-%s.json" % (self.deployment, name)
-        if (not os.path.isdir("cache")):
-            os.mkdir("cache")
-        with open(cfn, "w") as outfile:
-            json.dump(data, outfile)
+        self.cache.put("%s-%s" % (self.deployment, name), data)
 
+    # Select target devices by org/venue. devices can be a list or a stream
+    # such as iter_devices(), so matching starts on the first page
     def matching_targets(self, devices, pdata, org = None, venue = None, connected_only = True):
         targets = []
         for x in devices:
@@ -457,9 +986,18 @@ class API:
 
 #==================================================================================================================
 
+# Index a list of records by the given key. The first record for each key
+# wins, matching what a linear scan of the list would return
+def index_by(records, key):
+    index = {}
+    for rec in records or []:
+        if (key in rec):
+            index.setdefault(rec[key], rec)
+    return index
+
 class ProvData:
     # Init CloudSDK Provisioning Data class
-    def __init__(self, cloudsdk_api, verbose = True, limit = None, no_cache = None):
+    def __init__(self, cloudsdk_api, verbose = True, limit = None, no_cache = None, max_stale = None):
         if (cloudsdk_api == None):
             raise Exception("[cloudsdk] error: ProvData requires cloudsdk.API handle passed in")
         if (verbose):
@@ -467,7 +1005,8 @@ class ProvData:
 
         # Check if we can use cache
         if (not no_cache):
-            prov_data = cloudsdk_api.load_cache("ProvData")
+            reload = lambda: ProvData.fetch(cloudsdk_api, verbose=False, limit=limit)
+            prov_data = cloudsdk_api.load_cache("ProvData", revalidate=reload, max_stale=max_stale)
             if (prov_data):
                 self.inventory = prov_data['inventory']
                 self.venues    = prov_data['venues']
@@ -477,59 +1016,92 @@ class ProvData:
                                                           (len(self.inventory), len(self.venues), len(self.entities)))
                 return
 
-        # Load fresh info
-        self.inventory = cloudsdk_api.load_all_inventory(verbose=verbose, limit=limit)
-        self.venues    = cloudsdk_api.load_all_venues(verbose=verbose, limit=limit)
-        self.entities  = cloudsdk_api.load_all_entities(verbose=verbose, limit=limit)
+        self.refresh(cloudsdk_api, verbose=verbose, limit=limit)
+        return
+
+    # Load inventory, venues and entities from the API. The three collections
+    # are independent, so fetch them in parallel
+    @staticmethod
+    def fetch(cloudsdk_api, verbose = True, limit = None):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            inventory = executor.submit(cloudsdk_api.load_all_inventory, verbose=verbose, limit=limit)
+            venues    = executor.submit(cloudsdk_api.load_all_venues, verbose=verbose, limit=limit)
+            entities  = executor.submit(cloudsdk_api.load_all_entities, verbose=verbose, limit=limit)
+        return { 'inventory': inventory.result(), 'venues': venues.result(), 'entities': entities.result() }
+
+    # Reload from the API and update the cache
+    def refresh(self, cloudsdk_api, verbose = True, limit = None):
+        prov_data = ProvData.fetch(cloudsdk_api, verbose=verbose, limit=limit)
+        self.inventory = prov_data['inventory']
+        self.venues    = prov_data['venues']
+        self.entities  = prov_data['entities']
 
         # Store in cache
-        prov_data = { 'inventory': self.inventory, 'venues': self.venues, 'entities': self.entities }
         cloudsdk_api.save_cache("ProvData", prov_data)
-        return
+
+    # Assigning a collection (on load or refresh) rebuilds its lookup indexes
+    @property
+    def inventory(self):
+        return self._inventory
+
+    @inventory.setter
+    def inventory(self, inventory):
+        self._inventory = inventory
+        self.inventory_by_mac  = index_by(inventory, 'serialNumber')
+        self.inventory_by_uuid = index_by(inventory, 'id')
+
+    @property
+    def venues(self):
+        return self._venues
+
+    @venues.setter
+    def venues(self, venues):
+        self._venues = venues
+        self.venue_by_uuid = index_by(venues, 'id')
+        # Venue names are only unique within an entity: keep all venues per
+        # name, in list order, to pick from by entity
+        self.venues_by_name = {}
+        for venue in venues or []:
+            if ('name' in venue):
+                self.venues_by_name.setdefault(venue['name'], []).append(venue)
+
+    @property
+    def entities(self):
+        return self._entities
+
+    @entities.setter
+    def entities(self, entities):
+        self._entities = entities
+        self.entity_by_uuid = index_by(entities, 'id')
+        self.entity_by_name = index_by(entities, 'name')
 
     # Get inventory entry by device MAC (serial number)
     def get_inventory_by_mac(self, mac):
-        for inv in self.inventory:
-            if ('serialNumber' in inv and inv['serialNumber'] == mac):
-                return inv
-        return None
+        return self.inventory_by_mac.get(mac)
 
     # Get inventory entry by uuid
     def get_inventory_by_uuid(self, uuid):
-        for inv in self.inventory:
-            if ('id' in inv and inv['id'] == uuid):
-                return inv
-        return None
+        return self.inventory_by_uuid.get(uuid)
 
     # Get venue by name (and optionally entity)
     def get_venue_by_name(self, name, entity_uuid = None):
-        for venue in self.venues:
-            if ('name' in venue and venue['name'] == name):
-                if (entity_uuid and 'entity' in venue and venue['entity'] != entity_uuid):
-                    continue
-                return venue
+        for venue in self.venues_by_name.get(name, []):
+            if (entity_uuid and 'entity' in venue and venue['entity'] != entity_uuid):
+                continue
+            return venue
         return None
 
     # Get venue by uuid
     def get_venue_by_uuid(self, uuid):
-        for venue in self.venues:
-            if ('id' in venue and venue['id'] == uuid):
-                return venue
-        return None
+        return self.venue_by_uuid.get(uuid)
 
     # Get entity by name
     def get_entity_by_name(self, name, entity_uuid = None):
-        for entity in self.entities:
-            if ('name' in entity and entity['name'] == name):
-                return entity
-        return None
+        return self.entity_by_name.get(name)
 
     # Get entity by uuid
     def get_entity_by_uuid(self, uuid):
-        for entity in self.entities:
-            if ('id' in entity and entity['id'] == uuid):
-                return entity
-        return None
+        return self.entity_by_uuid.get(uuid)
 
     # Get device info (name, entity, venue)
     def get_device_info(self, mac, mark_unknown = False):
@@ -549,3 +1121,190 @@ class ProvData:
 
         return { 'mac': mac, 'name': inv['name'], 'entity': entity['name'], 'venue': venue['name'] }
 
+#==================================================================================================================
+
+class BulkCommand:
+    # Init a bulk command. start(target) issues the command for one target (a
+    # matching_targets() entry) and returns its status the way run_script()
+    # and update_fw() do. If poll is set, commands that return a UUID are
+    # polled with cmd_status() until they complete
+    def __init__(self, cloudsdk_api, label, start, poll = True, window = BULK_WINDOW, waves = None,
+                 max_fail = BULK_MAX_FAIL, poll_conf = None, verbose = True):
+        if (waves == None):
+            waves = BULK_WAVES
+        self.capi      = cloudsdk_api
+        self.label     = label
+        self.start     = start
+        self.poll      = poll
+        self.window    = window
+        self.waves     = waves
+        self.max_fail  = max_fail
+        self.poll_conf = dict(BULK_POLL)
+        self.poll_conf.update(poll_conf or {})
+        self.verbose   = verbose
+        self.lock      = threading.Lock()
+        self.results   = []
+        self.aborted   = False
+        self.poll_calls = 0
+        self.start_tm  = None
+        self.end_tm    = None
+
+    # Run the command on all targets, wave by wave. Returns the result table:
+    # one row per target, in target order
+    def run(self, targets):
+        self.results = []
+        for target in targets:
+            row = dict(target)
+            row.update({ 'wave': 0, 'state': "queued", 'uuid': "", 'text': "", 'started': 0,
+                         'finished': 0, 'secs': 0, 'polls': 0 })
+            self.results.append(row)
+
+        self.start_tm = time.time()
+        pos = 0
+        wave = 0
+        executor = ThreadPoolExecutor(max_workers=self.window)
+        try:
+            while (pos < len(self.results)):
+                if (wave < len(self.waves)):
+                    rows = self.results[pos:pos + self.waves[wave]]
+                else:
+                    rows = self.results[pos:]
+                pos += len(rows)
+                wave += 1
+                for row in rows:
+                    row['wave'] = wave
+                if (self.aborted):
+                    for row in rows:
+                        row['state'] = "skipped"
+                    continue
+
+                if (self.verbose):
+                    print("[cloudsdk] -> %s wave %d: %d targets, %d at a time" % (self.label, wave, len(rows), self.window))
+                self.run_wave(executor, rows)
+
+                failed = len([ row for row in rows if row['state'] != "completed" ])
+                if (failed > len(rows) * self.max_fail):
+                    self.aborted = True
+                    if (self.verbose and pos < len(self.results)):
+                        print("[cloudsdk] -> %s wave %d: %d of %d failed, skipping the remaining %d targets"
+                                                    % (self.label, wave, failed, len(rows), len(self.results) - pos))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.end_tm = time.time()
+        return self.results
+
+    # Run one wave: keep up to window commands in flight, starting more as
+    # others complete. All in-flight commands are polled in one round, and
+    # the wait between rounds backs off while none of them complete
+    def run_wave(self, executor, rows):
+        queue = deque(rows)
+        inflight = []
+        interval = self.poll_conf['interval']
+        while (len(queue) > 0 or len(inflight) > 0):
+            batch = [ queue.popleft() for i in range(min(self.window - len(inflight), len(queue))) ]
+            for row in executor.map(self.start_one, batch):
+                if (row['state'] == "pending"):
+                    inflight.append(row)
+            if (len(inflight) == 0):
+                continue
+
+            time.sleep(interval)
+            polled = list(executor.map(self.poll_one, inflight))
+            self.poll_calls += len(polled)
+            inflight = [ row for row in polled if row['state'] == "pending" ]
+            if (len(inflight) < len(polled)):
+                interval = self.poll_conf['interval']
+            else:
+                interval = min(interval * self.poll_conf['factor'], self.poll_conf['max_interval'])
+
+    # Start the command on one target
+    def start_one(self, row):
+        row['started'] = time.time()
+        try:
+            status = self.start(row)
+        except Exception as e:
+            return self.finish(row, "failed", str(e))
+        if (status == None):
+            return self.finish(row, "failed", "no status returned")
+        text = status.get('text', status.get('resultText', ""))
+        if (status.get('resultCode', 0) != 0 or status.get('error', 0) != 0):
+            return self.finish(row, "failed", text)
+        row['uuid'] = status.get('UUID', "")
+        if (self.poll and row['uuid']):
+            row['state'] = "pending"
+            row['text'] = text
+            return row
+        return self.finish(row, "completed", text)
+
+    # Poll the status of one in-flight command
+    def poll_one(self, row):
+        row['polls'] += 1
+        try:
+            cmd = self.capi.cmd_status(row['mac'], row['uuid'])
+        except Exception:
+            cmd = None
+        if (cmd != None and 'ErrorCode' in cmd):
+            return self.finish(row, "failed", cmd.get('ErrorDescription', ""))
+        if (cmd != None and (cmd.get('completed', 0) > 0 or cmd.get('status') in CMD_FAILED)):
+            text = cmd.get('errorText', "") or cmd.get('status', "")
+            if (cmd.get('errorCode', 0) != 0 or cmd.get('status') in CMD_FAILED):
+                return self.finish(row, "failed", text)
+            return self.finish(row, "completed", text)
+        if (time.time() - row['started'] > self.poll_conf['timeout']):
+            return self.finish(row, "timeout", "no result after %d s" % self.poll_conf['timeout'])
+        return row
+
+    # Record the outcome of one target
+    def finish(self, row, state, text):
+        row['state'] = state
+        row['text'] = text
+        row['finished'] = time.time()
+        row['secs'] = round(row['finished'] - row['started'], 3)
+        if (self.verbose):
+            with self.lock:
+                print("[cloudsdk]    -> %s %-12s %-9s (took %5.1f s) %s" % (self.label, row['mac'], state, row['secs'], text))
+        return row
+
+    # Get counts per state, throughput and completion time percentiles
+    def get_stats(self):
+        stats = { 'targets': len(self.results), 'completed': 0, 'failed': 0, 'timeout': 0, 'skipped': 0 }
+        for row in self.results:
+            if (row['state'] in stats):
+                stats[row['state']] += 1
+        secs = sorted([ row['secs'] for row in self.results if row['finished'] > 0 ])
+        if (self.start_tm != None and self.end_tm != None):
+            wall = self.end_tm - self.start_tm
+        else:
+            wall = 0
+        stats['aborted'] = self.aborted
+        stats['poll_calls'] = self.poll_calls
+        stats['wall_secs'] = round(wall, 3)
+        if (wall > 0):
+            stats['per_sec'] = round(len(secs) / wall, 2)
+        else:
+            stats['per_sec'] = 0
+        for name, q in [ ('p50_secs', 0.5), ('p90_secs', 0.9), ('max_secs', 1) ]:
+            if (len(secs) > 0):
+                stats[name] = secs[int(round(q * (len(secs) - 1)))]
+            else:
+                stats[name] = 0
+        return stats
+
+    # One line summary of the run
+    def summary(self):
+        stats = self.get_stats()
+        line = ("%s: %d targets, %d completed, %d failed, %d timed out, %d skipped in %.1f s (%.2f/sec, p50 %.1f s, p90 %.1f s, max %.1f s)"
+                    % (self.label, stats['targets'], stats['completed'], stats['failed'], stats['timeout'], stats['skipped'],
+                       stats['wall_secs'], stats['per_sec'], stats['p50_secs'], stats['p90_secs'], stats['max_secs']))
+        if (self.aborted):
+            line += ", aborted"
+        return line
+
+    # Write the result table as CSV
+    def write_csv(self, fn):
+        csv_fields = [ 'mac', 'name', 'model', 'org', 'venue', 'wave', 'state', 'uuid', 'text', 'started', 'finished', 'secs', 'polls' ]
+        with open(fn, "w") as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=csv_fields, extrasaction='ignore')
+            writer.writeheader()
+            for row in self.results:
+                writer.writerow(row)
@@ -0,0 +1,1528 @@
+#!/usr/bin/python3
+
+# Online device statistics collector. collect() loads the devices of a
+# deployment with the stats of each online one, and returns them processed
+# into per device, survey, neighbor and client records (see Collection).
+# All state lives in the returned Collection, so it can be called repeatedly
+# from a long-running app, reusing a warm cloudsdk.API client
+
+import os
+import io
+import json
+import csv
+import bisect
+import fcntl
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+import time
+from datetime import datetime
+from contextlib import nullcontext
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy
+import pandas
+
+from modules import cloudsdk
+from modules import tracing
+from modules import configlint
+from modules.projection import Projection
+
+# pyarrow is optional: without it no Parquet snapshot is written
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Device state sizes outside these bounds (bytes, as received) are reported.
+# They were [ 3000, 200000 ] when the size was that of the stats re-encoded
+# with indent=2, which is about 1.8x the compact body
+STATE_THRESHOLDS = [ 1650, 110000 ]
+RRM_STATES = [ "INVALID", "CAN_STEER", "STEERING", "BACKOFF", "DISABLED", "MAX_REACHED" ]
+MEM_THRESHOLD = 80
+STATS_WORKERS = 8
+
+# Processes turning device stats into records (see transformDevice()), one
+# core is left for fetching and writing. With none it is done in-thread. The
+# pool is forked, which is only safe while no other threads run, so it is
+# off unless asked for: get-online-devices.py uses this many when
+# collecting a single deployment
+TRANSFORM_PROCS = min(4, (os.cpu_count() or 1) - 1)
+
+# Devices whose stats fail to load are retried after the others, in rounds
+# RETRY_BACKOFF, 2x, 4x... seconds apart
+RETRY_ROUNDS = 3
+RETRY_BACKOFF = 5
+
+# Progress is checkpointed every CHECKPOINT_DEVICES devices or
+# CHECKPOINT_SECS seconds, whichever comes first (see Collection.checkpoint())
+CHECKPOINT_DEVICES = 500
+CHECKPOINT_SECS = 60
+
+# Steering counter and RRM capability fields of the client tables
+RRM_FIELDS = [ "rrm_%s_%s_%s" % (st, kt, sn) for st in ['upsteer', 'sticky', 'downsteer']
+                                             for kt in ['btm', 'legacy']
+                                             for sn in ['total', 'success', 'fail'] ] + \
+             [ "rrm_cap_%s" % x for x in ['wnm', 'active', 'passive', 'table', 'link', 'stats'] ]
+
+# Output tables and their CSV fields, in output order
+TABLES = {
+    'online-devices': ['mac', 'name', 'org', 'venue', 'model', 'firmware', 'uptime', 'up_days',
+                       'cpu_busy_pct', 'cpu_load_1m', 'cpu_load_5m', 'cpu_load_15m',
+                       'mem_used_pct', 'mem_free_pct', 'num_ifaces', 'num_ssids', 'num_assocs',
+                       'chan_2g', 'width_2g', 'chan_5g', 'width_5g', 'chan_6g', 'width_6g',
+                       'conf_2g', 'conf_5g', 'conf_6g', 'conf_2g_bw', 'conf_5g_bw', 'conf_6g_bw',
+                       'last_state', 'wan_carrier', 'wan_speed', 'wan_duplex'],
+    'survey-data': ['mac', 'name', 'org', 'venue', 'model', 'firmware', 'band', 'on-chan',
+                    'channel', 'noise_floor', 'active_ms', 'busy_ms', 'busy_self_ms',
+                    'busy_tx_ms', 'last_on_chan_secs_go', 'rrm_airtime_pct',
+                    'agg_15m_active_ms', 'agg_15m_busy_ms', 'agg_15m_busy_self_ms',
+                    'agg_15m_busy_tx_ms', 'agg_15m_num_samples'],
+    'neighbors-data': ['mac', 'name', 'org', 'venue', 'model', 'firmware', 'band', 'ssid',
+                       'bssid', 'in_network', 'channel', 'rssi', 'last_seen_secs_ago'],
+    'clients-by-ap': ['mac', 'org', 'venue', 'ap_mac', 'ap_name', 'ap_model', 'ap_fw', 'connected', 'band', 'ssid',
+                      'connected_time', 'rssi', 'avg_ack_rssi', 'rx_rate', 'tx_rate', 'rx_packets', 'rx_bytes',
+                      'tx_packets', 'tx_bytes', 'vlan_id', 'rrm_state', 'rrm_bands', 'rrm_active', 'rrm_pps'] + RRM_FIELDS,
+    'clients': ['mac', 'org', 'venue', 'ap_cnt', 'dups', 'connected', 'band', 'ssid', 'connected_time',
+                'rssi', 'avg_ack_rssi', 'rx_rate', 'tx_rate', 'rx_packets', 'rx_bytes', 'tx_packets',
+                'tx_bytes', 'vlan_id', 'rrm_state', 'rrm_bands', 'rrm_active', 'rrm_pps'] + RRM_FIELDS
+}
+
+# Fields of the AP client entries (see newAPClient()), the rest of the
+# clients-by-ap fields are the client and AP ones
+AP_CLIENT_FIELDS = TABLES['clients-by-ap'][TABLES['clients-by-ap'].index('connected'):]
+RRM_COUNTERS = [ x for x in RRM_FIELDS if not x.startswith("rrm_cap_") ]
+
+# Fields of the device stats read by transformDevice(), the rest of the
+# document is skipped rather than decoded
+STATS_PROJECTION = Projection({
+    'unit': { k: None for k in ['localtime', 'uptime', 'cpu_load', 'load', 'memory'] },
+    'interfaces': {
+        'vlan_id': None,
+        'ssids': {
+            'band': None,
+            'ssid': None,
+            'associations': { k: None for k in ['station', 'connected', 'rssi', 'ack_signal_avg', 'rx_packets', 'rx_bytes',
+                                                'tx_packets', 'tx_bytes', 'rx_rate', 'tx_rate', 'dynamic_vlan'] }
+        }
+    },
+    'radios': {
+        'band': None,
+        'channel': None,
+        'channel_width': None,
+        'survey': { k: None for k in ['on-chan', 'channel', 'noise_floor', 'active_ms', 'busy_ms', 'busy_self_ms', 'busy_tx_ms',
+                                      'last_on_chan_secs_go', 'rrm_airtime_pct', 'agg_15m'] },
+        'neighbors': { '*': { k: None for k in ['bssid', 'in_network', 'channel', 'rssi', 'last_seen_secs_ago'] } }
+    },
+    'rrm-info': { k: None for k in ['mac', 'state', 'supported_bands', 'active', 'pps_rx', 'stats', 'wnm', 'rrm'] },
+    'link-state': { 'upstream': { 'WAN': { k: None for k in ['carrier', 'speed', 'duplex'] } } }
+})
+
+# Get Latest Single Device Stats (runs on a stats worker thread), as a
+# span of the profiler if one is given. With raw set the stats are the
+# response body, left for the caller to decode
+def fetchStats(capi, mac, profiler = None, raw = False):
+    start_tm = datetime.now()
+    span_tm = (time.perf_counter(), time.thread_time())
+    stats = None
+    error = None
+    retries = 3
+    try_no = 1
+    while(try_no <= retries):
+        try:
+            stats = capi.get_device_stats(mac, raw=raw)
+        except Exception as e:
+            error = str(e)
+        else:
+            break
+        try_no = try_no + 1
+    end_tm = datetime.now()
+    fetch_tm = (end_tm - start_tm).total_seconds()
+    if (profiler):
+        profiler.add(mac, tracing.FETCH, span_tm[0], time.perf_counter(), time.thread_time() - span_tm[1], mac=mac, tries=try_no)
+    return { 'stats': stats, 'tries': try_no, 'fetch_tm': fetch_tm, 'error': error }
+
+# Fetch stats for the given device records on a pool of worker threads,
+# yielding (record, stats) in the same order as the records. At most 2x
+# workers fetches are outstanding at a time, so results are streamed rather
+# than accumulated
+def iterStats(capi, nds, workers, profiler = None, raw = False):
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stats")
+    pending = deque()
+    try:
+        for nd in nds:
+            pending.append((nd, executor.submit(fetchStats, capi, nd['mac'], profiler, raw)))
+            if (len(pending) >= workers * 2):
+                nd, future = pending.popleft()
+                yield nd, future.result()
+        while (len(pending) > 0):
+            nd, future = pending.popleft()
+            yield nd, future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def newAPClient(nd, intf = None, ssid = None, assoc = None):
+    if (intf and ssid and assoc):
+        apc = {
+                'connected': True,
+                'band': ssid['band'],
+                'ssid': ssid['ssid'],
+                'connected_time': assoc['connected'],
+                'rssi': assoc['rssi'],
+                'avg_ack_rssi': assoc['ack_signal_avg'],
+                'rx_packets': assoc['rx_packets'],
+                'rx_bytes': assoc['rx_bytes'],
+                'tx_packets': assoc['tx_packets'],
+                'tx_bytes': assoc['tx_bytes']
+        }
+        if 'rx_rate' in assoc and 'bitrate' in assoc['rx_rate']:
+            apc['rx_rate'] = assoc['rx_rate']['bitrate'] / 1000
+        else:
+            apc['rx_rate'] = 0
+        if 'tx_rate' in assoc and 'bitrate' in assoc['tx_rate']:
+            apc['tx_rate'] = assoc['tx_rate']['bitrate'] / 1000
+        else:
+            apc['tx_rate'] = 0
+        if 'dynamic_vlan' in assoc:
+            apc['vlan_id'] = "D-%d" % assoc['dynamic_vlan']
+        elif 'vlan_id' in intf:
+            apc['vlan_id'] = "S-%d" % intf['vlan_id']
+        else:
+            apc['vlan_id'] = ""
+    else:
+        apc = {
+                'connected': False,
+                'band': "",
+                'ssid': "",
+                'connected_time': 0,
+                'rssi': 0,
+                'avg_ack_rssi': 0,
+                'rx_packets': 0,
+                'rx_bytes': 0,
+                'tx_packets': 0,
+                'tx_bytes': 0,
+                'rx_rate': 0,
+                'tx_rate': 0,
+                'vlan_id': ""
+        }
+
+    # Store a pointer to the device
+    apc['_device'] = nd
+
+    apc['rrm_state'] = "N/A"
+    apc['rrm_bands'] = 0
+    apc['rrm_active'] = False
+    apc['rrm_pps'] = 0
+    for st in ['upsteer', 'sticky', 'downsteer']:
+        for kt in ['btm', 'legacy']:
+            for sn in ['total', 'success', 'fail']:
+                en = "rrm_%s_%s_%s" % (st, kt, sn)
+                apc[en] = 0
+    apc['rrm_cap_wnm'] = False
+    apc['rrm_cap_active'] = False
+    apc['rrm_cap_passive'] = False
+    apc['rrm_cap_table'] = False
+    apc['rrm_cap_link'] = False
+    apc['rrm_cap_stats'] = False
+
+    return apc
+
+def surveyRecords(nd, band, survey):
+    records = []
+    for s in survey:
+        ns = { }
+
+        # Workaround APs giving out old/wrong format
+        if 'agg_15m' not in s:
+            continue
+
+        # copy data from nd
+        for x in ['mac', 'name', 'venue', 'org', 'model', 'firmware']:
+            ns[x] = nd[x]
+
+        ns['band'] = band
+
+        # copy data from survey
+        if 'on-chan' in s:
+            ns['on-chan'] = s['on-chan']
+        else:
+            ns['on-chan'] = 'unknown'
+        for x in ['channel', 'noise_floor', 'active_ms', 'busy_ms', 'busy_self_ms', 'busy_tx_ms', 'last_on_chan_secs_go', 'rrm_airtime_pct']:
+            if x in s:
+                ns[x] = s[x]
+            else:
+                ns[x] = -1
+
+        # copy 15m agg data
+        for x in ['active_ms', 'busy_ms', 'busy_self_ms', 'busy_tx_ms', 'num_samples']:
+            if x in s['agg_15m']:
+                k = 'agg_15m_' + x
+                ns[k] = s['agg_15m'][x]
+            else:
+                ns[k] = -1
+
+        records.append(ns)
+    return records
+
+def neighborRecords(nd, band, neighbors):
+    records = []
+    for ssid in neighbors.keys():
+        nl = neighbors[ssid]
+        for n in nl:
+            nn = { }
+
+            # copy data from nd
+            for x in ['mac', 'name', 'venue', 'org', 'model', 'firmware']:
+                nn[x] = nd[x]
+
+            nn['band'] = band
+            nn['ssid'] = ssid
+
+            # copy data from neighbor
+            if 'bssid' in n:
+                nn['bssid'] = n['bssid']
+            else:
+                nn['bssid'] = 'unknown'
+            if 'in_network' in n:
+                nn['in_network'] = n['in_network']
+            else:
+                nn['in_network'] = False
+            for x in ['channel', 'rssi', 'last_seen_secs_ago']:
+                if x in n:
+                    nn[x] = n[x]
+                else:
+                    nn[x] = -1
+
+            records.append(nn)
+    return records
+
+# The RRM fields of each client in an AP's rrm-info, as (client mac, fields)
+def rrmUpdates(rrminfo):
+    updates = []
+    for ric in rrminfo:
+        if ric['state'] is None:
+            continue
+        rrm = { }
+        if ric['state'] >= 1 and ric['state'] < len(RRM_STATES):
+            rrm['rrm_state'] = RRM_STATES[ric['state']]
+        else:
+            rrm['rrm_state'] = str(ric['state'])
+        rrm['rrm_bands'] = ric['supported_bands']
+        rrm['rrm_active'] = ric['active']
+        rrm['rrm_pps'] = ric['pps_rx']
+        for st in ['upsteer', 'sticky', 'downsteer']:
+            for kt in ['btm', 'legacy']:
+                for sn in ['total', 'success', 'fail']:
+                    en = "rrm_%s_%s_%s" % (st, kt, sn)
+                    rrm[en] = ric['stats'][st][kt][sn]
+        rrm['rrm_cap_wnm'] = ric['wnm']
+        rrm['rrm_cap_active'] = ric['rrm']['beacon_active_measure']
+        rrm['rrm_cap_passive'] = ric['rrm']['beacon_passive_measure']
+        rrm['rrm_cap_table'] = ric['rrm']['beacon_table_measure']
+        rrm['rrm_cap_link'] = ric['rrm']['link_measure']
+        rrm['rrm_cap_stats'] = ric['rrm']['statistics_measure']
+        updates.append((ric['mac'], rrm))
+    return updates
+
+# Turn the stats of an online device (the response body as fetched, of which
+# only STATS_PROJECTION is decoded) into its records. This only depends on
+# its arguments, so it can run on a transform process: the result is merged
+# into the run by Collection.mergeDevice()
+def transformDevice(nd, data, now):
+    start_tm = time.perf_counter()
+    cpu_tm = time.thread_time()
+    stats = STATS_PROJECTION.loads(data)
+    if (not isinstance(stats, dict)):
+        raise Exception("not a JSON object")
+
+    # Size of the state as received
+    size = len(data)
+
+    if 'unit' in stats:
+        ap_time = datetime.fromtimestamp(stats['unit']['localtime'])
+        nd['last_state'] = (now - ap_time).total_seconds()
+        nd['uptime'] = stats['unit']['uptime']
+        nd['up_days'] = round(nd['uptime'] / 86400, 2)
+        if 'cpu_load' in stats['unit']:
+            nd['cpu_busy_pct'] = stats['unit']['cpu_load'][0]
+        else:
+            nd['cpu_busy_pct'] = -1
+        nd['cpu_load_1m'] = stats['unit']['load'][0]
+        nd['cpu_load_5m'] = stats['unit']['load'][1]
+        nd['cpu_load_15m'] = stats['unit']['load'][2]
+
+        mem_free = stats['unit']['memory']['free']
+        mem_total = stats['unit']['memory']['total']
+        mem_used = mem_total - mem_free
+        nd['mem_used_pct'] = round((mem_used * 100 / mem_total), 2)
+        nd['mem_free_pct'] = round((mem_free * 100 / mem_total), 2)
+    else:
+        nd['last_state'] = -1
+        nd['uptime'] = -1
+        nd['up_days'] = -1
+        nd['cpu_busy_pct'] = -1
+        nd['cpu_load_1m'] = -1
+        nd['cpu_load_5m'] = -1
+        nd['cpu_load_15m'] = -1
+        nd['mem_used_pct'] = -1
+        nd['mem_free_pct'] = -1
+
+    # Clients only keep the AP fields they are output with, so the
+    # device records can be released once written
+    ap = { k: nd[k] for k in ['mac', 'name', 'org', 'venue', 'model', 'firmware'] }
+    assocs = []
+    survey = []
+    neighbors = []
+    rrm = []
+
+    nd['num_ssids'] = 0
+    if 'interfaces' in stats:
+        nd['num_ifaces'] = len(stats['interfaces'])
+        for x in stats['interfaces']:
+            if 'ssids' in x:
+                nd['num_ssids'] = nd['num_ssids'] + len(x['ssids'])
+                for ssid in x['ssids']:
+                    if 'associations' in ssid:
+                        for assoc in ssid['associations']:
+                            assocs.append((assoc['station'], newAPClient(ap, x, ssid, assoc)))
+    else:
+        nd['num_ifaces'] = 0
+
+    for x in ['2g', '5g', '6g']:
+        nd["chan_" + x] = 0
+        nd["width_" + x] = 0
+
+    if 'radios' in stats:
+        for r in stats['radios']:
+            if r['band'][0] == "2G":
+                x = '2g'
+            elif r['band'][0] == "5G":
+                x = '5g'
+            elif r['band'][0] == "6G":
+                x = '6g'
+            else:
+                continue
+            nd["chan_" + x] = r['channel']
+            nd["width_" + x] = r['channel_width']
+
+            if 'survey' in r:
+                survey += surveyRecords(nd, x, r['survey'])
+            if 'neighbors' in r:
+                neighbors += neighborRecords(nd, x, r['neighbors'])
+
+    if 'rrm-info' in stats:
+        rrm = rrmUpdates(stats['rrm-info'])
+
+    nd['wan_carrier'] = -1
+    nd['wan_speed'] = -1
+    nd['wan_duplex'] = -1
+    if 'link-state' in stats:
+        if 'upstream' in stats['link-state']:
+            if 'WAN' in stats['link-state']['upstream']:
+                nd['wan_carrier'] = stats['link-state']['upstream']['WAN']['carrier']
+                nd['wan_speed'] = stats['link-state']['upstream']['WAN']['speed']
+                nd['wan_duplex'] = stats['link-state']['upstream']['WAN']['duplex']
+
+    return { 'nd': nd, 'ap': ap, 'size': size, 'assocs': assocs, 'survey': survey, 'neighbors': neighbors,
+             'rrm': rrm, 'transform_tm': (start_tm, time.perf_counter(), time.thread_time() - cpu_tm, os.getpid()) }
+
+# Line of the checkpoint journal for a device state (see
+# Collection.mergeDevice()). The clients' pointers to their AP are left out,
+# the AP is in the state
+def journalLine(state):
+    assocs = [ (cmac, { k: v for k, v in apc.items() if k != '_device' }) for cmac, apc in state['assocs'] ]
+    return json.dumps(dict(state, assocs=assocs)) + "\n"
+
+# Column types of the Parquet snapshot by field, string if not listed. Values
+# that do not convert to the column type are stored as null
+COLUMN_TYPES = {
+    'uptime': "int64", 'up_days': "float64", 'cpu_busy_pct': "float64", 'cpu_load_1m': "float64",
+    'cpu_load_5m': "float64", 'cpu_load_15m': "float64", 'mem_used_pct': "float64", 'mem_free_pct': "float64",
+    'num_ifaces': "int64", 'num_ssids': "int64", 'num_assocs': "int64",
+    'chan_2g': "int64", 'width_2g': "int64", 'chan_5g': "int64", 'width_5g': "int64", 'chan_6g': "int64", 'width_6g': "int64",
+    'last_state': "float64", 'wan_carrier': "int64", 'wan_speed': "int64",
+    'channel': "int64", 'noise_floor': "int64", 'active_ms': "int64", 'busy_ms': "int64", 'busy_self_ms': "int64",
+    'busy_tx_ms': "int64", 'last_on_chan_secs_go': "int64", 'rrm_airtime_pct': "float64",
+    'agg_15m_active_ms': "int64", 'agg_15m_busy_ms': "int64", 'agg_15m_busy_self_ms': "int64",
+    'agg_15m_busy_tx_ms': "int64", 'agg_15m_num_samples': "int64",
+    'in_network': "bool", 'rssi': "int64", 'last_seen_secs_ago': "int64",
+    'ap_cnt': "int64", 'dups': "int64", 'connected': "bool", 'connected_time': "int64", 'avg_ack_rssi': "int64",
+    'rx_rate': "float64", 'tx_rate': "float64", 'rx_packets': "int64", 'rx_bytes': "int64",
+    'tx_packets': "int64", 'tx_bytes': "int64", 'rrm_bands': "int64", 'rrm_active': "bool", 'rrm_pps': "int64"
+}
+for en in RRM_FIELDS:
+    if (en.startswith("rrm_cap_")):
+        COLUMN_TYPES[en] = "bool"
+    else:
+        COLUMN_TYPES[en] = "int64"
+COLUMN_CONVERT = { 'int64': int, 'float64': float, 'bool': bool, 'string': str }
+
+# Columns archived snapshot rows are tagged with (see modules/retention.py)
+ARCHIVE_COLUMNS = [ 'snapshot', 'snapshot_time' ]
+
+# Records per Parquet row group
+PARQUET_BATCH = 4096
+
+# Arrow schema of a table's Parquet snapshot
+def tableSchema(name):
+    return pyarrow.schema([ (f, pyarrow.type_for_alias(COLUMN_TYPES.get(f, "string"))) for f in TABLES[name] ])
+
+# Convert a record value to its column type
+def columnValue(value, ctype):
+    if (value == None):
+        return None
+    if (ctype == "bool" and isinstance(value, str)):
+        # As read back from CSV
+        return (value == "True")
+    try:
+        return COLUMN_CONVERT[ctype](value)
+    except (TypeError, ValueError):
+        return None
+
+# Convert a column of record values to its column type, as an Arrow array at
+# once if they all are of that type already (or None)
+COLUMN_KINDS = { 'int64': ["integer"], 'float64': ["floating", "integer", "mixed-integer-float"],
+                 'bool': ["boolean"], 'string': ["string"] }
+def columnArray(values, ctype):
+    if (pandas.api.types.infer_dtype(values, skipna=True) in COLUMN_KINDS[ctype]):
+        return pyarrow.array(values, type=pyarrow.type_for_alias(ctype), from_pandas=True)
+    return [ columnValue(x, ctype) for x in values ]
+
+# The records of a frame of object columns, with their values as they are
+def frameRecords(df):
+    fields = list(df.columns)
+    return [ dict(zip(fields, row)) for row in df.to_numpy(dtype="object").tolist() ]
+
+# Read a table of a snapshot (the file prefix, as in Collection.prefix) from
+# its Parquet file, optionally only the given columns. The file is memory
+# mapped, so only the columns read are loaded. Returns a pyarrow Table
+def read_snapshot(prefix, name, columns = None):
+    if (pyarrow == None):
+        raise Exception("[collector] Error: reading Parquet snapshots requires pyarrow")
+    return pyarrow.parquet.read_table("%s-%s.parquet" % (prefix, name), columns=columns, memory_map=True)
+
+# Convert a newline delimited JSON file to a JSON array file, one record at
+# a time. The output is the same as json.dump(records, indent=2)
+def ndjsonToJSON(src, dst):
+    with open(src) as infile, open(dst, "w") as outfile:
+        sep = "[\n"
+        for line in infile:
+            rec = json.dumps(json.loads(line), indent=2)
+            outfile.write(sep + "  " + rec.replace("\n", "\n  "))
+            sep = ",\n"
+        if (sep == "[\n"):
+            outfile.write("[]")
+        else:
+            outfile.write("\n]")
+
+#==================================================================================================================
+
+class Sink:
+    # Open the outputs of each table under prefix: newline delimited JSON and
+    # CSV, both written a row at a time as records are produced, plus a
+    # Parquet snapshot written a row group at a time if parquet is set (and
+    # pyarrow is available). To carry on with outputs left by an interrupted
+    # run, pass their position() from its checkpoint as resume: anything
+    # written after it is dropped
+    def __init__(self, prefix, tables = TABLES, parquet = True, resume = None):
+        self.prefix  = prefix
+        self.tables  = tables
+        self.parquet = (parquet and pyarrow != None)
+        self.counts  = {}
+        self.outputs = {}
+        self.batches = {}
+        self.parquet_writers = {}
+        for name, fields in tables.items():
+            if (resume):
+                os.truncate("%s-%s.ndjson" % (prefix, name), resume[name]['ndjson'])
+                os.truncate("%s-%s.csv" % (prefix, name), resume[name]['csv'])
+                ndjson = open("%s-%s.ndjson" % (prefix, name), "a")
+                csvfile = open("%s-%s.csv" % (prefix, name), "a")
+                writer = csv.DictWriter(csvfile, fieldnames=fields)
+            else:
+                ndjson = open("%s-%s.ndjson" % (prefix, name), "w")
+                csvfile = open("%s-%s.csv" % (prefix, name), "w")
+                writer = csv.DictWriter(csvfile, fieldnames=fields)
+                writer.writeheader()
+            self.outputs[name] = (ndjson, csvfile, writer)
+            self.counts[name] = 0
+            if (self.parquet):
+                self.parquet_writers[name] = pyarrow.parquet.ParquetWriter("%s-%s.parquet" % (prefix, name), tableSchema(name))
+                self.batches[name] = []
+
+            # The Parquet file of an interrupted run has no footer, so it is
+            # rewritten from the NDJSON records kept
+            if (resume):
+                self.counts[name] = resume[name]['count']
+                if (self.parquet):
+                    with open("%s-%s.ndjson" % (prefix, name)) as f:
+                        for line in f:
+                            self.batches[name].append(json.loads(line))
+                            if (len(self.batches[name]) >= PARQUET_BATCH):
+                                self.flush(name)
+
+    # Flush the NDJSON and CSV outputs, returning their sizes and record
+    # counts per table (to resume from, see __init__())
+    def position(self):
+        pos = {}
+        for name, (ndjson, csvfile, writer) in self.outputs.items():
+            ndjson.flush()
+            csvfile.flush()
+            pos[name] = { 'count': self.counts[name], 'ndjson': ndjson.tell(), 'csv': csvfile.tell() }
+        return pos
+
+    # Append a record to a table
+    def write(self, name, rec):
+        ndjson, csvfile, writer = self.outputs[name]
+        ndjson.write(json.dumps(rec) + "\n")
+        writer.writerow(rec)
+        self.counts[name] += 1
+        if (self.parquet):
+            batch = self.batches[name]
+            batch.append(rec)
+            if (len(batch) >= PARQUET_BATCH):
+                self.flush(name)
+
+    # Append the records of a frame with the table's fields. Values should be
+    # as they would be in records (object columns), so that they are written
+    # the same. Returns the records
+    def write_frame(self, name, df):
+        ndjson, csvfile, writer = self.outputs[name]
+        records = frameRecords(df)
+        ndjson.write("".join([ json.dumps(rec) + "\n" for rec in records ]))
+        df.to_csv(csvfile, columns=self.tables[name], header=False, index=False, lineterminator="\r\n")
+        self.counts[name] += len(df)
+        if (self.parquet and len(df) > 0):
+            # After the records written one at a time
+            self.flush(name)
+            writer = self.parquet_writers[name]
+            columns = {}
+            for field in writer.schema.names:
+                columns[field] = columnArray(df[field], COLUMN_TYPES.get(field, "string"))
+            writer.write_table(pyarrow.Table.from_pydict(columns, schema=writer.schema), row_group_size=PARQUET_BATCH)
+        return records
+
+    # Write the buffered records of a table as a Parquet row group
+    def flush(self, name):
+        batch = self.batches[name]
+        if (len(batch) == 0):
+            return
+        writer = self.parquet_writers[name]
+        columns = {}
+        for field in writer.schema.names:
+            ctype = COLUMN_TYPES.get(field, "string")
+            columns[field] = [ columnValue(rec.get(field), ctype) for rec in batch ]
+        writer.write_table(pyarrow.Table.from_pydict(columns, schema=writer.schema))
+        self.batches[name] = []
+
+    # Close all outputs
+    def close(self):
+        for ndjson, csvfile, writer in self.outputs.values():
+            ndjson.close()
+            csvfile.close()
+        for name, writer in self.parquet_writers.items():
+            self.flush(name)
+            writer.close()
+        self.parquet_writers = {}
+
+    # Files written, optionally converting the tables to JSON arrays too (the
+    # pre-streaming .json format)
+    def finish(self, json_arrays = True):
+        files = []
+        for name in self.tables.keys():
+            fn = "%s-%s" % (self.prefix, name)
+            files += [ fn + ".ndjson", fn + ".csv" ]
+            if (self.parquet):
+                files.append(fn + ".parquet")
+            if (json_arrays):
+                ndjsonToJSON(fn + ".ndjson", fn + ".json")
+                files.append(fn + ".json")
+        return files
+
+#==================================================================================================================
+
+class Manifest:
+    # Init the snapshot manifest of an output dir. It lists the completed
+    # snapshots in time order, with their files, row counts and checksums
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.path   = os.path.join(outdir, "manifest.json")
+
+    # Load the manifest. If there is none yet, the snapshot files already in
+    # the dir are indexed once and the manifest written, under the lock
+    def load(self):
+        if (not os.path.exists(self.path)):
+            if (not os.path.isdir(self.outdir)):
+                return { 'version': 1, 'snapshots': [] }
+            return self.update(lambda manifest: None)
+        return self.read()
+
+    # Read the manifest, or index the dir if there is none
+    def read(self):
+        try:
+            f = open(self.path)
+        except FileNotFoundError:
+            return { 'version': 1, 'snapshots': self.scan() }
+        with f:
+            return json.load(f)
+
+    # Index the snapshot files in the dir by their names, oldest first.
+    # Snapshots with a checkpoint are still being written (or were
+    # interrupted), so they are left out
+    def scan(self):
+        if (not os.path.isdir(self.outdir)):
+            return []
+        found = {}
+        partial = set()
+        for fn in os.listdir(self.outdir):
+            if (fn.endswith("-checkpoint.json") or fn.endswith("-checkpoint.ndjson")):
+                partial.add(fn.rsplit("-checkpoint.", 1)[0])
+            for name in TABLES.keys():
+                tag = "-%s." % name
+                if (tag in fn):
+                    prefix, ext = fn.split(tag, 1)
+                    found.setdefault(prefix, {}).setdefault(name, []).append(ext)
+        snapshots = []
+        for prefix, tables in found.items():
+            if (prefix in partial):
+                continue
+            try:
+                when = datetime.strptime(prefix[-15:], "%Y%m%d-%H%M%S")
+            except ValueError:
+                continue
+            snapshot = { 'prefix': prefix, 'deployment': prefix[:-16], 'time': when.isoformat(),
+                         'timestamp': when.timestamp(), 'org': None, 'venue': None, 'tables': {} }
+            for name, exts in tables.items():
+                files = {}
+                for ext in exts:
+                    fn = os.path.join(self.outdir, "%s-%s.%s" % (prefix, name, ext))
+                    files[ext] = { 'size': os.path.getsize(fn), 'sha256': fileChecksum(fn) }
+                rows = None
+                if ('csv' in exts):
+                    with open(os.path.join(self.outdir, "%s-%s.csv" % (prefix, name))) as f:
+                        rows = sum(1 for row in csv.reader(f)) - 1
+                snapshot['tables'][name] = { 'rows': rows, 'files': files }
+            snapshots.append(snapshot)
+        snapshots.sort(key=lambda x: x['timestamp'])
+        return snapshots
+
+    # Rewrite the manifest under a temp name and rename it into place, so
+    # readers see either the old or the new one
+    def save(self, manifest):
+        fd, tmp_fn = tempfile.mkstemp(dir=self.outdir, prefix=".manifest.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as outfile:
+                json.dump(manifest, outfile, indent=2)
+            os.replace(tmp_fn, self.path)
+        except BaseException:
+            os.unlink(tmp_fn)
+            raise
+
+    # Apply update(manifest) under the manifest lock and save the result,
+    # which is returned
+    def update(self, update):
+        os.makedirs(self.outdir, exist_ok=True)
+        with open(os.path.join(self.outdir, ".manifest.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self.read()
+            update(manifest)
+            self.save(manifest)
+        return manifest
+
+    # Add a completed snapshot (replacing any scanned entry for its files)
+    def add(self, snapshot):
+        def add_snapshot(manifest):
+            snapshots = [ x for x in manifest['snapshots'] if x['prefix'] != snapshot['prefix'] ]
+            manifest['snapshots'] = snapshots
+            times = [ x['timestamp'] for x in snapshots ]
+            snapshots.insert(bisect.bisect_right(times, snapshot['timestamp']), snapshot)
+        self.update(add_snapshot)
+
+    # All snapshots, oldest first, optionally only those taken from since up
+    # to until (datetimes)
+    def snapshots(self, since = None, until = None):
+        snapshots = self.load()['snapshots']
+        if (since != None):
+            snapshots = [ x for x in snapshots if x['timestamp'] >= since.timestamp() ]
+        if (until != None):
+            snapshots = [ x for x in snapshots if x['timestamp'] <= until.timestamp() ]
+        return snapshots
+
+    # The latest snapshot, optionally the latest taken with the given org and
+    # venue filters. None if there is none
+    def latest(self, org = None, venue = None):
+        for snapshot in reversed(self.load()['snapshots']):
+            if (snapshot['org'] == org and snapshot['venue'] == venue):
+                return snapshot
+        return None
+
+    # The snapshot that was the latest at a given time (datetime)
+    def at(self, when, org = None, venue = None):
+        snapshots = self.load()['snapshots']
+        times = [ x['timestamp'] for x in snapshots ]
+        for snapshot in reversed(snapshots[:bisect.bisect_right(times, when.timestamp())]):
+            if (snapshot['org'] == org and snapshot['venue'] == venue):
+                return snapshot
+        return None
+
+    # Path of a table file of a snapshot (ext is json, ndjson, csv or parquet)
+    def file(self, snapshot, table, ext):
+        return os.path.join(self.outdir, "%s-%s.%s" % (snapshot['prefix'], table, ext))
+
+    # Load a table of a snapshot as a pandas DataFrame, optionally only the
+    # given columns. Reads the Parquet snapshot if there is one
+    def read_table(self, snapshot, table, columns = None):
+        if ('archive' in snapshot['tables'][table]):
+            fn = os.path.join(self.outdir, snapshot['tables'][table]['archive'])
+            if (columns == None):
+                columns = TABLES[table]
+            return pyarrow.parquet.read_table(fn, columns=columns, filters=[ ('snapshot', '=', snapshot['prefix']) ]).to_pandas()
+        files = snapshot['tables'][table]['files']
+        if ('parquet' in files and pyarrow != None):
+            prefix = os.path.join(self.outdir, snapshot['prefix'])
+            return read_snapshot(prefix, table, columns).to_pandas()
+        if ('json' in files):
+            df = pandas.read_json(self.file(snapshot, table, "json"))
+        else:
+            df = pandas.read_json(self.file(snapshot, table, "ndjson"), lines=True)
+        if (columns != None):
+            df = df[columns]
+        return df
+
+    # Load a table across all snapshots taken from since up to until
+    # (datetimes) as one DataFrame, each row tagged with its snapshot and
+    # snapshot_time. Compacted snapshots are read from their archives
+    def read_range(self, table, since = None, until = None, columns = None, org = None, venue = None):
+        frames = []
+        archives = {}
+        for snapshot in self.snapshots(since, until):
+            if (snapshot['org'] != org or snapshot['venue'] != venue or table not in snapshot['tables']):
+                continue
+            if ('archive' in snapshot['tables'][table]):
+                archives.setdefault(snapshot['tables'][table]['archive'], []).append(snapshot['prefix'])
+                continue
+            df = self.read_table(snapshot, table, columns)
+            df.insert(0, 'snapshot', snapshot['prefix'])
+            df.insert(1, 'snapshot_time', pandas.Timestamp(snapshot['time']))
+            frames.append(df)
+        for path, prefixes in archives.items():
+            if (columns != None):
+                cols = ARCHIVE_COLUMNS + columns
+            else:
+                cols = None
+            frames.append(pyarrow.parquet.read_table(os.path.join(self.outdir, path), columns=cols,
+                                                     filters=[ ('snapshot', 'in', prefixes) ]).to_pandas())
+        if (len(frames) == 0):
+            return pandas.DataFrame(columns=ARCHIVE_COLUMNS + (columns or TABLES[table]))
+        df = pandas.concat(frames, ignore_index=True)
+        return df.sort_values('snapshot_time', kind='stable', ignore_index=True)
+
+# SHA-256 of a file
+def fileChecksum(fn):
+    digest = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+#==================================================================================================================
+
+# All the state of one collection run against one deployment
+class Collection:
+    # Init a collection. Records are streamed to a Sink under outdir (if set)
+    # as they are produced, and also kept in memory if keep is set. The
+    # phases and devices are timed if a tracing.Profiler is given. Device
+    # stats are processed on procs processes (see pipeline()), which are
+    # forked: only set it if no other threads run in this process
+    def __init__(self, capi, org = None, venue = None, jobs = STATS_WORKERS, out = None, verbose = True,
+                 outdir = None, keep = True, parquet = True, profiler = None, procs = 0):
+        self.capi    = capi
+        self.org     = org
+        self.venue   = venue
+        self.jobs    = jobs
+        self.out     = out
+        self.verbose = verbose
+        self.outdir  = outdir
+        self.keep    = keep
+        self.parquet = parquet
+        self.sink    = None
+        self.profiler = profiler
+        self.procs   = procs
+        self.transformer = None
+        self.emit_tm = [ 0, 0.0, 0.0 ]
+        self.done    = set()
+        self.retry   = []
+        self.journal = None
+        self.checkpoint_cnt = 0
+        self.checkpoint_tm = None
+
+        self.online_devices = []
+        self.survey_data = []
+        self.neighbors_data = []
+        self.stale_devices = []
+        self.config_findings = []
+        self.linter = configlint.ConfigLinter()
+        self.high_mem_devices = []
+        self.failed_devices = []
+        self.clients_by_ap = {}
+        self.clients_by_ap_data = []
+        self.clients_data = []
+        self.state_count = 0
+        self.state_min = 0
+        self.state_min_mac = ""
+        self.state_max = 0
+        self.state_max_mac = ""
+        self.state_avg = 0
+        self.state_warning = []
+        self.cnt_total = 0
+        self.cnt_online = 0
+        self.now = None
+        self.files = []
+        self.tables = { 'online-devices': self.online_devices, 'survey-data': self.survey_data,
+                        'neighbors-data': self.neighbors_data, 'clients-by-ap': self.clients_by_ap_data,
+                        'clients': self.clients_data }
+
+    # Print to this collection's output (stdout unless buffered)
+    def log(self, *args, **kwargs):
+        print(*args, file=self.out, **kwargs)
+
+    # Time a phase of the run, if profiling
+    def phase(self, name):
+        if (self.profiler):
+            return self.profiler.span(name)
+        return nullcontext()
+
+    # Output a record of a table
+    def emit(self, name, rec):
+        if (self.sink and self.profiler):
+            start_tm = time.perf_counter()
+            cpu_tm = time.thread_time()
+            self.sink.write(name, rec)
+            self.emit_tm[0] += 1
+            self.emit_tm[1] += time.perf_counter() - start_tm
+            self.emit_tm[2] += time.thread_time() - cpu_tm
+        elif (self.sink):
+            self.sink.write(name, rec)
+        if (self.keep):
+            self.tables[name].append(rec)
+
+    # Write out the records of a table from a frame (see Sink.write_frame())
+    def emitFrame(self, name, df):
+        start_tm = time.perf_counter()
+        cpu_tm = time.thread_time()
+        if (self.sink):
+            records = self.sink.write_frame(name, df)
+        else:
+            records = frameRecords(df)
+        if (self.sink and self.profiler):
+            self.emit_tm[0] += len(df)
+            self.emit_tm[1] += time.perf_counter() - start_tm
+            self.emit_tm[2] += time.thread_time() - cpu_tm
+        if (self.keep):
+            self.tables[name].extend(records)
+
+    # Account for the size of a device's state
+    def loadStats(self, mac, size):
+        if (self.state_avg == 0):
+            self.state_avg = size
+        else:
+            self.state_avg = ((self.state_avg * self.state_count) + size) / (self.state_count + 1)
+        self.state_count += 1
+        if (self.state_min == 0 or size < self.state_min):
+            self.state_min = size
+            self.state_min_mac = mac
+        if (self.state_max == 0 or size > self.state_max):
+            self.state_max = size
+            self.state_max_mac = mac
+        if (size < STATE_THRESHOLDS[0] or size > STATE_THRESHOLDS[1]):
+            sw = { 'mac': mac, 'size': size }
+            self.state_warning.append(sw)
+
+    # Merge the records of a device (see transformDevice()) into the run,
+    # and write them out. What the run keeps of them is also appended to the
+    # checkpoint journal, so a resumed run can rebuild it (see restore())
+    def mergeDevice(self, result):
+        nd = result['nd']
+        state = { 'mac': nd['mac'], 'size': result['size'], 'last_state': nd['last_state'],
+                  'mem_used_pct': nd['mem_used_pct'], 'ap': result['ap'], 'assocs': result['assocs'],
+                  'rrm': result['rrm'] }
+        if (self.journal):
+            self.journal.write(journalLine(state))
+        self.mergeState(state)
+
+        for ns in result['survey']:
+            self.emit('survey-data', ns)
+        for nn in result['neighbors']:
+            self.emit('neighbors-data', nn)
+        self.emit('online-devices', nd)
+
+    # Merge what the run keeps of a device's records: its state size, stale
+    # and high memory warnings, and clients
+    def mergeState(self, state):
+        mac = state['mac']
+        self.loadStats(mac, state['size'])
+        if (state['last_state'] > 120):
+            sd = { 'mac': mac, 'last_state': state['last_state'] }
+            self.stale_devices.append(sd)
+        if (state['mem_used_pct'] > MEM_THRESHOLD):
+            md = { 'mac': mac, 'mem_used_pct': state['mem_used_pct'] }
+            self.high_mem_devices.append(md)
+
+        self.mergeAssocClients(state['ap'], state['assocs'])
+        self.mergeRRMInfo(state['ap'], state['rrm'])
+        self.done.add(mac)
+
+    def mergeAssocClients(self, nd, assocs):
+        clients_by_ap = self.clients_by_ap
+
+        amac = nd['mac']
+        for cmac, apc in assocs:
+            if cmac in clients_by_ap:
+                if amac in clients_by_ap[cmac]['ap']:
+                    clients_by_ap[cmac]['dup'] = clients_by_ap[cmac]['dup'] + 1
+                    if (apc['connected_time'] > clients_by_ap[cmac]['ap'][amac]['connected_time']):
+                        # This is older entry, ignore it
+                        continue
+                    # ...fall through: newer entry, replace it
+                clients_by_ap[cmac]['ap'][amac] = apc
+            else:
+                clients_by_ap[cmac] = { 'dup': 0, 'ap': { amac: apc } }
+
+    def mergeRRMInfo(self, nd, updates):
+        clients_by_ap = self.clients_by_ap
+
+        amac = nd['mac']
+        for cmac, rrm in updates:
+            if cmac in clients_by_ap and amac in clients_by_ap[cmac]['ap']:
+                apc = clients_by_ap[cmac]['ap'][amac]
+            else:
+                apc = newAPClient(nd)
+            apc.update(rrm)
+
+            if (cmac in clients_by_ap):
+                clients_by_ap[cmac]['ap'][amac] = apc
+            else:
+                clients_by_ap[cmac] = { 'dup': 0, 'ap': { amac: apc } }
+
+    # Filter the devices down to the connected ones matching the org/venue filter,
+    # yielding a record for each with its inventory, venue and config info filled in
+    def onlineDevices(self, devices):
+        pdata = self.pdata
+
+        for x in devices:
+            self.cnt_total = self.cnt_total + 1
+            if x['connected']:
+                nd = { "mac": x['serialNumber'] }
+                inv = pdata.get_inventory_by_mac(x['serialNumber'])
+                if (inv == None):
+                    nd['name'] = "unknown"
+                    if (len(x['manufacturer']) > 0):
+                        nd['model'] = x['compatible']
+                    else:
+                        nd['model'] = "unknown"
+                else:
+                    nd['name'] = inv['name']
+                    nd['model'] = inv['deviceType']
+                if (inv != None and 'venue' in inv):
+                    ext = inv['venue']
+                else:
+                    ext = x['venue']
+                v = pdata.get_venue_by_uuid(ext)
+                if (v == None):
+                    nd['venue'] = "unknown"
+                    nd['org'] = "unknown"
+                else:
+                    nd['venue'] = v['name']
+                    e = pdata.get_entity_by_uuid(v['entity'])
+                    if (e == None):
+                        nd['org'] = "unknown"
+                    else:
+                        nd['org'] = e['name']
+
+                if (self.org):
+                    if (nd['org'].lower() != self.org.lower()):
+                        continue
+                if (self.venue):
+                    if (nd['venue'].lower() != self.venue.lower()):
+                        continue
+                self.cnt_online = self.cnt_online + 1
+
+                nd['num_assocs'] = x['associations_2G'] + x['associations_5G'] + x['associations_6G']
+                idx = x['firmware'].find("Shasta")
+                if (idx < 0):
+                    if (len(x['firmware']) == 0):
+                        nd['firmware'] = "unknown"
+                    else:
+                        nd['firmware'] = x['firmware']
+                else:
+                    nd['firmware'] = x['firmware'][idx:]
+
+                # Configured channels, and the config lint findings
+                index = configlint.ConfigIndex(x.get('configuration'))
+                for band in ['2g', '5g', '6g']:
+                    if band.upper() in index.radios:
+                        r = index.radios[band.upper()]
+                        nd['conf_' + band] = str(r['channel'])
+                        nd['conf_%s_bw' % band] = str(r['channel-width'])
+                    else:
+                        nd['conf_' + band] = "unknown"
+                        nd['conf_%s_bw' % band] = "unknown"
+                self.config_findings += self.linter.lint(nd['mac'], index)
+
+                # Done before the run was resumed
+                if (nd['mac'] in self.done):
+                    continue
+                yield nd
+
+    # Load the provisioning data and devices, then fetch and process the stats
+    # of every online device, streaming the records to the outputs. Pass a
+    # checkpoint (see findCheckpoint()) as resume to carry on with the
+    # snapshot of an interrupted run, skipping the devices it already did
+    def run(self, resume = None):
+        # The transform processes are forked first, while the run has no
+        # threads of its own: the ProvData and device page loaders leave
+        # threads behind that may still be running when they return
+        if (self.procs > 0):
+            self.transformer = ProcessPoolExecutor(max_workers=self.procs, mp_context=multiprocessing.get_context("fork"))
+            # Warmed up so that all the processes are forked now
+            self.transformer.submit(int).result()
+        try:
+            self.runPhases(resume)
+        finally:
+            if (self.transformer):
+                self.transformer.shutdown(cancel_futures=True)
+                self.transformer = None
+
+    def runPhases(self, resume):
+        capi = self.capi
+
+        # Load the provisioning data
+        with self.phase("load provdata"):
+            self.pdata = cloudsdk.ProvData(capi, verbose = self.verbose, no_cache = True)
+
+        if (resume):
+            self.restore(resume)
+            self.log("Resuming %s: %d devices already done" % (self.prefix, len(self.done)))
+        else:
+            self.now = datetime.now()
+        if (self.outdir):
+            os.makedirs(self.outdir, exist_ok=True)
+            if (not resume):
+                self.prefix = self.outdir + "/%s-%s" % (capi.deployment, self.now.strftime("%Y%m%d-%H%M%S"))
+            self.sink = Sink(self.prefix, parquet=self.parquet, resume=(resume['sink'] if resume else None))
+            self.journal = open(self.prefix + "-checkpoint.ndjson", ("a" if resume else "w"))
+            if (resume and self.keep):
+                for name in self.tables.keys():
+                    with open("%s-%s.ndjson" % (self.prefix, name)) as f:
+                        self.tables[name].extend([ json.loads(line) for line in f ])
+            self.checkpoint_tm = time.time()
+        try:
+            with self.phase("devices"):
+                self.runDevices()
+            with self.phase("client aggregation"):
+                self.processClients()
+        finally:
+            if (self.sink):
+                with self.phase("close outputs"):
+                    self.sink.close()
+                    self.journal.close()
+            if (self.profiler):
+                # Streamed as the records were produced, within the phases above
+                self.profiler.total("write records", tracing.PHASE, *self.emit_tm)
+
+    def runDevices(self):
+        capi = self.capi
+        now = self.now
+
+        # Get device count, the devices themselves are streamed in page by page below
+        with self.phase("device count"):
+            dev_count = capi.get_device_count()
+        devices = capi.iter_devices(verbose = self.verbose, count = dev_count)
+        if (self.profiler):
+            devices = self.profiler.iterate(devices, "list devices page")
+
+        # Get device connection statistics
+        with self.phase("conn stats"):
+            self.cstats = cstats = capi.get_conn_stats()
+
+        self.log("\nThere are %d connected devices out of %d total (%d avg conn time)" % (cstats['connectedDevices'], dev_count, cstats['averageConnectionTime']))
+
+        if (self.org or self.venue):
+            fstr = " (Filter: %s => %s)" % (self.org, self.venue)
+        else:
+            fstr = ""
+        self.log("-> Processing online devices" + fstr)
+
+        # Fetch device stats in parallel as the device pages come in, processing them
+        # in device order
+        if (self.procs > 0):
+            self.log("   -> Loading device stats, %d at a time, processed on %d processes" % (self.jobs, self.procs))
+        else:
+            self.log("   -> Loading device stats, %d at a time" % (self.jobs))
+        start_tm = datetime.now()
+        errors = {}
+        self.pipeline(self.onlineDevices(devices), errors)
+        self.retryDevices(errors)
+        fetch_tm = (datetime.now() - start_tm).total_seconds()
+        if (fetch_tm > 0):
+            self.log("   -> Loaded stats for %d devices in %.1f s (%.1f devices/sec)" % (self.cnt_online, fetch_tm, self.cnt_online / fetch_tm))
+
+    # Run devices through the pipeline: their stats are fetched on the stats
+    # worker threads, turned into records by transformDevice() on the
+    # transform processes (or on this thread if there are none), then merged
+    # into the run's state and written out on this thread, in device order.
+    # Each stage has at most 2x its workers in flight. Devices whose stats
+    # fail to load are queued for retry, with their error in errors
+    def pipeline(self, nds, errors):
+        fetched_devices = iterStats(self.capi, nds, self.jobs, self.profiler, raw=True)
+        if (self.profiler):
+            # Waiting on the stats workers (and the device pages they need)
+            fetched_devices = self.profiler.iterate(fetched_devices, "wait for stats")
+        pending = deque()
+        for nd, fetched in fetched_devices:
+            if (fetched['stats'] != None and self.transformer):
+                pending.append((nd, fetched, self.transformer.submit(transformDevice, nd, fetched['stats'], self.now)))
+            else:
+                pending.append((nd, fetched, None))
+            while (len(pending) > self.procs * 2):
+                self.mergeNext(pending, errors)
+        while (len(pending) > 0):
+            self.mergeNext(pending, errors)
+
+    # Merge the oldest device in the pipeline
+    def mergeNext(self, pending, errors):
+        nd, fetched, future = pending.popleft()
+        mac = nd['mac']
+        self.log("   -> Loading latest stats for " + mac, end = ": ")
+        self.log("Retrying..." * (fetched['tries'] - 1), end = "")
+        if (fetched['stats'] == None):
+            # Retried once the other devices are done
+            self.log("Failed (%s)" % fetched['error'])
+            errors[mac] = fetched['error']
+            self.retry.append(nd)
+            return
+        try:
+            if (future):
+                result = future.result()
+            else:
+                result = transformDevice(nd, fetched['stats'], self.now)
+        except Exception as e:
+            self.log("Failed (bad stats: %s)" % e)
+            self.failed_devices.append({ 'mac': mac, 'error': "bad stats: %s" % e })
+            return
+        self.log("%6d bytes (took %4.0f ms)" % (result['size'], (fetched['fetch_tm'] * 1000)));
+        self.mergeDevice(result)
+        if (self.profiler):
+            start, end, cpu, pid = result['transform_tm']
+            self.profiler.add(mac, tracing.PARSE, start, end, cpu, lane="transform-%d" % pid, mac=mac)
+        self.checkpointIfDue()
+
+    # Retry the devices whose stats failed to load, a round at a time with
+    # exponential backoff. Those still failing are reported, not processed
+    def retryDevices(self, errors):
+        for round_no in range(1, RETRY_ROUNDS + 1):
+            if (len(self.retry) == 0):
+                return
+            delay = RETRY_BACKOFF * (2 ** (round_no - 1))
+            self.log("   -> Retrying %d devices in %g s (round %d of %d)" % (len(self.retry), delay, round_no, RETRY_ROUNDS))
+            time.sleep(delay)
+            nds = self.retry
+            self.retry = []
+            self.pipeline(nds, errors)
+        for nd in self.retry:
+            self.failed_devices.append({ 'mac': nd['mac'], 'error': errors.get(nd['mac']) })
+        self.retry = []
+
+    # Aggregate the clients seen on each AP into the clients-by-ap records
+    # (one per client and AP) and the clients ones: the record of a client's
+    # primary AP (the connected one it joined last, or the first one if
+    # none), with the RRM steering counters summed over all its APs
+    def processClients(self):
+        clients_by_ap = self.clients_by_ap
+
+        self.log("\nThere are %d total clients across the %d connected devices" % (len(clients_by_ap), self.cstats['connectedDevices']))
+        self.log("-> Processing client stats and RRM info")
+
+        # One row per client and AP, in the order they were seen. Values are
+        # kept as they are (object columns), the outputs are written from them
+        cmacs = []
+        amacs = []
+        dups = []
+        apcs = []
+        aps = {}
+        for cmac, ent in clients_by_ap.items():
+            for amac, apc in ent['ap'].items():
+                cmacs.append(cmac)
+                amacs.append(amac)
+                dups.append(ent['dup'])
+                apcs.append(apc)
+                aps[amac] = apc['_device']
+        by_ap = pandas.DataFrame(apcs, columns=AP_CLIENT_FIELDS, dtype="object")
+        ap_info = pandas.DataFrame(list(aps.values()), index=list(aps.keys()), columns=['org', 'venue', 'name', 'model', 'firmware'],
+                                   dtype="object").reindex(amacs)
+        for i, (field, x) in enumerate([ ('mac', cmacs), ('org', ap_info['org']), ('venue', ap_info['venue']), ('ap_mac', amacs),
+                                         ('ap_name', ap_info['name']), ('ap_model', ap_info['model']), ('ap_fw', ap_info['firmware']) ]):
+            by_ap.insert(i, field, numpy.asarray(x, dtype="object"))
+        self.emitFrame('clients-by-ap', by_ap)
+
+        # Clients are numbered in the order they were seen, and their rows
+        # sorted by connected first, then by connected time and row
+        codes = pandas.factorize(numpy.asarray(cmacs, dtype="object"))[0]
+        connected = by_ap['connected'].to_numpy(dtype="bool")
+        connected_time = numpy.where(connected, pandas.to_numeric(by_ap['connected_time']).to_numpy(dtype="float64"), 0)
+        order = numpy.lexsort((numpy.arange(len(by_ap)), connected_time, ~connected, codes))
+        primary = order[numpy.r_[True, codes[order][1:] != codes[order][:-1]]] if (len(order) > 0) else order
+
+        clients = by_ap.drop(columns=['ap_mac', 'ap_name', 'ap_model', 'ap_fw']).iloc[primary].reset_index(drop=True)
+        counters = by_ap[RRM_COUNTERS].astype("int64").groupby(codes).sum()
+        for x in RRM_COUNTERS:
+            clients[x] = counters[x].to_numpy().astype("object")
+        clients['ap_cnt'] = numpy.bincount(codes, minlength=len(clients)).astype("object")
+        clients['dups'] = numpy.asarray(dups, dtype="object")[primary]
+        clients = clients[TABLES['clients']]
+        self.emitFrame('clients', clients)
+        self.log("   -> %d of them are currently connected" % connected[primary].sum())
+
+    # Checkpoint if CHECKPOINT_DEVICES devices or CHECKPOINT_SECS seconds
+    # went by since the last time
+    def checkpointIfDue(self):
+        if (self.sink == None):
+            return
+        self.checkpoint_cnt += 1
+        if (self.checkpoint_cnt >= CHECKPOINT_DEVICES or time.time() - self.checkpoint_tm >= CHECKPOINT_SECS):
+            self.checkpoint()
+
+    # Save the progress of the run to <prefix>-checkpoint.json: the size of
+    # each output and of the journal of device states so far. Both only grow,
+    # so this takes the same time however many devices are done
+    def checkpoint(self):
+        self.journal.flush()
+        cp = { 'version': 2, 'prefix': os.path.basename(self.prefix), 'time': self.now.isoformat(),
+               'org': self.org, 'venue': self.venue, 'sink': self.sink.position(), 'journal': self.journal.tell() }
+
+        fd, tmp_fn = tempfile.mkstemp(dir=self.outdir, prefix=".checkpoint.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(cp, f)
+            os.replace(tmp_fn, self.prefix + "-checkpoint.json")
+        except BaseException:
+            os.unlink(tmp_fn)
+            raise
+        self.checkpoint_cnt = 0
+        self.checkpoint_tm = time.time()
+
+    # Latest checkpoint an interrupted run of this deployment left in the
+    # output dir, or None
+    def findCheckpoint(self):
+        if (not os.path.isdir(self.outdir)):
+            return None
+        found = [ fn for fn in os.listdir(self.outdir)
+                  if fn.startswith(self.capi.deployment + "-") and fn.endswith("-checkpoint.json") ]
+        if (len(found) == 0):
+            return None
+        with open(os.path.join(self.outdir, sorted(found)[-1])) as f:
+            return json.load(f)
+
+    # Restore the progress saved by checkpoint(), replaying the device
+    # states journaled up to it. Anything journaled after it is dropped
+    def restore(self, cp):
+        if (cp.get('version') != 2):
+            raise Exception("[collector] Error: checkpoint %s is from an older version, it can't be resumed" % (cp['prefix']))
+        if (cp['org'] != self.org or cp['venue'] != self.venue):
+            raise Exception("[collector] Error: checkpoint %s was for %s => %s, not %s => %s"
+                            % (cp['prefix'], cp['org'], cp['venue'], self.org, self.venue))
+        self.now = datetime.fromisoformat(cp['time'])
+        self.prefix = self.outdir + "/" + cp['prefix']
+        os.truncate(self.prefix + "-checkpoint.ndjson", cp['journal'])
+        with open(self.prefix + "-checkpoint.ndjson") as f:
+            for line in f:
+                state = json.loads(line)
+                for cmac, apc in state['assocs']:
+                    apc['_device'] = state['ap']
+                self.mergeState(state)
+
+    # Finish the outputs written during the run, optionally converting them
+    # to the JSON array files too
+    def write(self, json_arrays = True):
+        self.log("\n[" + self.prefix + "] Processed " + str(self.cnt_online) + " online devices out of " + str(self.cnt_total) + " total")
+        if (self.sink.parquet):
+            exts = "ndjson,csv,parquet"
+        else:
+            exts = "ndjson,csv"
+            if (self.parquet):
+                self.log("   -> pyarrow is not installed, no Parquet snapshot written")
+        for name, cnt in self.sink.counts.items():
+            self.log("   -> Wrote %d %s records to %s-%s.{%s}" % (cnt, name, self.prefix, name, exts))
+        if (json_arrays):
+            self.log("   -> Writing JSON arrays of each to %s-*.json" % (self.prefix))
+        self.files = self.sink.finish(json_arrays)
+
+        # The snapshot is complete: list it in the manifest
+        snapshot = { 'prefix': os.path.basename(self.prefix), 'deployment': self.capi.deployment,
+                     'time': self.now.isoformat(), 'timestamp': self.now.timestamp(),
+                     'org': self.org, 'venue': self.venue, 'tables': {} }
+        for name, cnt in self.sink.counts.items():
+            snapshot['tables'][name] = { 'rows': cnt, 'files': {} }
+        for fn in self.files:
+            name, ext = fn[len(self.prefix) + 1:].rsplit(".", 1)
+            snapshot['tables'][name]['files'][ext] = { 'size': os.path.getsize(fn), 'sha256': fileChecksum(fn) }
+        Manifest(self.outdir).add(snapshot)
+        self.log("   -> Added snapshot to " + os.path.join(self.outdir, "manifest.json"))
+
+        # Nothing left to resume
+        for ext in [ "json", "ndjson" ]:
+            if (os.path.exists("%s-checkpoint.%s" % (self.prefix, ext))):
+                os.unlink("%s-checkpoint.%s" % (self.prefix, ext))
+
+    # Print the information, warnings and errors found during the run
+    def report(self, expand = False):
+        pdata = self.pdata
+
+        self.log("\nInformation, warnings, and errors detected:")
+        self.log("   -> State Size Info:")
+        dinfo = pdata.get_device_info(self.state_min_mac, mark_unknown=True)
+        self.log("        Min: %6d bytes (MAC: %s, %s => %s => %s)"
+                                    % (round(self.state_min), self.state_min_mac, dinfo['entity'], dinfo['venue'], dinfo['name']))
+        dinfo = pdata.get_device_info(self.state_max_mac, mark_unknown=True)
+        self.log("        Max: %6d bytes (MAC: %s, %s => %s => %s)"
+                                    % (round(self.state_max), self.state_max_mac, dinfo['entity'], dinfo['venue'], dinfo['name']))
+        self.log("        Avg: %6d bytes" % (round(self.state_avg)))
+
+        if (len(self.state_warning)):
+            self.log("   -> WARNING: Found " + str(len(self.state_warning)) + " devices with state size outside of warning thresholds:")
+            for sw in self.state_warning:
+                dinfo = pdata.get_device_info(sw['mac'], mark_unknown=True)
+                self.log("       -> %s state size is %6d bytes (%s => %s => %s)"
+                                    % (sw['mac'], round(sw['size']), dinfo['entity'], dinfo['venue'], dinfo['name']))
+
+        if (len(self.high_mem_devices)):
+            self.log("   -> WARNING: Found " + str(len(self.high_mem_devices)) + " devices with memory > " + str(MEM_THRESHOLD) + "%:")
+            for md in self.high_mem_devices:
+                dinfo = pdata.get_device_info(md['mac'], mark_unknown=True)
+                self.log("       -> %s mem usage is %d%% (%s => %s => %s)"
+                                    % (md['mac'], md['mem_used_pct'], dinfo['entity'], dinfo['venue'], dinfo['name']))
+
+        if (len(self.stale_devices)):
+            self.log("   -> WARNING: Found " + str(len(self.stale_devices)) + " devices with stale stats:")
+            for sd in self.stale_devices:
+                dinfo = pdata.get_device_info(sd['mac'], mark_unknown=True)
+                self.log("       -> %s last updated %d seconds ago (%s => %s => %s)"
+                                    % (sd['mac'], sd['last_state'], dinfo['entity'], dinfo['venue'], dinfo['name']))
+
+        if (len(self.failed_devices)):
+            self.log("   -> ERROR: Failed to load stats for " + str(len(self.failed_devices)) + " devices, left out of the outputs:")
+            for fd in self.failed_devices:
+                dinfo = pdata.get_device_info(fd['mac'], mark_unknown=True)
+                self.log("       -> %s: %s (%s => %s => %s)"
+                                    % (fd['mac'], fd['error'], dinfo['entity'], dinfo['venue'], dinfo['name']))
+
+        for r in self.linter.rules:
+            found = self.findings(r['name'])
+            if (len(found) == 0):
+                continue
+            self.log("   -> %s: %s" % (r['severity'], r['summary'] % len(found)))
+            if (expand or not r['expand']):
+                for f in found:
+                    dinfo = pdata.get_device_info(f['mac'], mark_unknown=True)
+                    self.log("       -> %s (%s => %s => %s)" % (r['detail'] % f, dinfo['entity'], dinfo['venue'], dinfo['name']))
+
+    # The config lint findings of a rule
+    def findings(self, rule):
+        return [ f for f in self.config_findings if f['rule'] == rule ]
+
+    # The results as a dict of record lists (empty unless kept), plus the
+    # warnings and the files written (if any)
+    def get_results(self):
+        return {
+            'deployment': self.capi.deployment,
+            'time': self.now,
+            'total': self.cnt_total,
+            'online': self.cnt_online,
+            'online_devices': self.online_devices,
+            'survey_data': self.survey_data,
+            'neighbors_data': self.neighbors_data,
+            'clients_by_ap': self.clients_by_ap_data,
+            'clients': self.clients_data,
+            'state_warning': self.state_warning,
+            'high_mem_devices': self.high_mem_devices,
+            'stale_devices': self.stale_devices,
+            'remote_logging_devices': self.findings("remote-logging"),
+            'broken_lan_devices': self.findings("broken-lan"),
+            'config_findings': self.config_findings,
+            'failed_devices': self.failed_devices,
+            'files': self.files
+        }
+
+# Collect the online devices of a deployment, returning the Collection. The
+# records are streamed to files under outdir (results/<deployment> by
+# default) unless outdir is False, with JSON array copies if json_arrays is
+# set and a Parquet snapshot if parquet is set, and kept in memory if keep
+# is set. Device stats are processed on procs forked processes (only set it
+# if no other threads run in this process). The run is timed
+# if a tracing.Profiler is given, and with resume
+# set it carries on from the checkpoint of an interrupted run in outdir, if
+# there is one. Pass capi to reuse an API client,
+# otherwise one is created and closed again. Output goes to out, or stdout;
+# if not verbose and no out is given it is kept in a buffer (the
+# Collection's out) instead
+def collect(deployment, org = None, venue = None, jobs = STATS_WORKERS, outdir = None, capi = None,
+            out = None, verbose = True, expand = False, keep = True, json_arrays = True, parquet = True,
+            profiler = None, resume = False, procs = 0):
+    own_api = (capi == None)
+    if (own_api):
+        capi = cloudsdk.API(deployment=deployment, verbose=verbose)
+    if (out == None and not verbose):
+        out = io.StringIO()
+    if (outdir == None):
+        outdir = "results/%s" % (capi.deployment)
+
+    coll = Collection(capi, org=org, venue=venue, jobs=jobs, out=out, verbose=verbose, outdir=outdir, keep=keep,
+                      parquet=parquet, profiler=profiler, procs=procs)
+    try:
+        checkpoint = None
+        if (resume and outdir):
+            checkpoint = coll.findCheckpoint()
+            if (checkpoint == None):
+                coll.log("No checkpoint to resume in %s, starting a new snapshot" % (outdir))
+        coll.run(resume=checkpoint)
+        if (outdir):
+            with coll.phase("write outputs"):
+                coll.write(json_arrays=json_arrays)
+        coll.report(expand=expand)
+    finally:
+        if (own_api):
+            capi.close()
+    return coll
+
+#==================================================================================================================
+
+class Collector:
+    # Init a collector for a long-running app: it keeps one warm API client
+    # per deployment, created on first use
+    def __init__(self, verbose = False):
+        self.verbose = verbose
+        self.lock    = threading.Lock()
+        self.apis    = {}
+
+    # Get the API client of a deployment
+    def get_api(self, deployment):
+        deployment = deployment.upper()
+        with self.lock:
+            if (deployment not in self.apis):
+                self.apis[deployment] = cloudsdk.API(deployment=deployment, verbose=self.verbose)
+            return self.apis[deployment]
+
+    # Collect a deployment (see collect()) with its warm API client
+    def collect(self, deployment, **kwargs):
+        kwargs.setdefault('verbose', self.verbose)
+        return collect(deployment, capi=self.get_api(deployment), **kwargs)
+
+    # Close all API clients
+    def close(self):
+        with self.lock:
+            for capi in self.apis.values():
+                capi.close()
+            self.apis = {}
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+# Lint of device configurations. Each device's configuration is indexed once
+# (radios by band, interfaces by name, ports to the interfaces selecting
+# them, SSIDs and services), then every registered rule is checked against
+# the index. A rule is a function of the index returning the details of its
+# finding on the device (a dict) or None, registered with @rule:
+#
+#   @rule("no-ntp", "WARNING", "Found %d devices without NTP:", "%(mac)s has no NTP servers")
+#   def noNTP(index):
+#       if ('ntp' not in index.services):
+#           return {}
+#
+# Findings are dicts of the device mac, rule name and severity plus those
+# details, so fleet-wide audits can be added without another pass over the
+# configurations
+
+# Registered rules, checked and reported in this order
+CONFIG_RULES = []
+
+# Register a rule. summary is reported with the number of devices found,
+# detail for each of them (from the finding), only when expanded if expand
+# is set
+def rule(name, severity, summary, detail, expand = False):
+    def register(check):
+        CONFIG_RULES.append({ 'name': name, 'severity': severity, 'summary': summary, 'detail': detail,
+                              'expand': expand, 'check': check })
+        return check
+    return register
+
+#==================================================================================================================
+
+class ConfigIndex:
+    # Index a device configuration (None if the device has none)
+    def __init__(self, config):
+        if (config == None):
+            config = {}
+        self.config = config
+        self.services = config.get('services', {})
+
+        # The last one of a band wins
+        self.radios = {}
+        for r in config.get('radios', []):
+            self.radios[r['band']] = r
+
+        # Ports selected by the ethernet entries of each interface, as
+        # (interface name, port) in config order, and the interfaces
+        # selecting each port and any LAN port
+        self.interfaces = {}
+        self.ports = []
+        self.port_ifaces = {}
+        self.lan_ifaces = set()
+        self.ssids = []
+        for intf in config.get('interfaces', []):
+            ifname = intf.get('name')
+            self.interfaces[ifname] = intf
+            for eth in intf.get('ethernet', []):
+                for pn in eth.get('select-ports', []):
+                    self.ports.append((ifname, pn))
+                    self.port_ifaces.setdefault(pn, set()).add(ifname)
+                    if (pn.startswith('LAN')):
+                        self.lan_ifaces.add(ifname)
+            for ssid in intf.get('ssids', []):
+                self.ssids.append((ifname, ssid))
+
+class ConfigLinter:
+    # Init a linter checking the given rules, all registered ones by default
+    def __init__(self, rules = None):
+        if (rules == None):
+            rules = CONFIG_RULES
+        self.rules = rules
+
+    # Check the rules against the index of a device's config, returning
+    # its findings
+    def lint(self, mac, index):
+        findings = []
+        for r in self.rules:
+            details = r['check'](index)
+            if (details != None):
+                finding = { 'mac': mac, 'rule': r['name'], 'severity': r['severity'] }
+                finding.update(details)
+                findings.append(finding)
+        return findings
+
+#==================================================================================================================
+
+# LAN ports selected by more than one interface ("LAN*" selects them all)
+@rule("broken-lan", "ERROR", "Found %d devices with broken LAN config:", "%(mac)s has LAN duplicated %(dup_cnt)d times")
+def brokenLAN(index):
+    dup_cnt = 0
+    for ifname, pn in index.ports:
+        if (not pn.startswith('LAN')):
+            continue
+        # The interface itself is always in both sets
+        if (len(index.port_ifaces[pn]) > 1 or (pn == "LAN*" and len(index.lan_ifaces) > 1)):
+            dup_cnt += 1
+    if (dup_cnt > 0):
+        return { 'dup_cnt': dup_cnt }
+
+# Logging to a remote syslog host
+@rule("remote-logging", "WARNING", "There are %d devices remote logging", "%(mac)s logging to %(host)s:%(port)s", expand=True)
+def remoteLogging(index):
+    log = index.services.get('log', {})
+    if ('host' in log):
+        return { 'host': log['host'], 'port': log.get('port') }
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+# Shared fixtures of the module tests. API clients are for a LOCAL deployment
+# served by the fake controller (see bench/fake_controller.py) from the DF
+# fixtures in cache/, with their config, auth token and cache under the
+# test's temp dir
+#
+#   python3 -m pytest -q
+
+import os
+import sys
+import json
+import pytest
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP_DIR)
+sys.path.append(os.path.join(TOP_DIR, "bench"))
+
+import fake_controller
+from modules import cloudsdk
+
+# Start a fake controller on a free port (see fake_controller.FakeController
+# for the options)
+def startController(**kwargs):
+    return fake_controller.start(0, fixtures="DF", cache_dir=os.path.join(TOP_DIR, "cache"), **kwargs)
+
+# Fake controller shared by the tests that need no special behavior from it
+@pytest.fixture(scope="session")
+def controller():
+    srv = startController()
+    yield srv
+    srv.shutdown()
+
+# Create API clients of the LOCAL deployment on a fake controller, with
+# optional rate limit settings for its services. They are closed after the test
+@pytest.fixture
+def make_api(tmp_path, monkeypatch):
+    monkeypatch.setattr(cloudsdk, "CLOUD_CONFIG", str(tmp_path / "clouds.json"))
+    monkeypatch.setattr(cloudsdk, "CRED_CONFIG", str(tmp_path / "PRIV-creds.json"))
+    monkeypatch.setattr(cloudsdk, "CACHE_CONFIG", str(tmp_path / "PRIV-auth-cache.json"))
+    with open(cloudsdk.CRED_CONFIG, "w") as f:
+        json.dump({ 'LOCAL': { 'userId': "test", 'password': "test" } }, f)
+    apis = []
+
+    def make(srv, rate_limit = None):
+        svc = { 'host': "127.0.0.1", 'port': srv.server_address[1], 'scheme': "http" }
+        if (rate_limit != None):
+            svc['rate_limit'] = rate_limit
+        with open(cloudsdk.CLOUD_CONFIG, "w") as f:
+            json.dump({ 'LOCAL': { 'owsec': svc, 'owgw': svc, 'owprov': svc } }, f)
+        capi = cloudsdk.API(deployment="LOCAL", verbose=False, cache=cloudsdk.Cache(str(tmp_path / "cache")))
+        apis.append(capi)
+        return capi
+
+    yield make
+    for capi in apis:
+        capi.close()
+
+# API client on the shared fake controller
+@pytest.fixture
+def capi(controller, make_api):
+    return make_api(controller)
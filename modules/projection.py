@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+# Selective decoding of JSON documents. A Projection is built from a nested
+# dict of the fields to keep: None keeps a field's whole value, a dict keeps
+# only those fields of it (of each element if it is an array), and a '*' key
+# stands for any other field. Projection.loads() walks the raw document and
+# only decodes the kept values, the rest is skipped over by a regex without
+# building any objects. Objects whose kept fields are all whole values are
+# decoded in one go by the json module's C scanner and then trimmed, which is
+# faster than walking many small objects field by field.
+#
+#   p = Projection({ 'unit': None, 'radios': { 'band': None, 'channel': None } })
+#   stats = p.loads(body)
+#
+# Skipped values are only checked for balanced brackets and strings, not
+# fully validated as json.loads() would do
+
+import re
+from json.decoder import JSONDecoder, JSONDecodeError
+
+# Values nested deeper than this are skipped by decoding them instead
+PROJECTION_SKIP_DEPTH = 12
+
+WS_RE    = r'[ \t\n\r]*+'
+STRING_RE = r'"[^"\\]*+(?:\\.[^"\\]*+)*+"'
+FLAT_RE  = r'[^"\[\]{}]*+(?:%s[^"\[\]{}]*+)*+' % (STRING_RE)
+
+# Contents of an array or object nested at most depth levels deep
+def nestedPattern(depth):
+    pattern = FLAT_RE
+    for i in range(depth):
+        pattern = r'%s(?:[\[{]%s[\]}]%s)*+' % (FLAT_RE, pattern, FLAT_RE)
+    return pattern
+
+SKIP = re.compile(r'%s|[-+.0-9a-zA-Z]++|[\[{]%s[\]}]' % (STRING_RE, nestedPattern(PROJECTION_SKIP_DEPTH - 1)))
+WS   = re.compile(WS_RE)
+KEY  = re.compile(r'%s"([^"\\]*+(?:\\.[^"\\]*+)*+)"%s:%s' % (WS_RE, WS_RE, WS_RE))
+SEP  = re.compile(r'%s([,}\]])%s' % (WS_RE, WS_RE))
+
+MISSING = object()
+
+# Compile the fields to keep: None for whole values, a frozenset of the keys
+# of objects that are only trimmed, and dicts of those walked field by field
+def compileFields(fields):
+    if (fields == None):
+        return None
+    if (all([ x == None for x in fields.values() ])):
+        if ('*' in fields):
+            return None
+        return frozenset(fields.keys())
+    return { k: compileFields(v) for k, v in fields.items() }
+
+# Keep the given keys of an object, or of each object of an array
+def pickFields(value, keys):
+    if (isinstance(value, dict)):
+        return { k: v for k, v in value.items() if k in keys }
+    if (isinstance(value, list)):
+        return [ pickFields(x, keys) for x in value ]
+    return value
+
+#==================================================================================================================
+
+class Projection:
+    # Init a projection keeping the given fields (see above)
+    def __init__(self, fields):
+        self.fields = compileFields(fields)
+        self.scan = JSONDecoder().scan_once
+
+    # Decode the projection of a JSON document (str or UTF-8 bytes)
+    def loads(self, data):
+        if (isinstance(data, (bytes, bytearray))):
+            data = data.decode("utf-8")
+        try:
+            value, idx = self.value(data, WS.match(data, 0).end(), self.fields)
+        except IndexError:
+            raise JSONDecodeError("Unterminated document", data, len(data))
+        except StopIteration as e:
+            raise JSONDecodeError("Expecting value", data, e.value)
+        if (WS.match(data, idx).end() != len(data)):
+            raise JSONDecodeError("Extra data", data, idx)
+        return value
+
+    # Decode the value at idx, returning it and the index past it
+    def value(self, s, idx, fields):
+        c = s[idx]
+        if (fields == None or (c != '{' and c != '[')):
+            return self.scan(s, idx)
+        if (type(fields) is frozenset):
+            value, idx = self.scan(s, idx)
+            return pickFields(value, fields), idx
+        if (c == '['):
+            return self.array(s, idx, fields)
+        return self.object(s, idx, fields)
+
+    # Decode the array at idx, projecting each element
+    def array(self, s, idx, fields):
+        values = []
+        idx = WS.match(s, idx + 1).end()
+        if (s[idx] == ']'):
+            return values, idx + 1
+        while True:
+            value, idx = self.value(s, idx, fields)
+            values.append(value)
+            m = SEP.match(s, idx)
+            if (m == None or m.group(1) == '}'):
+                raise JSONDecodeError("Expecting ',' delimiter", s, idx)
+            idx = m.end()
+            if (m.group(1) == ']'):
+                return values, idx
+
+    # Decode the kept fields of the object at idx, skipping the others
+    def object(self, s, idx, fields):
+        values = {}
+        idx = WS.match(s, idx + 1).end()
+        if (s[idx] == '}'):
+            return values, idx + 1
+        other = fields.get('*', MISSING)
+        while True:
+            m = KEY.match(s, idx)
+            if (m == None):
+                raise JSONDecodeError("Expecting property name enclosed in double quotes", s, idx)
+            key = m.group(1)
+            if ('\\' in key):
+                key = self.scan('"%s"' % (key), 0)[0]
+            idx = m.end()
+            sub = fields.get(key, other)
+            if (sub is not MISSING):
+                values[key], idx = self.value(s, idx, sub)
+            else:
+                m = SKIP.match(s, idx)
+                if (m != None and m.end() > idx):
+                    idx = m.end()
+                else:
+                    # Nested too deep for the regex
+                    idx = self.scan(s, idx)[1]
+            m = SEP.match(s, idx)
+            if (m == None or m.group(1) == ']'):
+                raise JSONDecodeError("Expecting ',' delimiter", s, idx)
+            idx = m.end()
+            if (m.group(1) == '}'):
+                return values, idx
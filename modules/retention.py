@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+
+# Retention of collector snapshots (see collector.Manifest). Recent snapshots
+# are kept as written. Older ones are compacted into one zstd Parquet archive
+# per table per day, under <outdir>/archive/<table>/day=YYYY-MM-DD.parquet,
+# and older days again into one per month (month=YYYY-MM.parquet). Archived
+# rows are tagged with their snapshot, and the manifest points each snapshot
+# at its archive, so Manifest.read_table() and read_range() keep working on
+# compacted history. A snapshot's anomaly report (see anomaly.py) is kept
+# until the snapshot goes into a month archive
+
+import os
+import json
+import csv
+import tempfile
+from datetime import datetime, timedelta
+
+from modules import collector
+from modules.collector import pyarrow, TABLES
+from modules.anomaly import ANOMALY_DIR
+
+if (pyarrow != None):
+    import pyarrow.compute
+
+# Default policy: keep snapshots as written for full_days, then in day
+# archives until day_days, then in month archives, which are dropped after
+# keep_months (None keeps them forever)
+RETENTION = { 'full_days': 7, 'day_days': 60, 'keep_months': None }
+ARCHIVE_DIR = "archive"
+ARCHIVE_COMPRESSION = "zstd"
+
+# Arrow schema of a table's archive: the snapshot schema, tagged
+def archiveSchema(name):
+    fields = [ pyarrow.field('snapshot', pyarrow.string()), pyarrow.field('snapshot_time', pyarrow.timestamp('s')) ]
+    return pyarrow.schema(fields + list(collector.tableSchema(name)))
+
+# Load a table of a snapshot as written (from Parquet, NDJSON, JSON or CSV,
+# whichever there is) as an archive Table
+def loadSnapshotTable(manifest, snapshot, name):
+    files = snapshot['tables'][name]['files']
+    schema = archiveSchema(name)
+    if ('parquet' in files):
+        table = pyarrow.parquet.read_table(manifest.file(snapshot, name, "parquet"))
+        snaps = pyarrow.array([ snapshot['prefix'] ] * table.num_rows, pyarrow.string())
+        times = pyarrow.array([ datetime.fromisoformat(snapshot['time']) ] * table.num_rows, pyarrow.timestamp('s'))
+        return table.add_column(0, 'snapshot', snaps).add_column(1, 'snapshot_time', times).cast(schema)
+
+    if ('ndjson' in files):
+        with open(manifest.file(snapshot, name, "ndjson")) as f:
+            records = [ json.loads(line) for line in f ]
+    elif ('json' in files):
+        with open(manifest.file(snapshot, name, "json")) as f:
+            records = json.load(f)
+    else:
+        with open(manifest.file(snapshot, name, "csv")) as f:
+            records = list(csv.DictReader(f))
+    columns = { 'snapshot': [ snapshot['prefix'] ] * len(records),
+                'snapshot_time': [ datetime.fromisoformat(snapshot['time']) ] * len(records) }
+    for field in TABLES[name]:
+        ctype = collector.COLUMN_TYPES.get(field, "string")
+        columns[field] = [ collector.columnValue(rec.get(field), ctype) for rec in records ]
+    return pyarrow.Table.from_pydict(columns, schema=schema)
+
+# Write an archive Table under a temp name and rename it into place
+def writeArchive(fn, table):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".archive.", suffix=".tmp")
+    os.close(fd)
+    try:
+        pyarrow.parquet.write_table(table, tmp_fn, compression=ARCHIVE_COMPRESSION)
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        os.unlink(tmp_fn)
+        raise
+
+# Add rows to an archive, replacing any rows it already has from the same
+# snapshots (so re-running after an interrupted compaction is safe)
+def appendArchive(fn, name, tables):
+    prefixes = set()
+    for table in tables:
+        prefixes.update(table.column('snapshot').unique().to_pylist())
+    if (os.path.exists(fn)):
+        old = pyarrow.parquet.read_table(fn).cast(archiveSchema(name))
+        keep = pyarrow.compute.invert(pyarrow.compute.is_in(old.column('snapshot'), value_set=pyarrow.array(list(prefixes), pyarrow.string())))
+        tables = [ old.filter(keep) ] + tables
+    table = pyarrow.concat_tables(tables).sort_by([ ('snapshot_time', "ascending") ])
+    writeArchive(fn, table)
+    return table.num_rows
+
+#==================================================================================================================
+
+class Retention:
+    # Init retention for an output dir, with a policy (see RETENTION)
+    def __init__(self, outdir, policy = None, verbose = True):
+        if (pyarrow == None):
+            raise Exception("[retention] Error: compacting snapshots requires pyarrow")
+        self.outdir   = outdir
+        self.manifest = collector.Manifest(outdir)
+        self.policy   = dict(RETENTION)
+        self.policy.update(policy or {})
+        self.verbose  = verbose
+        self.stats    = { 'snapshots': 0, 'days': 0, 'months': 0, 'expired': 0, 'files_removed': 0,
+                          'bytes_before': 0, 'bytes_after': 0 }
+
+    def log(self, msg):
+        if (self.verbose):
+            print("[retention] " + msg)
+
+    # Path of an archive, relative to the output dir
+    def archivePath(self, name, period, key):
+        return os.path.join(ARCHIVE_DIR, name, "%s=%s.parquet" % (period, key))
+
+    # Total size of the files and archives the manifest lists
+    def diskUsage(self, manifest):
+        size = 0
+        for snapshot in manifest['snapshots']:
+            for ent in snapshot['tables'].values():
+                for f in ent.get('files', {}).values():
+                    size += f['size']
+        for a in manifest.get('archives', {}).values():
+            size += a['size']
+        return size
+
+    # Record an archive in the manifest
+    def addArchive(self, manifest, path, rows):
+        fn = os.path.join(self.outdir, path)
+        manifest.setdefault('archives', {})[path] = { 'rows': rows, 'size': os.path.getsize(fn),
+                                                      'sha256': collector.fileChecksum(fn) }
+
+    # Compact snapshots older than full_days into day archives. The latest
+    # snapshot is always kept as written. Returns the files to remove
+    def compactDays(self, manifest, now):
+        cutoff = (now - timedelta(days=self.policy['full_days'])).timestamp()
+        snapshots = manifest['snapshots']
+        by_day = {}
+        for snapshot in snapshots[:-1]:
+            if (snapshot.get('compacted') or snapshot['timestamp'] >= cutoff):
+                continue
+            day = snapshot['time'][:10]
+            by_day.setdefault(day, []).append(snapshot)
+
+        remove = []
+        for day, day_snapshots in sorted(by_day.items()):
+            for name in TABLES.keys():
+                tables = [ loadSnapshotTable(self.manifest, x, name) for x in day_snapshots if name in x['tables'] ]
+                if (len(tables) == 0):
+                    continue
+                path = self.archivePath(name, "day", day)
+                rows = appendArchive(os.path.join(self.outdir, path), name, tables)
+                self.addArchive(manifest, path, rows)
+                for x in day_snapshots:
+                    if (name in x['tables']):
+                        for ext in x['tables'][name]['files'].keys():
+                            remove.append(self.manifest.file(x, name, ext))
+                        x['tables'][name] = { 'rows': x['tables'][name]['rows'], 'archive': path }
+            for x in day_snapshots:
+                x['compacted'] = "day"
+            self.stats['snapshots'] += len(day_snapshots)
+            self.stats['days'] += 1
+            self.log("-> Compacted %d snapshots of %s into day archives" % (len(day_snapshots), day))
+        return remove
+
+    # Merge day archives older than day_days into month archives. Returns the
+    # files to remove
+    def compactMonths(self, manifest, now):
+        cutoff = (now - timedelta(days=self.policy['day_days'])).strftime("%Y-%m-%d")
+        by_month = {}
+        for snapshot in manifest['snapshots']:
+            if (snapshot.get('compacted') == "day" and snapshot['time'][:10] < cutoff):
+                by_month.setdefault(snapshot['time'][:7], []).append(snapshot)
+
+        remove = []
+        for month, month_snapshots in sorted(by_month.items()):
+            for name in TABLES.keys():
+                days = sorted(set([ x['tables'][name]['archive'] for x in month_snapshots if name in x['tables'] ]))
+                if (len(days) == 0):
+                    continue
+                tables = []
+                for day in days:
+                    table = pyarrow.parquet.read_table(os.path.join(self.outdir, day)).cast(archiveSchema(name))
+                    # A day archive may also hold snapshots still within day_days
+                    prefixes = [ x['prefix'] for x in month_snapshots if x['tables'].get(name, {}).get('archive') == day ]
+                    tables.append(table.filter(pyarrow.compute.is_in(table.column('snapshot'), value_set=pyarrow.array(prefixes, pyarrow.string()))))
+                path = self.archivePath(name, "month", month)
+                rows = appendArchive(os.path.join(self.outdir, path), name, tables)
+                self.addArchive(manifest, path, rows)
+                for x in month_snapshots:
+                    if (name in x['tables']):
+                        x['tables'][name]['archive'] = path
+            for x in month_snapshots:
+                x['compacted'] = "month"
+            self.stats['months'] += 1
+            self.log("-> Merged %d snapshots of %s into month archives" % (len(month_snapshots), month))
+
+        # Day archives no snapshot points at any more
+        used = set([ ent['archive'] for x in manifest['snapshots'] for ent in x['tables'].values() if 'archive' in ent ])
+        for path in list(manifest.get('archives', {}).keys()):
+            if (path not in used):
+                del manifest['archives'][path]
+                remove.append(os.path.join(self.outdir, path))
+        return remove
+
+    # Drop month archives (and their snapshots) older than keep_months
+    def expire(self, manifest, now):
+        if (self.policy['keep_months'] == None):
+            return []
+        month = now.year * 12 + now.month - 1 - self.policy['keep_months']
+        cutoff = "%04d-%02d" % (month // 12, month % 12 + 1)
+        expired = [ x for x in manifest['snapshots'] if x.get('compacted') == "month" and x['time'][:7] < cutoff ]
+        if (len(expired) == 0):
+            return []
+        prefixes = set([ x['prefix'] for x in expired ])
+        manifest['snapshots'] = [ x for x in manifest['snapshots'] if x['prefix'] not in prefixes ]
+        self.stats['expired'] += len(expired)
+        self.log("-> Expired %d snapshots from before %s" % (len(expired), cutoff))
+
+        remove = []
+        used = set([ ent['archive'] for x in manifest['snapshots'] for ent in x['tables'].values() if 'archive' in ent ])
+        for path in list(manifest.get('archives', {}).keys()):
+            if (path not in used):
+                del manifest['archives'][path]
+                remove.append(os.path.join(self.outdir, path))
+        return remove
+
+    # Anomaly reports of the snapshots (of prefixes) that are now in month
+    # archives or expired. Returns the files to remove
+    def anomalyReports(self, manifest, prefixes):
+        kept = set([ x['prefix'] for x in manifest['snapshots'] if x.get('compacted') != "month" ])
+        return [ os.path.join(self.outdir, ANOMALY_DIR, x + ".csv") for x in prefixes if x not in kept ]
+
+    # Apply the policy. The manifest is updated (atomically, under its lock)
+    # before any file is removed, so an interrupted run never leaves the
+    # manifest pointing at missing data
+    def run(self, now = None):
+        if (now == None):
+            now = datetime.now()
+        remove = []
+        def apply(manifest):
+            self.stats['bytes_before'] = self.diskUsage(manifest)
+            prefixes = [ x['prefix'] for x in manifest['snapshots'] ]
+            remove.extend(self.compactDays(manifest, now))
+            remove.extend(self.compactMonths(manifest, now))
+            remove.extend(self.expire(manifest, now))
+            remove.extend(self.anomalyReports(manifest, prefixes))
+            self.stats['bytes_after'] = self.diskUsage(manifest)
+        self.manifest.update(apply)
+
+        for fn in remove:
+            if (os.path.exists(fn)):
+                os.unlink(fn)
+                self.stats['files_removed'] += 1
+        self.log("-> %s: %.1f MB -> %.1f MB, %d files removed" % (self.outdir, self.stats['bytes_before'] / 1e6,
+                                                                 self.stats['bytes_after'] / 1e6, self.stats['files_removed']))
+        return self.stats
+
+# Apply a retention policy to an output dir, returns the stats
+def compact(outdir, policy = None, now = None, verbose = True):
+    return Retention(outdir, policy, verbose).run(now)
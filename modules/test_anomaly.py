@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+# Tests of the anomaly detection: the vectorized baselines must match
+# scoring each device on its own, and a run's anomalies must be reported
+
+import os
+import math
+import numpy
+import pandas
+import pytest
+
+from modules import collector, anomaly
+from modules.anomaly import AnomalyDetector, ANOMALY_METRICS, ANOMALY_MIN_STD
+
+pytestmark = pytest.mark.skipif(collector.pyarrow == None, reason="anomaly detection requires pyarrow")
+
+# Device x metric matrix with the given values of some metrics, the others unknown
+def matrix(values):
+    df = pandas.DataFrame(index=pandas.Index(list(values.keys()), name='mac'), columns=ANOMALY_METRICS, dtype="float64")
+    for mac, metrics in values.items():
+        for m, v in metrics.items():
+            df.loc[mac, m] = v
+    return df
+
+# EWMA mean and variance of a series, one sample at a time, as the detector
+# keeps them
+def ewma(series, alpha):
+    mean, var = 0.0, 0.0
+    for n, x in enumerate(series):
+        a = max(alpha, 1.0 / (n + 1))
+        delta = x - mean
+        mean += a * delta
+        var = (1 - a) * (var + a * delta * delta)
+    return mean, var
+
+CPU = [ 20, 25, 18, 30, 22, 27, 19, 24, 21, 26, 23, 28, 20, 22 ]
+MEM = [ 40, 41, 39, 40, 42, 38, 40, 41, 39, 40, 40, 41, 39, 40 ]
+
+def test_baselines(tmp_path):
+    det = AnomalyDetector(str(tmp_path), alpha=0.1, warmup=5)
+    for cpu, mem in zip(CPU, MEM):
+        found = det.score(matrix({ 'a1': { 'cpu_busy_pct': cpu, 'mem_used_pct': mem }, 'a2': { 'cpu_busy_pct': mem } }))
+        assert (len(found) == 0)
+    # Until 1/n drops below alpha these are the plain mean and variance
+    assert (math.isclose(ewma(CPU[:10], 0.1)[0], numpy.mean(CPU[:10])))
+    assert (math.isclose(ewma(CPU[:10], 0.1)[1], numpy.var(CPU[:10])))
+    mean, var = ewma(CPU, 0.1)
+    assert (math.isclose(det.mean.loc['a1', 'cpu_busy_pct'], mean) and math.isclose(det.var.loc['a1', 'cpu_busy_pct'], var))
+    assert (math.isclose(det.mean.loc['a2', 'cpu_busy_pct'], ewma(MEM, 0.1)[0]))
+    # Unknown metrics are not counted
+    assert (det.n.loc['a1', 'cpu_busy_pct'] == len(CPU) and det.n.loc['a2', 'mem_used_pct'] == 0)
+    assert (numpy.isnan(det.mean.loc['a2', 'mem_used_pct']))
+
+def test_z_scores(tmp_path):
+    det = AnomalyDetector(str(tmp_path), alpha=0.1, warmup=5)
+    for cpu, mem in zip(CPU, MEM):
+        det.score(matrix({ 'a1': { 'cpu_busy_pct': cpu, 'mem_used_pct': mem }, 'a2': { 'cpu_busy_pct': cpu } }))
+    mean, var = ewma(CPU, 0.1)
+    mem_mean, mem_var = ewma(MEM, 0.1)
+    info = pandas.DataFrame({ 'name': [ "ap-1", "ap-2" ] }, index=pandas.Index([ "a1", "a2" ], name='mac'))
+    found = det.score(matrix({ 'a1': { 'cpu_busy_pct': 95, 'mem_used_pct': 60 }, 'a2': { 'cpu_busy_pct': 30 } }), info)
+
+    # Largest |z| first, with the std floored where the metric barely moved
+    cpu_z = (95 - mean) / max(math.sqrt(var), ANOMALY_MIN_STD['cpu_busy_pct'])
+    mem_z = (60 - mem_mean) / max(math.sqrt(mem_var), ANOMALY_MIN_STD['mem_used_pct'])
+    assert (math.sqrt(mem_var) < ANOMALY_MIN_STD['mem_used_pct'])
+    assert (found[[ 'mac', 'metric', 'name' ]].values.tolist() == [ [ "a1", "cpu_busy_pct", "ap-1" ], [ "a1", "mem_used_pct", "ap-1" ] ])
+    assert (numpy.allclose(found['z'], [ cpu_z, mem_z ]) and cpu_z > mem_z > anomaly.ANOMALY_Z)
+    assert (math.isclose(found['baseline'][0], mean) and found['value'][0] == 95)
+
+def test_warmup(tmp_path):
+    for samples, flagged in [ (2, 0), (3, 1) ]:
+        det = AnomalyDetector(str(tmp_path), warmup=3)
+        for i in range(samples):
+            det.score(matrix({ 'a1': { 'cpu_busy_pct': 10 } }))
+        # Only scored once the baseline has warmup samples
+        assert (len(det.score(matrix({ 'a1': { 'cpu_busy_pct': 90 } }))) == flagged)
+
+def test_vectorized(tmp_path):
+    # Scoring many devices at once gives each the scores it would get alone
+    rnd = numpy.random.default_rng(5)
+    values = rnd.normal(50, 10, (15, 20, len(ANOMALY_METRICS)))
+    values[rnd.random(values.shape) < 0.1] = numpy.nan
+    runs = [ { "d%02d" % i: { m: v for m, v in zip(ANOMALY_METRICS, row) if not numpy.isnan(v) } for i, row in enumerate(run) }
+             for run in values ]
+    runs[-1]['d07']['busy_pct_5g'] = 500
+    together = AnomalyDetector(str(tmp_path / "a"), warmup=5)
+    for run in runs:
+        found = together.score(matrix(run))
+    assert (("d07", "busy_pct_5g") in [ tuple(x) for x in found[[ 'mac', 'metric' ]].values.tolist() ])
+    for mac in [ "d00", "d07", "d19" ]:
+        alone = AnomalyDetector(str(tmp_path / mac), warmup=5)
+        for run in runs:
+            found_alone = alone.score(matrix({ mac: run[mac] }))
+        pandas.testing.assert_series_equal(alone.mean.loc[mac], together.mean.loc[mac])
+        pandas.testing.assert_series_equal(alone.var.loc[mac], together.var.loc[mac])
+        pandas.testing.assert_frame_equal(found_alone, found[found['mac'] == mac].reset_index(drop=True))
+
+def test_save_load(tmp_path):
+    det = AnomalyDetector(str(tmp_path))
+    for cpu in CPU:
+        det.score(matrix({ 'a1': { 'cpu_busy_pct': cpu }, 'a2': { 'num_assocs': cpu } }))
+    det.save()
+    loaded = AnomalyDetector(str(tmp_path))
+    pandas.testing.assert_frame_equal(loaded.mean, det.mean, check_names=False)
+    pandas.testing.assert_frame_equal(loaded.var, det.var, check_names=False)
+    pandas.testing.assert_frame_equal(loaded.n, det.n, check_names=False)
+
+def test_run_snapshot(capi, tmp_path):
+    outdir = str(tmp_path)
+    coll = collector.collect("LOCAL", outdir=outdir, capi=capi, verbose=False, keep=True, json_arrays=False)
+    for i in range(3):
+        assert (len(AnomalyDetector(outdir, warmup=3).run_snapshot(coll.prefix)) == 0)
+    det = AnomalyDetector(outdir, warmup=3)
+    assert (len(det.n) == len(coll.online_devices))
+    assert (not os.path.exists(os.path.join(outdir, anomaly.ANOMALY_DIR)))
+
+    # Baselines far below every device's CPU
+    det.mean['cpu_busy_pct'] -= 100
+    found = det.run_snapshot(coll.prefix)
+    busy = [ x for x in coll.online_devices if x['cpu_busy_pct'] >= 0 ]
+    assert (sorted(found['mac']) == sorted([ x['mac'] for x in busy ]) and set(found['metric']) == { "cpu_busy_pct" })
+    assert ([ x for x in [ 'name', 'org', 'venue' ] if x not in found.columns ] == [])
+    report = pandas.read_csv(os.path.join(outdir, anomaly.ANOMALY_DIR, os.path.basename(coll.prefix) + ".csv"))
+    assert (report['mac'].tolist() == found['mac'].tolist())
@@ -0,0 +1,475 @@
+#!/usr/bin/python3
+
+# Tests of the cloudsdk API client, mostly against the fake controller
+
+import io
+import os
+import re
+import json
+import time
+import gzip
+import socket
+import threading
+import http.client
+import pytest
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+from modules import cloudsdk
+from modules.cloudsdk import ConnectionPool, RateLimiter, Cache, read_body, parse_retry_after
+from conftest import startController
+
+# Close, from the client side, the write half of the pool's idle
+# connections: the server sees the end of the stream and closes them, as it
+# would an idle connection it timed out
+def dropIdle(pool):
+    for conn, last_used in pool.idle:
+        conn.sock.shutdown(socket.SHUT_WR)
+    time.sleep(0.1)
+
+# Server that reads each request and closes the connection without an answer.
+# Returns the listening socket and the list of accepted connections
+def droppingServer():
+    lsock = socket.socket()
+    lsock.bind(("127.0.0.1", 0))
+    lsock.listen()
+    accepted = []
+    def serve():
+        while (True):
+            try:
+                sock, addr = lsock.accept()
+            except OSError:
+                return
+            accepted.append(addr)
+            sock.recv(65536)
+            sock.close()
+    threading.Thread(target=serve, daemon=True).start()
+    return lsock, accepted
+
+def test_pool_reuses_connections(controller, make_api):
+    capi = make_api(controller)
+    before = controller.get_stats()['connections']
+    for i in range(20):
+        assert (capi.get_device_count() == len(controller.devices))
+    stats = capi.get_pool_stats()['owgw']
+    assert (stats['connects'] == 1 and stats['reuses'] == 19 and stats['resets'] == 0)
+    assert (controller.get_stats()['connections'] - before == 1)
+
+def test_pool_skips_closed_idle_connections(controller, make_api):
+    capi = make_api(controller)
+    capi.get_device_count()
+    dropIdle(capi.pools['owgw'])
+    # Found closed before a request was sent on it: nothing to replay
+    assert (capi.get_device_count() == len(controller.devices))
+    assert (capi.get_pool_stats()['owgw'] == { 'connects': 2, 'reuses': 0, 'resets': 0, 'idle': 1 })
+
+def test_pool_idle_time():
+    pool = ConnectionPool("127.0.0.1", 1, idle_time=0.05)
+    conn = http.client.HTTPConnection("127.0.0.1", 1)
+    assert (not pool.is_healthy(conn, time.monotonic()))
+    conn.sock = socket.socket()
+    try:
+        assert (not pool.is_healthy(conn, time.monotonic() - 1))
+    finally:
+        conn.sock.close()
+
+def test_pool_replays_get_on_reset(controller, make_api, monkeypatch):
+    capi = make_api(controller)
+    capi.get_device_count()
+    pool = capi.pools['owgw']
+    # Closed by the server, but not yet seen to be
+    monkeypatch.setattr(pool, "is_healthy", lambda conn, last_used: True)
+    dropIdle(pool)
+    assert (capi.get_device_count() == len(controller.devices))
+    stats = capi.get_pool_stats()['owgw']
+    assert (stats['resets'] == 1 and stats['connects'] == 2)
+
+@pytest.mark.parametrize("method,conns", [ ("GET", 2), ("POST", 1) ])
+def test_pool_replays_only_gets_once_sent(make_api, controller, monkeypatch, method, conns):
+    capi = make_api(controller)
+    lsock, accepted = droppingServer()
+    try:
+        pool = ConnectionPool("127.0.0.1", lsock.getsockname()[1], use_ssl=False)
+        monkeypatch.setattr(pool, "is_healthy", lambda conn, last_used: True)
+        conn = pool.new_conn()
+        conn.connect()
+        pool.release(conn)
+        capi.pools['owgw'] = pool
+        # The reused connection is dropped after the request was sent: a GET
+        # is tried again on a new connection, a POST is not
+        with pytest.raises(cloudsdk.CONN_RESET_ERRORS):
+            capi.api_call("owgw", method, "/api/v1/devices?countOnly=true")
+        time.sleep(0.1)
+        assert (len(accepted) == conns)
+        assert (pool.get_stats()['resets'] == conns)
+    finally:
+        lsock.close()
+
+#==================================================================================================================
+
+# Page function over range(total) whose pages take longer the earlier they
+# are, so they complete in reverse order
+def slowPages(total, failed = None):
+    def page_fn(limit, offset):
+        time.sleep(0.02 * (total - offset) / cloudsdk.GET_LIMIT)
+        if (offset == failed):
+            return None
+        return list(range(offset, min(offset + limit, total)))
+    return page_fn
+
+def test_iter_pages_order(capi, capsys):
+    total = cloudsdk.GET_LIMIT * 7 + 3
+    pages = list(capi.iter_pages("things", None, slowPages(total), count=total))
+    assert ([ x for page in pages for x in page ] == list(range(total)))
+    lines = capsys.readouterr().out.splitlines()
+    # Progress lines are whole, and in offset order
+    assert (lines[0].startswith("[cloudsdk] -> Loading things: %d total" % total))
+    starts = [ int(x.split()[4]) for x in lines[1:] ]
+    assert (starts == list(range(1, total + 1, cloudsdk.GET_LIMIT)))
+    assert (all([ x.endswith(" ms)") for x in lines[1:] ]))
+
+def test_iter_pages_concurrent_output(capi, capsys):
+    # As ProvData loads its collections, each line stays whole
+    total = cloudsdk.GET_LIMIT * 8
+    threads = [ threading.Thread(target=lambda x: list(capi.iter_pages(x, None, slowPages(total), count=total)), args=(x,))
+                for x in [ "inventory", "venues", "entities" ] ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    lines = capsys.readouterr().out.splitlines()
+    assert (len(lines) == 3 * 9)
+    assert (all([ re.fullmatch(r"\[cloudsdk\]    -> Fetching \w+ +\d+ to +\d+\.\.\.\.done \(took +\d+ ms\)", x) or
+                  re.fullmatch(r"\[cloudsdk\] -> Loading \w+: \d+ total, fetching \d+ at a time", x) for x in lines ]))
+
+def test_iter_pages_limit(capi):
+    total = cloudsdk.GET_LIMIT * 3
+    pages = list(capi.iter_pages("things", lambda: total, slowPages(total), verbose=False, limit=100))
+    assert ([ x for page in pages for x in page ] == list(range(100)))
+
+def test_iter_pages_stops_on_failed_page(capi):
+    total = cloudsdk.GET_LIMIT * 6
+    pages = list(capi.iter_pages("things", None, slowPages(total, failed=cloudsdk.GET_LIMIT * 2), verbose=False, count=total))
+    assert (len(pages) == 3 and pages[-1] == None)
+    with pytest.raises(Exception):
+        list(capi.iter_records("things", None, slowPages(total, failed=0), verbose=False, count=total))
+
+def test_iter_devices(controller, capi):
+    assert ([ x['serialNumber'] for x in capi.iter_devices(verbose=False) ] == [ x['serialNumber'] for x in controller.devices ])
+    assert (capi.load_all_devices(verbose=False, no_cache=True) == controller.devices)
+
+#==================================================================================================================
+
+def test_retry_after_seconds():
+    assert (parse_retry_after("2") == 2)
+    assert (parse_retry_after("0.25") == 0.25)
+    assert (parse_retry_after("-5") == 0)
+
+def test_retry_after_http_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert (28 <= parse_retry_after(format_datetime(when, usegmt=True)) <= 30)
+    when = datetime.now(timezone.utc) - timedelta(seconds=30)
+    assert (parse_retry_after(format_datetime(when, usegmt=True)) == 0)
+
+def test_retry_after_missing_or_bad():
+    assert (parse_retry_after(None) == None)
+    assert (parse_retry_after("") == None)
+    assert (parse_retry_after("soon") == None)
+
+def test_limiter_adapts_rate():
+    limiter = RateLimiter(rate=8, burst=1, min_rate=1, max_rate=10, step=1)
+    limiter.on_throttle()
+    assert (limiter.rate == 4)
+    for i in range(5):
+        limiter.on_throttle()
+    assert (limiter.rate == 1)
+    for i in range(20):
+        limiter.on_success()
+    assert (limiter.rate == 10)
+    assert (limiter.get_stats()['throttled'] == 6)
+
+def test_limiter_spaces_calls():
+    limiter = RateLimiter(rate=50, burst=1, min_rate=1, max_rate=50, step=0)
+    start_tm = time.monotonic()
+    for i in range(6):
+        limiter.acquire()
+    # The first token is the burst, the others come 20 ms apart
+    assert (time.monotonic() - start_tm >= 0.09)
+
+def test_limiter_blocks_for_retry_after():
+    limiter = RateLimiter(rate=1000, burst=10, min_rate=1000, max_rate=1000, step=0)
+    limiter.on_throttle(0.2)
+    start_tm = time.monotonic()
+    limiter.acquire()
+    assert (time.monotonic() - start_tm >= 0.19)
+    assert (limiter.get_stats()['waited'] >= 0.19)
+
+def test_api_retries_throttled_calls(make_api):
+    # A few requests/sec get through, the others are answered 429 with a
+    # Retry-After the client must honor
+    srv = startController(rate_limit=20)
+    try:
+        capi = make_api(srv, rate_limit={ 'rate': 100, 'burst': 100, 'max_rate': 100 })
+        for i in range(40):
+            assert (capi.get_device_count() == len(srv.devices))
+        assert (srv.get_stats()['throttled'] > 0)
+        assert (capi.limiters['owgw'].get_stats()['throttled'] > 0)
+        assert (capi.limiters['owgw'].rate < 100)
+    finally:
+        srv.shutdown()
+
+def test_api_gives_up_after_retries(make_api, monkeypatch):
+    srv = startController()
+    try:
+        capi = make_api(srv)
+        srv.error_rate = 1
+        monkeypatch.setattr(cloudsdk, "RATE_RETRIES", 2)
+        resp = capi.api_call("owgw", "GET", "/api/v1/devices?countOnly=true")
+        assert (resp['ErrorCode'] == 500)
+        # The first try and 2 retries
+        assert (srv.get_stats()['errors'] == 3)
+    finally:
+        srv.shutdown()
+
+#==================================================================================================================
+
+# Make a cache entry look age secs old
+def ageEntry(cache, key, age):
+    when = time.time() - age
+    os.utime(cache.path(key, "bin"), (when, when))
+
+def test_cache_roundtrip(tmp_path):
+    cache = Cache(str(tmp_path))
+    data = { 'devices': [ { 'mac': "903cb3bb1d4b", 'connected': True, 'load': 0.5 } ], 'count': 1 }
+    cache.put("DF-Devices", data)
+    with open(cache.path("DF-Devices", "bin"), "rb") as f:
+        assert (f.read().startswith(cloudsdk.CACHE_MAGIC))
+    got, age = Cache(str(tmp_path)).get("DF-Devices")
+    assert (got == data and 0 <= age < 5)
+    assert (cache.get("DF-ProvData") == (None, None))
+
+def test_cache_lru(tmp_path):
+    cache = Cache(str(tmp_path), lru_size=2)
+    for key in [ "a", "b", "c" ]:
+        cache.put(key, [ key ])
+    assert (list(cache.lru.keys()) == [ "b", "c" ])
+    # Served from memory while the file is unchanged, reloaded once it is not
+    assert (cache.get("b")[0] is cache.get("b")[0])
+    assert (cache.get("a")[0] == [ "a" ] and list(cache.lru.keys()) == [ "b", "a" ])
+    Cache(str(tmp_path)).put("b", [ "new" ])
+    ageEntry(cache, "b", 10)
+    assert (cache.get("b")[0] == [ "new" ])
+
+def test_cache_bad_files(tmp_path):
+    cache = Cache(str(tmp_path))
+    with open(cache.path("a", "bin"), "wb") as f:
+        f.write(b"not a cache file")
+    with open(cache.path("b", "bin"), "wb") as f:
+        f.write(cloudsdk.CACHE_MAGIC + b"not zlib")
+    assert (cache.get("a") == (None, None) and cache.get("b") == (None, None))
+
+def test_cache_reads_json(tmp_path):
+    # As written by older versions
+    with open(tmp_path / "DF-Devices.json", "w") as f:
+        json.dump([ { 'mac': "a" } ], f)
+    assert (Cache(str(tmp_path)).get("DF-Devices")[0] == [ { 'mac': "a" } ])
+
+# Revalidate function returning data, counting its calls
+def revalidator(data):
+    calls = []
+    def revalidate():
+        calls.append(threading.current_thread())
+        return data
+    return revalidate, calls
+
+# Wait for the background cache reloads to finish
+def waitReloads():
+    for t in threading.enumerate():
+        if (t != threading.current_thread() and not t.daemon):
+            t.join()
+
+def test_load_cache_fresh(capi):
+    capi.save_cache("Devices", [ 1 ])
+    revalidate, calls = revalidator([ 2 ])
+    assert (capi.load_cache("Devices", revalidate) == [ 1 ])
+    waitReloads()
+    assert (calls == [])
+
+def test_load_cache_stale_while_revalidate(capi):
+    capi.save_cache("Devices", [ 1 ])
+    key = "LOCAL-Devices"
+    ageEntry(capi.cache, key, cloudsdk.CACHE_TTL['Devices'] + 10)
+    revalidate, calls = revalidator([ 2 ])
+    # The stale entry is returned, and reloaded once in the background
+    assert (capi.load_cache("Devices", revalidate) == [ 1 ])
+    waitReloads()
+    assert (len(calls) == 1 and calls[0] != threading.current_thread())
+    assert (capi.load_cache("Devices", revalidate) == [ 2 ])
+    assert (key not in capi.cache.reloading)
+
+def test_load_cache_too_stale(capi):
+    capi.save_cache("Devices", [ 1 ])
+    ageEntry(capi.cache, "LOCAL-Devices", cloudsdk.CACHE_TTL['Devices'] + cloudsdk.CACHE_STALE['Devices'] + 10)
+    revalidate, calls = revalidator([ 2 ])
+    assert (capi.load_cache("Devices", revalidate) == None)
+    # Past the TTL, stale data is only served to callers that revalidate it
+    assert (capi.load_cache("Devices") == None)
+    # or that opt in to a longer window
+    assert (capi.load_cache("Devices", revalidate, max_stale=86400) == [ 1 ])
+    waitReloads()
+    assert (len(calls) == 1)
+
+def test_provdata_cache(controller, capi):
+    pdata = cloudsdk.ProvData(capi, verbose=False)
+    assert (len(pdata.inventory) == len(controller.inventory))
+    requests = controller.get_stats()['requests']
+    cached = cloudsdk.ProvData(capi, verbose=False)
+    assert (cached.inventory == pdata.inventory and cached.venues == pdata.venues)
+    assert (controller.get_stats()['requests'] == requests)
+
+#==================================================================================================================
+
+# Stands in for an http.client response
+class FakeResponse(io.BytesIO):
+    def __init__(self, data, encoding = None):
+        super().__init__(data)
+        self.encoding = encoding
+
+    def getheader(self, name, default = None):
+        if (name == 'Content-Encoding' and self.encoding != None):
+            return self.encoding
+        return default
+
+def test_read_body():
+    data = json.dumps([ { 'mac': "%012x" % i } for i in range(100) ]).encode()
+    assert (read_body(FakeResponse(data)) == (data, len(data)))
+    compressed = gzip.compress(data)
+    res = FakeResponse(compressed, "GZIP")
+    assert (read_body(res) == (data, len(compressed)))
+    # Read to the end, so the connection can take the next request
+    assert (res.read() == b"")
+
+def test_read_body_bad_gzip():
+    with pytest.raises(OSError):
+        read_body(FakeResponse(b"not gzip", "gzip"))
+
+def test_api_gzip(controller, capi):
+    devices = capi.load_all_devices(verbose=False, no_cache=True)
+    assert (devices == controller.devices)
+    stats = capi.get_transfer_stats()['owgw']
+    assert (stats['wire_bytes'] < stats['body_bytes'] / 2 and stats['ratio'] < 0.5)
+    # Small bodies come uncompressed, on a kept-alive connection
+    connects = capi.get_pool_stats()['owgw']['connects']
+    assert (capi.get_device_count() == len(devices))
+    stats = capi.get_pool_stats()['owgw']
+    assert (stats['connects'] == connects and stats['resets'] == 0)
+
+#==================================================================================================================
+
+# Targets for bulk commands: the first n devices, then the given unknown MACs
+def bulkTargets(controller, n, unknown = []):
+    return [ { 'mac': x['serialNumber'] } for x in controller.devices[:n] ] + [ { 'mac': x } for x in unknown ]
+
+# Start function issuing commands on the fake controller that complete after
+# delay secs
+def delayedCommands(controller, delay):
+    def start(target):
+        cmd = controller.new_command(target['mac'], "upgrade", delay)
+        return { 'UUID': cmd['UUID'], 'resultCode': 0, 'text': "Success" }
+    return start
+
+FAST_POLL = { 'interval': 0.02, 'factor': 2, 'max_interval': 0.1, 'timeout': 10 }
+
+# Fake controller whose commands complete in about 0.1 s
+@pytest.fixture(scope="module")
+def fast_controller():
+    srv = startController(cmd_time=0.1)
+    yield srv
+    srv.shutdown()
+
+def test_bulk_waves(fast_controller, make_api):
+    controller = fast_controller
+    capi = make_api(controller)
+    bulk = capi.bulk_update_fw(bulkTargets(controller, 15), "http://fw/fw.bin", window=3, waves=[ 1, 4 ],
+                               poll_conf=FAST_POLL, verbose=False)
+    assert ([ x['wave'] for x in bulk.results ] == [ 1 ] + [ 2 ] * 4 + [ 3 ] * 10)
+    assert ([ x['mac'] for x in bulk.results ] == [ x['serialNumber'] for x in controller.devices[:15] ])
+    assert (all([ x['state'] == "completed" and x['uuid'] and x['polls'] > 0 for x in bulk.results ]))
+    stats = bulk.get_stats()
+    assert (stats['completed'] == 15 and not stats['aborted'] and stats['poll_calls'] >= 15)
+    assert (stats['p50_secs'] <= stats['p90_secs'] <= stats['max_secs'])
+
+def test_bulk_window(controller, capi):
+    # Commands started and not yet finished, and the most there were at once
+    inflight = set()
+    most = [ 0 ]
+    lock = threading.Lock()
+    start = delayedCommands(controller, 0.05)
+    def counted(target):
+        with lock:
+            inflight.add(target['mac'])
+            most[0] = max(most[0], len(inflight))
+        return start(target)
+    bulk = cloudsdk.BulkCommand(capi, "test", counted, window=4, waves=[], poll_conf=FAST_POLL, verbose=False)
+    finish = bulk.finish
+    def finished(row, state, text):
+        with lock:
+            inflight.discard(row['mac'])
+        return finish(row, state, text)
+    bulk.finish = finished
+    bulk.run(bulkTargets(controller, 20))
+    assert (bulk.get_stats()['completed'] == 20)
+    assert (most[0] == 4)
+
+def test_bulk_aborts_failed_wave(fast_controller, make_api):
+    controller = fast_controller
+    capi = make_api(controller)
+    # The canary targets an unknown device: the rest are skipped
+    targets = bulkTargets(controller, 0, [ "000000000000" ]) + bulkTargets(controller, 10)
+    bulk = capi.bulk_update_fw(targets, "http://fw/fw.bin", waves=[ 1, 4 ], poll_conf=FAST_POLL, verbose=False)
+    assert ([ x['state'] for x in bulk.results ] == [ "failed" ] + [ "skipped" ] * 10)
+    assert (bulk.get_stats()['aborted'] and bulk.results[0]['text'] == "No such device")
+    assert ("aborted" in bulk.summary())
+
+def test_bulk_tolerates_failures(fast_controller, make_api):
+    controller = fast_controller
+    capi = make_api(controller)
+    # 1 of 5 failed is within max_fail
+    targets = bulkTargets(controller, 4, [ "000000000000" ]) + bulkTargets(controller, 3)
+    bulk = capi.bulk_update_fw(targets, "http://fw/fw.bin", waves=[ 5 ], poll_conf=FAST_POLL, verbose=False)
+    stats = bulk.get_stats()
+    assert (stats['completed'] == 7 and stats['failed'] == 1 and not stats['aborted'])
+
+def test_bulk_poll_backoff(controller, capi, monkeypatch):
+    # The waits between polling rounds, on the thread running the command
+    waits = []
+    sleep = time.sleep
+    def recorded(secs):
+        if (threading.current_thread() == threading.main_thread()):
+            waits.append(secs)
+        sleep(secs)
+    monkeypatch.setattr(cloudsdk.time, "sleep", recorded)
+
+    delays = { controller.devices[0]['serialNumber']: 0.3, controller.devices[1]['serialNumber']: 0.8 }
+    def start(target):
+        cmd = controller.new_command(target['mac'], "upgrade", delays[target['mac']])
+        return { 'UUID': cmd['UUID'], 'resultCode': 0 }
+    poll_conf = { 'interval': 0.01, 'factor': 2, 'max_interval': 0.08, 'timeout': 10 }
+    bulk = cloudsdk.BulkCommand(capi, "test", start, waves=[], poll_conf=poll_conf, verbose=False)
+    bulk.run(bulkTargets(controller, 2))
+    assert (bulk.get_stats()['completed'] == 2)
+    assert (bulk.poll_calls == sum([ x['polls'] for x in bulk.results ]))
+    # Backs off while nothing completes, and starts over once one does
+    assert (waits[:4] == [ 0.01, 0.02, 0.04, 0.08 ] and max(waits) == 0.08)
+    resets = [ i for i in range(1, len(waits)) if waits[i] < waits[i - 1] ]
+    assert (len(resets) == 1 and waits[resets[0]] == 0.01)
+
+def test_bulk_poll_timeout(controller, capi):
+    poll_conf = dict(FAST_POLL, timeout=0.2)
+    bulk = cloudsdk.BulkCommand(capi, "test", delayedCommands(controller, 60), waves=[ 2 ], poll_conf=poll_conf, verbose=False)
+    bulk.run(bulkTargets(controller, 4))
+    assert ([ x['state'] for x in bulk.results ] == [ "timeout" ] * 2 + [ "skipped" ] * 2)
+
+def test_bulk_script_not_polled(controller, capi):
+    bulk = capi.bulk_run_script(bulkTargets(controller, 5), b"ZWNobyBoaQ==", verbose=False)
+    assert (bulk.get_stats()['completed'] == 5 and bulk.poll_calls == 0)
@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+
+# Tests of the collector: its outputs, the snapshot manifest, resuming an
+# interrupted run from its checkpoint, and the client aggregation
+
+import io
+import os
+import csv
+import json
+import threading
+import pytest
+import pandas
+from datetime import datetime
+
+from modules import collector
+from modules.collector import Sink, Manifest, Collection, TABLES, RRM_COUNTERS, tableSchema, columnValue, fileChecksum, newAPClient
+
+needsParquet = pytest.mark.skipif(collector.pyarrow == None, reason="Parquet outputs require pyarrow")
+
+# Records of a survey-data table, with values of the wrong type or missing
+SURVEY = [
+    { 'mac': "903cb3bb0001", 'band': "5G", 'on-chan': True, 'channel': 36, 'noise_floor': -95, 'rrm_airtime_pct': 12.5 },
+    { 'mac': "903cb3bb0001", 'band': "2G", 'on-chan': False, 'channel': "6", 'noise_floor': None, 'rrm_airtime_pct': 3 },
+    { 'mac': "903cb3bb0002", 'band': "6G", 'channel': "n/a" },
+]
+
+def readNDJSON(fn):
+    with open(fn) as f:
+        return [ json.loads(line) for line in f ]
+
+def readCSV(fn):
+    with open(fn) as f:
+        return list(csv.reader(f))
+
+# A survey-data record as the outputs hold it: every field of the table
+def fullRecord(rec):
+    return { f: rec.get(f) for f in TABLES['survey-data'] }
+
+@needsParquet
+def test_sink_outputs(tmp_path):
+    prefix = str(tmp_path / "DF-20261018-120000")
+    sink = Sink(prefix)
+    for rec in SURVEY:
+        sink.write('survey-data', fullRecord(rec))
+    sink.close()
+    files = sink.finish(json_arrays=True)
+    assert (len(files) == len(TABLES) * 4)
+    assert (sink.counts['survey-data'] == 3 and sink.counts['online-devices'] == 0)
+
+    fn = prefix + "-survey-data"
+    assert (readNDJSON(fn + ".ndjson") == [ fullRecord(x) for x in SURVEY ])
+    with open(fn + ".json") as f:
+        assert (json.load(f) == [ fullRecord(x) for x in SURVEY ])
+    rows = readCSV(fn + ".csv")
+    assert (rows[0] == TABLES['survey-data'] and len(rows) == 4)
+
+    # Typed columns, with values that do not convert stored as null
+    table = collector.read_snapshot(prefix, 'survey-data')
+    assert (table.schema == tableSchema('survey-data'))
+    assert (table.column('channel').to_pylist() == [ 36, 6, None ])
+    assert (table.column('on-chan').to_pylist() == [ "True", "False", None ])
+    assert (table.column('rrm_airtime_pct').to_pylist() == [ 12.5, 3.0, None ])
+    for name in TABLES.keys():
+        assert (collector.read_snapshot(prefix, name).schema == tableSchema(name))
+        with open(prefix + "-%s.json" % name) as f:
+            assert (json.load(f) == readNDJSON(prefix + "-%s.ndjson" % name))
+
+@needsParquet
+def test_sink_write_frame(tmp_path):
+    # Written as a frame, the outputs are the same as record by record
+    recs = [ fullRecord(x) for x in SURVEY ]
+    by_rec = Sink(str(tmp_path / "a"))
+    for rec in recs:
+        by_rec.write('survey-data', rec)
+    by_rec.close()
+    by_frame = Sink(str(tmp_path / "b"))
+    by_frame.write('survey-data', recs[0])
+    df = pandas.DataFrame(recs[1:], columns=TABLES['survey-data'], dtype="object")
+    assert (by_frame.write_frame('survey-data', df) == recs[1:])
+    by_frame.close()
+    for ext in [ "ndjson", "csv" ]:
+        with open(tmp_path / ("a-survey-data." + ext)) as a, open(tmp_path / ("b-survey-data." + ext)) as b:
+            assert (a.read() == b.read())
+    a = collector.read_snapshot(str(tmp_path / "a"), 'survey-data')
+    b = collector.read_snapshot(str(tmp_path / "b"), 'survey-data')
+    assert (a.equals(b))
+
+def test_sink_without_parquet(tmp_path):
+    prefix = str(tmp_path / "DF")
+    sink = Sink(prefix, parquet=False)
+    sink.write('survey-data', fullRecord(SURVEY[0]))
+    sink.close()
+    assert (not any([ x.endswith(".parquet") for x in sink.finish(json_arrays=False) ]))
+    assert (not os.path.exists(prefix + "-survey-data.parquet"))
+
+def test_column_values():
+    assert (columnValue("5", "int64") == 5 and columnValue("x", "int64") == None)
+    assert (columnValue("True", "bool") == True and columnValue("False", "bool") == False)
+    assert (columnValue(3, "float64") == 3.0 and columnValue(None, "string") == None)
+
+@needsParquet
+def test_collect_outputs(capi, tmp_path):
+    coll = collector.collect("LOCAL", outdir=str(tmp_path), capi=capi, verbose=False, keep=True, json_arrays=False)
+    for name, records in coll.tables.items():
+        table = collector.read_snapshot(coll.prefix, name)
+        assert (table.schema == tableSchema(name))
+        assert (table.num_rows == len(records) == len(readCSV("%s-%s.csv" % (coll.prefix, name))) - 1)
+        assert (readNDJSON("%s-%s.ndjson" % (coll.prefix, name)) == records)
+    assert (len(coll.tables['online-devices']) == 60)
+
+#==================================================================================================================
+
+# Write the CSV and NDJSON files of a snapshot's online-devices table
+def writeSnapshot(outdir, prefix, macs):
+    fn = os.path.join(outdir, "%s-online-devices" % prefix)
+    with open(fn + ".csv", "w") as f:
+        writer = csv.writer(f)
+        writer.writerow([ "mac", "name" ])
+        for mac in macs:
+            writer.writerow([ mac, "ap-" + mac ])
+    with open(fn + ".ndjson", "w") as f:
+        for mac in macs:
+            f.write(json.dumps({ 'mac': mac, 'name': "ap-" + mac }) + "\n")
+
+# Manifest entry of a snapshot written by writeSnapshot()
+def snapshotEntry(outdir, prefix, rows, org = None):
+    when = datetime.strptime(prefix[-15:], "%Y%m%d-%H%M%S")
+    files = {}
+    for ext in [ "csv", "ndjson" ]:
+        fn = os.path.join(outdir, "%s-online-devices.%s" % (prefix, ext))
+        files[ext] = { 'size': os.path.getsize(fn), 'sha256': fileChecksum(fn) }
+    return { 'prefix': prefix, 'deployment': prefix[:-16], 'time': when.isoformat(), 'timestamp': when.timestamp(),
+             'org': org, 'venue': None, 'tables': { 'online-devices': { 'rows': rows, 'files': files } } }
+
+def test_manifest_scan(tmp_path, monkeypatch):
+    writeSnapshot(tmp_path, "DF-20261018-120000", [ "a1", "a2", "a3" ])
+    writeSnapshot(tmp_path, "DF-20261017-120000", [ "a1" ])
+    (tmp_path / "notes.txt").write_text("not a snapshot")
+    (tmp_path / "DF-latest-online-devices.csv").write_text("no time in the name")
+
+    manifest = Manifest(str(tmp_path))
+    snapshots = manifest.snapshots()
+    assert ([ x['prefix'] for x in snapshots ] == [ "DF-20261017-120000", "DF-20261018-120000" ])
+    assert (snapshots[1] == snapshotEntry(str(tmp_path), "DF-20261018-120000", 3))
+    assert (snapshots[1]['deployment'] == "DF")
+
+    # The scan was written to the manifest, and is not done again
+    assert ((tmp_path / "manifest.json").exists())
+    monkeypatch.setattr(Manifest, "scan", lambda self: pytest.fail("rescanned"))
+    assert (manifest.latest()['prefix'] == "DF-20261018-120000")
+    assert (list(manifest.read_table(manifest.latest(), 'online-devices')['mac']) == [ "a1", "a2", "a3" ])
+
+def test_manifest_empty(tmp_path):
+    assert (Manifest(str(tmp_path / "missing")).snapshots() == [])
+    assert (not (tmp_path / "missing").exists())
+    assert (Manifest(str(tmp_path)).latest() == None)
+
+def test_manifest_add(tmp_path):
+    writeSnapshot(tmp_path, "DF-20261018-120000", [ "a1" ])
+    manifest = Manifest(str(tmp_path))
+    # Replaces the scanned entry of the same files
+    manifest.add(snapshotEntry(str(tmp_path), "DF-20261018-120000", 1, org="Org"))
+    writeSnapshot(tmp_path, "DF-20261016-120000", [ "a1" ])
+    manifest.add(snapshotEntry(str(tmp_path), "DF-20261016-120000", 1))
+    assert ([ (x['prefix'], x['org']) for x in manifest.snapshots() ] ==
+            [ ("DF-20261016-120000", None), ("DF-20261018-120000", "Org") ])
+    assert (manifest.latest()['prefix'] == "DF-20261016-120000")
+    assert (manifest.latest(org="Org")['prefix'] == "DF-20261018-120000")
+    assert (manifest.at(datetime(2026, 10, 17))['prefix'] == "DF-20261016-120000")
+    assert (manifest.at(datetime(2026, 10, 15)) == None)
+    assert (len(manifest.snapshots(since=datetime(2026, 10, 17))) == 1)
+
+def test_manifest_concurrent_adds(tmp_path):
+    prefixes = [ "DF-202610%02d-120000" % day for day in range(1, 17) ]
+    for prefix in prefixes:
+        writeSnapshot(tmp_path, prefix, [ "a1" ])
+    entries = [ snapshotEntry(str(tmp_path), x, 1, org="Org") for x in prefixes ]
+    threads = [ threading.Thread(target=Manifest(str(tmp_path)).add, args=(x,)) for x in entries ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert (Manifest(str(tmp_path)).snapshots() == entries)
+
+def test_manifest_scan_skips_partial(tmp_path):
+    # A run still in progress (or interrupted) is not a snapshot yet
+    writeSnapshot(tmp_path, "DF-20261018-120000", [ "a1" ])
+    writeSnapshot(tmp_path, "DF-20261018-130000", [ "a1" ])
+    (tmp_path / "DF-20261018-130000-checkpoint.ndjson").write_text("")
+    assert ([ x['prefix'] for x in Manifest(str(tmp_path)).snapshots() ] == [ "DF-20261018-120000" ])
+
+def test_collect_adds_snapshot(capi, tmp_path):
+    coll = collector.collect("LOCAL", outdir=str(tmp_path), capi=capi, verbose=False, keep=False, json_arrays=False)
+    latest = Manifest(str(tmp_path)).latest()
+    assert (latest['prefix'] == os.path.basename(coll.prefix) and latest['deployment'] == "LOCAL")
+    assert (latest['tables']['online-devices']['rows'] == 60)
+    df = Manifest(str(tmp_path)).read_table(latest, 'online-devices')
+    assert (len(df) == 60 and list(df.columns) == TABLES['online-devices'])
+
+#==================================================================================================================
+
+
+# Rows of a table of the latest snapshot in outdir, without the fields that
+# depend on when the stats were fetched
+def latestTable(outdir, name):
+    manifest = Manifest(outdir)
+    df = manifest.read_table(manifest.latest(), name)
+    return df.drop(columns=[ x for x in [ 'last_state' ] if x in df.columns ]).to_dict('records')
+
+def test_resume(capi, tmp_path, monkeypatch):
+    full = str(tmp_path / "full")
+    collector.collect("LOCAL", outdir=full, capi=capi, verbose=False, keep=False, json_arrays=False)
+
+    # Interrupted after 25 devices, checkpointed every 10
+    monkeypatch.setattr(collector, "CHECKPOINT_DEVICES", 10)
+    merge = Collection.mergeDevice
+    merged = []
+    def interrupted(self, result):
+        if (len(merged) == 25):
+            raise KeyboardInterrupt()
+        merged.append(result['nd']['mac'])
+        merge(self, result)
+    monkeypatch.setattr(Collection, "mergeDevice", interrupted)
+    resumed = str(tmp_path / "resumed")
+    with pytest.raises(KeyboardInterrupt):
+        collector.collect("LOCAL", outdir=resumed, capi=capi, verbose=False, keep=False, json_arrays=False)
+    cp = Collection(capi, outdir=resumed, out=io.StringIO()).findCheckpoint()
+    assert (cp['sink']['online-devices']['count'] == 20)
+    assert (Manifest(resumed).latest() == None)
+
+    monkeypatch.setattr(Collection, "mergeDevice", merge)
+    coll = collector.collect("LOCAL", outdir=resumed, capi=capi, verbose=False, keep=False, json_arrays=False, resume=True)
+    assert (os.path.basename(coll.prefix) == cp['prefix'])
+    assert (not os.path.exists(coll.prefix + "-checkpoint.json"))
+    assert (not os.path.exists(coll.prefix + "-checkpoint.ndjson"))
+    for name in collector.TABLES.keys():
+        assert (latestTable(resumed, name) == latestTable(full, name))
+
+def test_resume_without_checkpoint(capi, tmp_path):
+    coll = collector.collect("LOCAL", outdir=str(tmp_path), capi=capi, verbose=False, keep=True, json_arrays=False, resume=True)
+    assert ("No checkpoint to resume" in coll.out.getvalue())
+    assert (len(coll.online_devices) > 0)
+
+#==================================================================================================================
+
+# Collection with the given clients seen on each AP: { ap mac: [ (client mac,
+# connected time or None if not connected, RRM counter value) ] }
+def clientsCollection(aps):
+    coll = Collection(None, out=io.StringIO())
+    coll.cstats = { 'connectedDevices': len(aps) }
+    for amac, clients in aps.items():
+        nd = { 'mac': amac, 'name': "ap-" + amac, 'org': "Org", 'venue': "Venue", 'model': "m", 'firmware': "fw" }
+        assocs = []
+        for cmac, connected_time, rrm in clients:
+            if (connected_time != None):
+                assoc = { 'connected': connected_time, 'rssi': -50, 'ack_signal_avg': -51, 'rx_packets': 1,
+                          'rx_bytes': 2, 'tx_packets': 3, 'tx_bytes': 4 }
+                apc = newAPClient(nd, { 'vlan_id': 10 }, { 'band': "5G", 'ssid': "home" }, assoc)
+            else:
+                apc = newAPClient(nd)
+            for x in RRM_COUNTERS:
+                apc[x] = rrm
+            assocs.append((cmac, apc))
+        coll.mergeAssocClients(nd, assocs)
+    coll.processClients()
+    return coll
+
+def test_process_clients():
+    coll = clientsCollection({
+        'ap1': [ ("c1", 300, 1), ("c2", None, 1), ("c3", None, 2) ],
+        'ap2': [ ("c1", 100, 10), ("c2", None, 20) ],
+        'ap3': [ ("c1", None, 100), ("c2", 50, 300) ],
+    })
+    clients = { x['mac']: x for x in coll.clients_data }
+    assert (list(clients.keys()) == [ "c1", "c2", "c3" ])
+
+    # Primary AP: the connected one joined last
+    assert (clients['c1']['connected_time'] == 100 and clients['c1']['connected'])
+    assert (clients['c2']['connected_time'] == 50)
+    # Counters summed over all the client's APs, and its APs counted once
+    assert (clients['c1']['rrm_upsteer_btm_total'] == 111 and clients['c1']['ap_cnt'] == 3)
+    assert (clients['c2']['rrm_sticky_legacy_fail'] == 321 and clients['c2']['ap_cnt'] == 3)
+    assert (clients['c3']['rrm_downsteer_btm_success'] == 2 and clients['c3']['ap_cnt'] == 1)
+    assert (all([ list(x.keys()) == collector.TABLES['clients'] for x in coll.clients_data ]))
+
+    by_ap = [ (x['mac'], x['ap_mac']) for x in coll.clients_by_ap_data ]
+    assert (by_ap == [ ("c1", "ap1"), ("c1", "ap2"), ("c1", "ap3"), ("c2", "ap1"), ("c2", "ap2"), ("c2", "ap3"), ("c3", "ap1") ])
+    assert ("1 of them are currently connected" not in coll.out.getvalue())
+    assert ("2 of them are currently connected" in coll.out.getvalue())
+
+def test_process_clients_none_connected():
+    coll = clientsCollection({ 'ap1': [ ("c1", None, 5) ], 'ap2': [ ("c1", None, 7) ] })
+    # The first AP, its counters not counted twice
+    assert (len(coll.clients_data) == 1)
+    assert (coll.clients_data[0]['connected'] == False)
+    assert (coll.clients_data[0]['rrm_upsteer_legacy_total'] == 12 and coll.clients_data[0]['ap_cnt'] == 2)
+
+def test_process_clients_duplicates():
+    coll = clientsCollection({ 'ap1': [ ("c1", 200, 1), ("c1", 100, 2) ] })
+    # The entry that joined last replaces the other
+    assert (coll.clients_data[0]['dups'] == 1 and coll.clients_data[0]['connected_time'] == 100)
+    assert (coll.clients_data[0]['rrm_upsteer_btm_total'] == 2 and coll.clients_data[0]['ap_cnt'] == 1)
+
+def test_process_clients_empty():
+    coll = clientsCollection({})
+    assert (coll.clients_data == [] and coll.clients_by_ap_data == [])
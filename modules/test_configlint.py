@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+# Tests of the device configuration lint: the config index, the built-in
+# rules, and registering new ones
+
+from modules import configlint
+from modules.configlint import ConfigIndex, ConfigLinter, rule
+
+# Interface selecting the given ports
+def iface(name, *ports, **kwargs):
+    intf = { 'name': name, 'ethernet': [ { 'select-ports': list(ports) } ] }
+    intf.update(kwargs)
+    return intf
+
+def lint(config):
+    return ConfigLinter().lint("903cb3bb1d4b", ConfigIndex(config))
+
+def test_index():
+    config = { 'radios': [ { 'band': "2G", 'channel': 1 }, { 'band': "5G", 'channel': 36 }, { 'band': "2G", 'channel': 6 } ],
+               'interfaces': [ iface("WAN", "WAN*"), iface("LAN", "LAN1", "LAN2", ssids=[ { 'name': "home" } ]) ],
+               'services': { 'ntp': {} } }
+    index = ConfigIndex(config)
+    assert (index.radios['2G']['channel'] == 6)
+    assert (index.ports == [ ("WAN", "WAN*"), ("LAN", "LAN1"), ("LAN", "LAN2") ])
+    assert (index.port_ifaces == { 'WAN*': { "WAN" }, 'LAN1': { "LAN" }, 'LAN2': { "LAN" } })
+    assert (index.lan_ifaces == { "LAN" })
+    assert (index.ssids == [ ("LAN", { 'name': "home" }) ])
+    assert ('ntp' in index.services)
+
+def test_no_config():
+    index = ConfigIndex(None)
+    assert (index.radios == {} and index.ports == [] and index.services == {})
+    assert (lint(None) == [])
+
+def test_broken_lan():
+    # Both interfaces select LAN1: once each
+    findings = lint({ 'interfaces': [ iface("LAN", "LAN1", "LAN2"), iface("GUEST", "LAN1") ] })
+    assert (findings == [ { 'mac': "903cb3bb1d4b", 'rule': "broken-lan", 'severity': "ERROR", 'dup_cnt': 2 } ])
+
+def test_broken_lan_wildcard():
+    # LAN* selects every LAN port, so any other LAN interface duplicates it
+    findings = lint({ 'interfaces': [ iface("LAN", "LAN*"), iface("GUEST", "LAN3") ] })
+    assert (findings[0]['dup_cnt'] == 1)
+
+def test_good_lan():
+    assert (lint({ 'interfaces': [ iface("WAN", "WAN*"), iface("LAN", "LAN*") ] }) == [])
+    assert (lint({ 'interfaces': [ iface("LAN", "LAN1"), iface("GUEST", "LAN2") ] }) == [])
+    # Only LAN ports count
+    assert (lint({ 'interfaces': [ iface("WAN", "WAN1"), iface("WAN2", "WAN1") ] }) == [])
+
+def test_remote_logging():
+    findings = lint({ 'services': { 'log': { 'host': "10.0.0.1", 'port': 514 } } })
+    assert (findings == [ { 'mac': "903cb3bb1d4b", 'rule': "remote-logging", 'severity': "WARNING",
+                            'host': "10.0.0.1", 'port': 514 } ])
+    assert (lint({ 'services': { 'log': { 'size': 64 } } }) == [])
+
+def test_register_rule(monkeypatch):
+    monkeypatch.setattr(configlint, "CONFIG_RULES", list(configlint.CONFIG_RULES))
+
+    @rule("no-ntp", "WARNING", "Found %d devices without NTP:", "%(mac)s has no NTP servers")
+    def noNTP(index):
+        if ('ntp' not in index.services):
+            return {}
+
+    assert ([ x['rule'] for x in lint({ 'services': { 'log': { 'host': "h" } } }) ] == [ "remote-logging", "no-ntp" ])
+    assert (lint({ 'services': { 'ntp': {} } }) == [])
+    # Only the given rules are checked
+    only = [ x for x in configlint.CONFIG_RULES if x['name'] == "no-ntp" ]
+    assert (ConfigLinter(only).lint("m", ConfigIndex({ 'services': { 'log': { 'host': "h" } } })) ==
+            [ { 'mac': "m", 'rule': "no-ntp", 'severity': "WARNING" } ])
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+# Tests of the fake controller the other tests run against: it must serve
+# the fixtures the way the controller does
+
+import json
+import time
+import http.client
+
+import fake_controller
+
+# GET a path, returns (status, headers, decoded body)
+def get(srv, path, headers = {}):
+    conn = http.client.HTTPConnection("127.0.0.1", srv.server_address[1])
+    try:
+        conn.request("GET", path, headers=headers)
+        res = conn.getresponse()
+        return res.status, dict(res.getheaders()), res.read()
+    finally:
+        conn.close()
+
+def test_paging(controller):
+    status, headers, body = get(controller, "/api/v1/devices?countOnly=true")
+    assert (status == 200 and json.loads(body) == { 'count': len(controller.devices) })
+    macs = []
+    for offset in range(0, len(controller.devices), 50):
+        status, headers, body = get(controller, "/api/v1/devices?limit=50&offset=%d" % offset)
+        macs += [ x['serialNumber'] for x in json.loads(body)['devicesWithStatus'] ]
+    assert (macs == [ x['serialNumber'] for x in controller.devices ])
+
+def test_stats(controller):
+    mac = controller.devices[0]['serialNumber']
+    status, headers, body = get(controller, "/api/v1/device/%s/statistics" % mac)
+    assert (status == 200)
+    stats = json.loads(body)
+    stats['unit'].pop('localtime')
+    expected = fake_controller.synth_stats(mac)
+    expected['unit'].pop('localtime')
+    assert (stats == expected)
+    assert (get(controller, "/api/v1/device/000000000000/statistics")[0] == 404)
+
+def test_gzip(controller):
+    status, headers, body = get(controller, "/api/v1/devices?limit=50", { 'Accept-Encoding': "gzip" })
+    assert (headers['Content-Encoding'] == "gzip" and int(headers['Content-Length']) == len(body))
+    assert ('Content-Encoding' not in get(controller, "/api/v1/devices?limit=50")[1])
+
+def test_commands(controller):
+    mac = controller.devices[0]['serialNumber']
+    cmd = controller.new_command(mac, "upgrade", 0.2)
+    assert (controller.get_command(cmd['UUID'])['status'] == "pending")
+    time.sleep(0.25)
+    status, headers, body = get(controller, "/api/v1/command/%s" % cmd['UUID'])
+    assert (json.loads(body)['status'] == "completed")
+    assert (controller.get_command("missing") == None)
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+# Tests of get-online-devices.py collecting several deployments at once,
+# each served by the fake controller
+
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+from modules.collector import Manifest, pyarrow
+from conftest import TOP_DIR
+
+pytestmark = pytest.mark.skipif(pyarrow == None, reason="time series require pyarrow")
+
+# Run get-online-devices.py in run_dir, where config/ points each deployment
+# at the fake controller. Returns the completed process
+def runScript(run_dir, controller, deployments, *args):
+    svc = { 'host': "127.0.0.1", 'port': controller.server_address[1], 'scheme': "http" }
+    os.makedirs(run_dir / "config", exist_ok=True)
+    with open(run_dir / "config" / "clouds.json", "w") as f:
+        json.dump({ x: { 'owsec': svc, 'owgw': svc, 'owprov': svc } for x in deployments }, f)
+    with open(run_dir / "config" / "PRIV-creds.json", "w") as f:
+        json.dump({ x: { 'userId': "test", 'password': "test" } for x in deployments }, f)
+    cmd = [ sys.executable, os.path.join(TOP_DIR, "get-online-devices.py"), "-d", ",".join(deployments),
+            "-O", str(run_dir / "out"), "-J", "-A" ] + list(args)
+    env = dict(os.environ, PYTHONPATH=TOP_DIR)
+    return subprocess.run(cmd, cwd=run_dir, env=env, capture_output=True, text=True, timeout=300)
+
+# The output of each deployment, from its "==== <deployment>" header on
+def sections(out):
+    found = {}
+    for part in out.split("\n==== ")[1:]:
+        name, rest = part.split("\n", 1)
+        found[name] = rest
+    return found
+
+def test_several_deployments(tmp_path, controller):
+    res = runScript(tmp_path, controller, [ "LOCAL", "LOCAL2" ], "-p", "2")
+    assert (res.returncode == 0)
+    assert ("Collecting several deployments, ignoring --procs" in res.stdout)
+    assert ("Collected 2 of 2 deployments" in res.stdout)
+    found = sections(res.stdout)
+    assert (list(found.keys()) == [ "LOCAL", "LOCAL2" ])
+    for dep in [ "LOCAL", "LOCAL2" ]:
+        assert ("There are 60 connected devices out of 114 total" in found[dep])
+        assert ("Appended device metrics" in found[dep])
+        latest = Manifest(str(tmp_path / "out" / dep)).latest()
+        assert (latest['deployment'] == dep and latest['tables']['online-devices']['rows'] == 60)
+
+def test_failed_deployment(tmp_path, controller):
+    # Fails appending to the time series, once the collection is done
+    os.makedirs(tmp_path / "out" / "LOCAL2")
+    (tmp_path / "out" / "LOCAL2" / "timeseries").write_text("not a dir")
+    res = runScript(tmp_path, controller, [ "LOCAL", "LOCAL2" ])
+    assert (res.returncode == 1)
+    assert ("Collected 1 of 2 deployments" in res.stdout)
+    found = sections(res.stdout)
+    assert ("Appended device metrics" in found["LOCAL"])
+    # What the failed one printed comes before its error
+    assert (list(found.keys())[1] == "LOCAL2" and list(found.keys())[2].startswith("LOCAL2: FAILED (") and len(found) == 3)
+    assert ("There are 60 connected devices out of 114 total" in found["LOCAL2"])
+    assert ("Appended device metrics" not in found["LOCAL2"])
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+# Tests of the selective JSON decoding: projections must match trimming the
+# fully decoded document, and malformed documents must be rejected
+
+import json
+import pytest
+
+import fake_controller
+from modules.projection import Projection, PROJECTION_SKIP_DEPTH
+from modules.collector import STATS_PROJECTION
+
+# Trim a decoded value to the fields of a projection, as Projection.loads()
+# should have decoded it
+def project(value, fields):
+    if (fields == None):
+        return value
+    if (isinstance(value, list)):
+        return [ project(x, fields) for x in value ]
+    if (not isinstance(value, dict)):
+        return value
+    trimmed = {}
+    for k, v in value.items():
+        if (k in fields):
+            trimmed[k] = project(v, fields[k])
+        elif ('*' in fields):
+            trimmed[k] = project(v, fields['*'])
+    return trimmed
+
+FIELDS = { 'unit': { 'load': None, 'memory': { 'free': None } }, 'radios': { 'band': None, 'survey': { 'busy': None } },
+           'tags': None, 'other': { '*': { 'x': None } } }
+
+DOCS = [
+    {},
+    { 'unit': {}, 'radios': [], 'tags': [] },
+    { 'unit': { 'load': [ 1, 2, 3 ], 'memory': { 'free': 10, 'total': 20 }, 'skipped': { 'a': [ {}, [] ] } } },
+    { 'radios': [ { 'band': [ "5G" ], 'survey': [ { 'busy': 1, 'idle': 2 }, { 'idle': 3 } ] }, { 'channel': 6 } ] },
+    { 'skipped': "brackets ][}{ and \"quotes\" in a string", 'tags': { 'a': None, 'b': True, 'c': -1.5e-3 } },
+    { 'other': { 'k1': { 'x': 1, 'y': 2 }, 'k2': [ { 'x': 3 }, 4 ], 'k3': "s" } },
+    { 'radios': "not an array", 'unit': [ { 'load': 1 } ], 'other': 5 },
+    { 'deep': json.loads("[" * (PROJECTION_SKIP_DEPTH + 5) + "1" + "]" * (PROJECTION_SKIP_DEPTH + 5)), 'tags': [ "é中" ] },
+]
+
+@pytest.mark.parametrize("doc", DOCS)
+def test_matches_full_decode(doc):
+    p = Projection(FIELDS)
+    for body in [ json.dumps(doc), json.dumps(doc, indent=2), json.dumps(doc, ensure_ascii=False), json.dumps(doc).encode() ]:
+        assert (p.loads(body) == project(doc, FIELDS))
+
+def test_non_object_documents():
+    p = Projection(FIELDS)
+    assert (p.loads("[ { \"tags\": 1, \"x\": 2 }, 3 ]") == [ { 'tags': 1 }, 3 ])
+    assert (p.loads(" 42 ") == 42)
+    assert (p.loads("null") == None)
+
+def test_escaped_keys():
+    p = Projection({ 'a': None, 'b"c': None })
+    assert (p.loads('{ "\\u0061": 1, "b\\"c": 2, "d": 3 }') == { 'a': 1, 'b"c': 2 })
+
+def test_whole_projection():
+    doc = { 'a': [ 1, { 'b': 2 } ], 'c': None }
+    assert (Projection({ '*': None }).loads(json.dumps(doc)) == doc)
+
+def test_stats_projection():
+    # Every field the collector reads from the stats is kept
+    doc = fake_controller.synth_stats("903cb3bb1d4b")
+    stats = STATS_PROJECTION.loads(json.dumps(doc))
+    assert (stats['unit'] == doc['unit'])
+    for r, full in zip(stats['radios'], doc['radios']):
+        assert (r['band'] == full['band'] and r['channel'] == full['channel'])
+    for intf, full in zip(stats['interfaces'], doc['interfaces']):
+        for ssid, full_ssid in zip(intf.get('ssids', []), full.get('ssids', [])):
+            assert (ssid['associations'] == full_ssid['associations'])
+
+@pytest.mark.parametrize("body", [
+    '', '   ', '{"a": 1', '{"a": 1}}', '{"a" 1}', '{"a": 1 "b": 2}', '{"x": [1, 2}', '{"x": "abc}', '{"x": 1,}',
+    '{"radios": [{"band": 1}, ]}', '{"unit": {"memory": [1, 2]}', '{"tags": tru}', '{"tags": [1,]}', '[{"tags": 1},]',
+])
+def test_malformed(body):
+    with pytest.raises(json.JSONDecodeError):
+        Projection(FIELDS).loads(body)
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+# Tests of snapshot retention: compacted history must read back the same, and
+# compacting again, or after an interrupted run, must not change it
+
+import os
+import json
+import pytest
+from datetime import datetime
+
+from modules import collector, retention
+from modules.collector import Manifest, fileChecksum
+from modules.anomaly import ANOMALY_DIR
+
+pytestmark = pytest.mark.skipif(collector.pyarrow == None, reason="retention requires pyarrow")
+
+NOW = datetime(2026, 10, 18, 12, 0, 0)
+
+# Write a snapshot of a few devices taken at when, and add it to the manifest
+# as Collection.write() does
+def addSnapshot(outdir, when):
+    prefix = os.path.join(outdir, "DF-%s" % when.strftime("%Y%m%d-%H%M%S"))
+    sink = collector.Sink(prefix)
+    for i in range(3):
+        sink.write('online-devices', { 'mac': "903cb3bb%04x" % i, 'name': "AP-%d" % i, 'uptime': when.day * 100 + i })
+    sink.write('survey-data', { 'mac': "903cb3bb0000", 'band': "5g", 'channel': 36 })
+    sink.close()
+    snapshot = { 'prefix': os.path.basename(prefix), 'deployment': "DF", 'time': when.isoformat(), 'timestamp': when.timestamp(),
+                 'org': None, 'venue': None, 'tables': {} }
+    for name, cnt in sink.counts.items():
+        snapshot['tables'][name] = { 'rows': cnt, 'files': {} }
+    for fn in sink.finish(json_arrays=False):
+        name, ext = fn[len(prefix) + 1:].rsplit(".", 1)
+        snapshot['tables'][name]['files'][ext] = { 'size': os.path.getsize(fn), 'sha256': fileChecksum(fn) }
+    Manifest(outdir).add(snapshot)
+
+@pytest.fixture
+def outdir(tmp_path):
+    for day in [ (8, 2), (8, 3), (9, 1), (10, 1), (10, 9), (10, 15), (10, 17) ]:
+        for hour in [ 6, 18 ]:
+            addSnapshot(str(tmp_path), datetime(2026, day[0], day[1], hour))
+    return str(tmp_path)
+
+# All rows of a table, as read back through the manifest
+def readAll(outdir, name):
+    df = Manifest(outdir).read_range(name)
+    return sorted([ tuple(x) for x in df[[ 'snapshot', 'mac', 'uptime' if name == 'online-devices' else 'channel' ]].values.tolist() ])
+
+# State of an output dir: the manifest and the checksum of every file
+def dirState(outdir):
+    files = {}
+    for root, dirs, fns in os.walk(outdir):
+        for fn in fns:
+            if (not fn.startswith(".")):
+                files[os.path.relpath(os.path.join(root, fn), outdir)] = fileChecksum(os.path.join(root, fn))
+    with open(os.path.join(outdir, "manifest.json")) as f:
+        return json.load(f), files
+
+def test_compact(outdir):
+    before = { name: readAll(outdir, name) for name in [ 'online-devices', 'survey-data' ] }
+    stats = retention.compact(outdir, now=NOW, verbose=False)
+    assert (stats['snapshots'] == 10 and stats['days'] == 5 and stats['months'] == 1)
+    assert (stats['bytes_after'] < stats['bytes_before'])
+
+    manifest = json.load(open(os.path.join(outdir, "manifest.json")))
+    assert ([ x.get('compacted') for x in manifest['snapshots'] ] == [ "month" ] * 4 + [ "day" ] * 6 + [ None ] * 4)
+    assert (sorted(manifest['archives'].keys()) == sorted([ "archive/%s/%s.parquet" % (name, key)
+            for name in collector.TABLES.keys() for key in [ "month=2026-08", "day=2026-09-01", "day=2026-10-01", "day=2026-10-09" ] ]))
+    for snapshot in manifest['snapshots'][:10]:
+        assert (not os.path.exists(os.path.join(outdir, "%s-online-devices.ndjson" % snapshot['prefix'])))
+    for name, rows in before.items():
+        assert (readAll(outdir, name) == rows)
+
+def test_compact_again(outdir):
+    retention.compact(outdir, now=NOW, verbose=False)
+    compacted = dirState(outdir)
+    stats = retention.compact(outdir, now=NOW, verbose=False)
+    assert (stats['snapshots'] == 0 and stats['months'] == 0 and stats['files_removed'] == 0)
+    assert (dirState(outdir) == compacted)
+
+def test_compact_interrupted(outdir, monkeypatch):
+    before = readAll(outdir, 'online-devices')
+    manifest_before = dirState(outdir)[0]
+
+    # Archives written, but the manifest never updated
+    def failing(self, manifest):
+        raise KeyboardInterrupt()
+    save = Manifest.save
+    monkeypatch.setattr(Manifest, "save", failing)
+    with pytest.raises(KeyboardInterrupt):
+        retention.compact(outdir, now=NOW, verbose=False)
+    assert (os.path.isdir(os.path.join(outdir, retention.ARCHIVE_DIR)))
+    assert (dirState(outdir)[0] == manifest_before)
+    assert (readAll(outdir, 'online-devices') == before)
+
+    # Done again, the archives hold each snapshot's rows once
+    monkeypatch.setattr(Manifest, "save", save)
+    retention.compact(outdir, now=NOW, verbose=False)
+    assert (readAll(outdir, 'online-devices') == before)
+    manifest = dirState(outdir)[0]
+    assert (sum([ x['rows'] for x in manifest['archives'].values() ]) == 10 * 4)
+
+def test_expire(outdir):
+    retention.compact(outdir, now=NOW, verbose=False)
+    stats = retention.compact(outdir, policy={ 'keep_months': 1 }, now=NOW, verbose=False)
+    assert (stats['expired'] == 4)
+    manifest = dirState(outdir)[0]
+    assert (all([ x['time'] >= "2026-09" for x in manifest['snapshots'] ]))
+    assert (not any([ "month=2026-08" in x for x in manifest['archives'].keys() ]))
+    assert (not os.path.exists(os.path.join(outdir, "archive/online-devices/month=2026-08.parquet")))
+    assert (len(readAll(outdir, 'online-devices')) == 10 * 3)
+
+def test_anomaly_reports(outdir):
+    reports = os.path.join(outdir, ANOMALY_DIR)
+    os.makedirs(reports)
+    prefixes = [ x['prefix'] for x in Manifest(outdir).snapshots() ]
+    for prefix in prefixes:
+        with open(os.path.join(reports, prefix + ".csv"), "w") as f:
+            f.write("mac,metric,z\n")
+    # Kept until their snapshot is in a month archive
+    retention.compact(outdir, now=NOW, verbose=False)
+    assert (sorted(os.listdir(reports)) == [ x + ".csv" for x in prefixes[4:] ])
+    retention.compact(outdir, policy={ 'day_days': 20 }, now=NOW, verbose=False)
+    assert (sorted(os.listdir(reports)) == [ x + ".csv" for x in prefixes[6:] ])
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+# Tests of the device metrics time series: rollups must match aggregating
+# the raw samples, and queries must only read the partitions they need
+
+import os
+import pytest
+import pandas
+from datetime import datetime
+
+from modules import collector, timeseries
+from modules.timeseries import DeviceMetrics, TS_TAGS, TS_GAUGES, TS_LAST
+
+pytestmark = pytest.mark.skipif(collector.pyarrow == None, reason="the time series require pyarrow")
+
+# Device records with the time series fields, cpu_busy_pct set per mac
+def samples(cpu):
+    rows = []
+    for mac, value in cpu.items():
+        row = { f: None for f in TS_TAGS + TS_GAUGES + TS_LAST }
+        row.update({ 'mac': mac, 'name': "ap-" + mac, 'org': "Org", 'venue': "V-" + mac[-1], 'cpu_busy_pct': value,
+                     'mem_used_pct': 50, 'uptime': value * 10 })
+        rows.append(row)
+    return pandas.DataFrame(rows)
+
+def test_rollups(tmp_path):
+    ts = DeviceMetrics(str(tmp_path))
+    # Three samples of a1 in the 10:00 hour, one of them unknown (-1), and
+    # one in the 11:00 hour
+    ts.append(samples({ 'a1': 10, 'a2': 40 }), datetime(2026, 10, 18, 10, 5), "s1")
+    ts.append(samples({ 'a1': 30 }), datetime(2026, 10, 18, 10, 35), "s2")
+    ts.append(samples({ 'a1': -1 }), datetime(2026, 10, 18, 10, 50), "s3")
+    ts.append(samples({ 'a1': 80 }), datetime(2026, 10, 18, 11, 5), "s4")
+
+    raw = ts.query("raw", mac="a1")
+    assert (len(raw) == 4 and raw['cpu_busy_pct'].isna().tolist() == [ False, False, True, False ])
+
+    hours = ts.query("1h", mac="a1")
+    assert (hours['time'].tolist() == [ pandas.Timestamp(2026, 10, 18, 10), pandas.Timestamp(2026, 10, 18, 11) ])
+    first = hours.iloc[0]
+    assert (first['samples'] == 3 and first['cpu_busy_pct_avg'] == 20)
+    assert (first['cpu_busy_pct_min'] == 10 and first['cpu_busy_pct_max'] == 30)
+    # The last value of the hour, as sampled
+    assert (first['uptime'] == -10)
+    assert (hours.iloc[1]['uptime'] == 800)
+
+    # The day is weighted by the samples that had a value, not by hour
+    day = ts.query("1d", mac="a1").iloc[0]
+    assert (day['samples'] == 4 and day['cpu_busy_pct_avg'] == 40)
+    assert (day['cpu_busy_pct_min'] == 10 and day['cpu_busy_pct_max'] == 80)
+    assert (ts.query("1d", venue="V-2")['cpu_busy_pct_avg'].tolist() == [ 40 ])
+
+def test_query_partitions(tmp_path):
+    ts = DeviceMetrics(str(tmp_path))
+    for day in [ 1, 2, 3 ]:
+        ts.append(samples({ 'a1': day }), datetime(2026, 10, day, 12), "s%d" % day)
+    since, until = datetime(2026, 10, 2), datetime(2026, 10, 2, 23)
+    assert ([ os.path.basename(x) for x in ts.files("1h", since, until) ] == [ "date=2026-10-02.parquet" ])
+    assert (ts.query("1h", since, until)['cpu_busy_pct_avg'].tolist() == [ 2 ])
+    assert (ts.query("raw", since=datetime(2026, 10, 2, 13))['cpu_busy_pct'].tolist() == [ 3 ])
+    assert (len(ts.files("1d")) == 1)
+    assert (ts.query("raw", mac="missing").empty)
+
+def test_prune(tmp_path):
+    ts = DeviceMetrics(str(tmp_path), retention={ 'raw': 2, '1h': 35, '1d': 30 })
+    for when in [ datetime(2026, 8, 1), datetime(2026, 9, 20), datetime(2026, 10, 8), datetime(2026, 10, 9) ]:
+        ts.append(samples({ 'a1': when.day }), when, when.strftime("s%m%d"))
+    assert (sorted(os.listdir(os.path.join(ts.root, "raw"))) == [ "date=2026-10-08", "date=2026-10-09" ])
+    assert (sorted(os.listdir(os.path.join(ts.root, "1h"))) == [ "date=2026-09-20.parquet", "date=2026-10-08.parquet",
+                                                               "date=2026-10-09.parquet" ])
+    # Months go once their last day is past the cutoff
+    assert (sorted(os.listdir(os.path.join(ts.root, "1d"))) == [ "month=2026-09.parquet", "month=2026-10.parquet" ])
+    assert (ts.query("1d")['cpu_busy_pct_avg'].tolist() == [ 20, 8, 9 ])
+
+def test_append_snapshots(capi, tmp_path):
+    outdir = str(tmp_path)
+    ts = DeviceMetrics(outdir)
+    colls = []
+    for i in range(2):
+        coll = collector.collect("LOCAL", outdir=outdir, capi=capi, verbose=False, keep=True, json_arrays=False)
+        ts.append_snapshot(coll.prefix, coll.now)
+        colls.append(coll)
+    raw = ts.query("raw")
+    assert (len(raw) == 2 * len(colls[0].online_devices))
+    rec = colls[1].online_devices[0]
+    last = raw[raw['mac'] == rec['mac']].iloc[-1]
+    assert (last['cpu_busy_pct'] == rec['cpu_busy_pct'] and last['uptime'] == rec['uptime'])
+    hours = ts.query("1h", mac=rec['mac'])
+    assert (hours['samples'].sum() == 2)
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+# Tests of the run profiler: spans must be traced in the Chrome trace event
+# format, and a profiled collection must trace its phases and devices
+
+import json
+import time
+import threading
+
+from modules import collector
+from modules.tracing import Profiler, PHASE, FETCH, PARSE
+
+# The trace written by a profiler
+def readTrace(profiler, tmp_path):
+    fn = str(tmp_path / "trace.json")
+    profiler.write(fn)
+    with open(fn) as f:
+        return json.load(f)
+
+def test_spans(tmp_path):
+    profiler = Profiler()
+    with profiler.span("load", items=3):
+        time.sleep(0.01)
+    for page in profiler.iterate(iter([ 1, 2 ]), "page"):
+        time.sleep(0.002)
+    # Too short to trace, only counted
+    profiler.add("tiny", PHASE, 1.0, 1.0001, 0)
+    profiler.total("write records", PHASE, 5, 0.5, 0.25)
+
+    trace = readTrace(profiler, tmp_path)
+    assert (trace['displayTimeUnit'] == "ms")
+    spans = [ x for x in trace['traceEvents'] if x['ph'] == "X" ]
+    assert ([ x['name'] for x in spans ] == [ "load" ])
+    load = spans[0]
+    assert (load['cat'] == PHASE and load['args']['items'] == 3 and 'cpu_ms' in load['args'])
+    assert (load['dur'] >= 10000 and load['ts'] >= 0)
+    assert (profiler.totals[(PHASE, "page")][0] == 2 and profiler.totals[(PHASE, "tiny")][0] == 1)
+    assert (profiler.totals[(PHASE, "write records")] == [ 5, 0.5, 0.25 ])
+    names = [ x['args']['name'] for x in trace['traceEvents'] if x['ph'] == "M" ]
+    assert (names == [ threading.current_thread().name, "collector" ])
+
+def test_lanes(tmp_path):
+    profiler = Profiler()
+    def work(i):
+        with profiler.span("work-%d" % i, FETCH):
+            time.sleep(0.005)
+    threads = [ threading.Thread(target=work, args=(i,), name="worker-%d" % i) for i in range(3) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    start = time.perf_counter()
+    profiler.add("a1", PARSE, start, start + 0.002, 0.002, lane="transform-7", mac="a1")
+
+    trace = readTrace(profiler, tmp_path)
+    tids = { x['args']['name']: x['tid'] for x in trace['traceEvents'] if x['name'] == "thread_name" }
+    assert (sorted(tids.keys()) == [ "transform-7", "worker-0", "worker-1", "worker-2" ])
+    for x in trace['traceEvents']:
+        if (x['ph'] == "X" and x['cat'] == FETCH):
+            assert (tids["worker-" + x['name'][-1]] == x['tid'])
+    # Per device spans are totalled by category
+    assert (profiler.totals[(FETCH, FETCH)][0] == 3 and profiler.totals[(PARSE, PARSE)][0] == 1)
+
+def test_profiled_collection(capi, tmp_path):
+    profiler = Profiler()
+    coll = collector.collect("LOCAL", outdir=str(tmp_path), capi=capi, verbose=False, keep=True, json_arrays=False,
+                             profiler=profiler)
+    trace = readTrace(profiler, tmp_path)
+    # Every phase is counted, the longer ones traced too
+    phases = set([ name for cat, name in profiler.totals.keys() if cat == PHASE ])
+    assert (set([ "load provdata", "devices", "device count", "conn stats", "client aggregation", "close outputs",
+                  "write outputs", "write records" ]) <= phases)
+    assert ("devices" in [ x['name'] for x in trace['traceEvents'] if x.get('cat') == PHASE ])
+    fetched = [ x['args']['mac'] for x in trace['traceEvents'] if x.get('cat') == FETCH ]
+    assert (sorted(fetched) == sorted([ x['mac'] for x in coll.online_devices ]))
+    assert (profiler.totals[(FETCH, FETCH)][0] == 60 and profiler.totals[(PARSE, PARSE)][0] == 60)
+
+    summary = profiler.summary(top=3)
+    assert ("Devices: 60 in " in summary)
+    slowest = summary.split("Slowest devices (ms):\n")[1].splitlines()
+    assert (len(slowest) == 4 and slowest[0].split() == [ "mac", FETCH, PARSE ])
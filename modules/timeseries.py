@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+
+# Per-device metrics time series across collection runs. Each run appends
+# the online devices' metrics to <outdir>/timeseries/raw/date=YYYY-MM-DD/
+# (one Parquet file per run), then recomputes the 1h rollup of that day and
+# the 1d rollup of that month:
+#
+#   timeseries/raw/date=YYYY-MM-DD/<snapshot>.parquet
+#   timeseries/1h/date=YYYY-MM-DD.parquet
+#   timeseries/1d/month=YYYY-MM.parquet
+#
+# Rollups keep avg/min/max of each gauge, with the number of samples that
+# had a value (<gauge>_n), and the last value of the others.
+# Queries only read the partitions of the time range asked for
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+import pandas
+
+from modules.collector import pyarrow
+
+# Device fields, gauges (averaged on rollup, -1 means unknown) and values
+# where the latest sample is kept
+TS_TAGS   = [ 'mac', 'name', 'org', 'venue', 'model', 'firmware' ]
+TS_GAUGES = [ 'cpu_busy_pct', 'cpu_load_1m', 'cpu_load_5m', 'cpu_load_15m', 'mem_used_pct', 'mem_free_pct', 'num_assocs' ]
+TS_LAST   = [ 'uptime', 'num_ssids', 'chan_2g', 'width_2g', 'chan_5g', 'width_5g', 'chan_6g', 'width_6g' ]
+TS_DIR    = "timeseries"
+
+# How long each resolution is kept, in days (None is forever)
+TS_RETENTION = { 'raw': 14, '1h': 180, '1d': None }
+
+# Write a DataFrame as Parquet under a temp name and rename it into place
+def writeFrame(fn, df):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".ts.", suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_fn, index=False, compression="zstd")
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        os.unlink(tmp_fn)
+        raise
+
+#==================================================================================================================
+
+class DeviceMetrics:
+    # Init the metrics store of a collector output dir
+    def __init__(self, outdir, retention = None):
+        if (pyarrow == None):
+            raise Exception("[timeseries] Error: the device metrics store requires pyarrow")
+        self.root = os.path.join(outdir, TS_DIR)
+        self.retention = dict(TS_RETENTION)
+        self.retention.update(retention or {})
+
+    # Partition file of a resolution for a time
+    def partition(self, resolution, when):
+        if (resolution == "1h"):
+            return os.path.join(self.root, "1h", "date=%s.parquet" % when.strftime("%Y-%m-%d"))
+        return os.path.join(self.root, "1d", "month=%s.parquet" % when.strftime("%Y-%m"))
+
+    # Raw partition dir of a day
+    def raw_dir(self, when):
+        return os.path.join(self.root, "raw", "date=%s" % when.strftime("%Y-%m-%d"))
+
+    # Append the online devices of a snapshot taken at when (a datetime), as
+    # written by the collector under prefix, then update the rollups
+    def append_snapshot(self, prefix, when):
+        fields = TS_TAGS + TS_GAUGES + TS_LAST
+        if (os.path.exists(prefix + "-online-devices.parquet")):
+            df = pandas.read_parquet(prefix + "-online-devices.parquet", columns=fields)
+        else:
+            df = pandas.read_json(prefix + "-online-devices.ndjson", lines=True)
+            df = df.reindex(columns=fields)
+        self.append(df, when, os.path.basename(prefix))
+
+    # Append device records (a DataFrame with the TS_* columns) sampled at when
+    def append(self, df, when, name):
+        df = df.copy()
+        for col in TS_GAUGES:
+            df[col] = pandas.to_numeric(df[col], errors='coerce').astype("float64")
+            df.loc[df[col] < 0, col] = float("nan")
+        for col in TS_LAST:
+            df[col] = pandas.to_numeric(df[col], errors='coerce').astype("float64")
+        df.insert(0, 'time', pandas.Timestamp(when).floor("s"))
+        writeFrame(os.path.join(self.raw_dir(when), name + ".parquet"), df)
+        self.rollup(when)
+        self.prune(when)
+
+    # Recompute the 1h rollup of the day and the 1d rollup of the month of when
+    def rollup(self, when):
+        raw_dir = self.raw_dir(when)
+        raw = pandas.concat([ pandas.read_parquet(os.path.join(raw_dir, fn)) for fn in sorted(os.listdir(raw_dir))
+                              if fn.endswith(".parquet") ], ignore_index=True)
+        raw['samples'] = 1
+        for col in TS_GAUGES:
+            raw[col + "_n"] = raw[col].notna().astype("int64")
+            raw[col + "_avg"] = raw[col]
+            raw[col + "_min"] = raw[col]
+            raw[col + "_max"] = raw[col]
+        writeFrame(self.partition("1h", when), self.downsample(raw, "h"))
+
+        # The 1d rollup is computed from the 1h ones of the month
+        hour_dir = os.path.join(self.root, "1h")
+        month = when.strftime("%Y-%m")
+        hours = pandas.concat([ pandas.read_parquet(os.path.join(hour_dir, fn)) for fn in sorted(os.listdir(hour_dir))
+                                if fn.startswith("date=" + month) ], ignore_index=True)
+        writeFrame(self.partition("1d", when), self.downsample(hours, "D"))
+
+    # Downsample samples (raw rows, or a finer rollup) to the given period.
+    # Averages are weighted by the number of raw samples behind each row
+    # that had a value
+    def downsample(self, df, period):
+        df = df.copy()
+        df['time'] = df['time'].dt.floor(period)
+        for col in TS_GAUGES:
+            if (col + "_n" not in df.columns):
+                # Rollups written before the counts were kept
+                df[col + "_n"] = df[col + "_avg"].notna() * df['samples']
+            df[col + "_sum"] = df[col + "_avg"].fillna(0) * df[col + "_n"]
+        df = df.sort_values('time', kind='stable')
+        aggs = { 'samples': "sum" }
+        for col in TS_TAGS[1:] + TS_LAST:
+            aggs[col] = "last"
+        for col in TS_GAUGES:
+            aggs[col + "_sum"] = "sum"
+            aggs[col + "_n"] = "sum"
+            aggs[col + "_min"] = "min"
+            aggs[col + "_max"] = "max"
+        out = df.groupby([ 'time', 'mac' ], sort=True).agg(aggs).reset_index()
+        for col in TS_GAUGES:
+            out[col + "_avg"] = out[col + "_sum"] / out[col + "_n"].where(out[col + "_n"] > 0)
+            out = out.drop(columns=[ col + "_sum" ])
+        return out
+
+    # Drop partitions past their resolution's retention
+    def prune(self, now):
+        for resolution, days in self.retention.items():
+            if (days == None):
+                continue
+            cutoff = (now - timedelta(days=days)).strftime("%Y-%m-%d")
+            res_dir = os.path.join(self.root, resolution)
+            for fn in os.listdir(res_dir):
+                if (fn.startswith(".")):
+                    continue
+                key = fn.split("=", 1)[-1].split(".")[0]
+                if (len(key) == 7):
+                    # Months go once their last day is past the cutoff
+                    key += "-31"
+                if (key < cutoff):
+                    path = os.path.join(res_dir, fn)
+                    if (os.path.isdir(path)):
+                        for x in os.listdir(path):
+                            os.unlink(os.path.join(path, x))
+                        os.rmdir(path)
+                    else:
+                        os.unlink(path)
+
+    # Partition files of a resolution overlapping since..until
+    def files(self, resolution, since = None, until = None):
+        res_dir = os.path.join(self.root, resolution)
+        if (not os.path.isdir(res_dir)):
+            return []
+        lo = since.strftime("%Y-%m-%d") if since else ""
+        hi = until.strftime("%Y-%m-%d") if until else "9999"
+        files = []
+        for fn in sorted(os.listdir(res_dir)):
+            if (fn.startswith(".")):
+                continue
+            key = fn.split("=", 1)[-1].split(".")[0]
+            if (key[:len(hi)] > hi[:len(key)] or (key + "-31")[:10] < lo):
+                continue
+            path = os.path.join(res_dir, fn)
+            if (os.path.isdir(path)):
+                files += [ os.path.join(path, x) for x in sorted(os.listdir(path)) if x.endswith(".parquet") ]
+            else:
+                files.append(path)
+        return files
+
+    # Samples of a resolution ("raw", "1h" or "1d") from since up to until
+    # (datetimes), optionally for one mac, venue or org only
+    def query(self, resolution = "raw", since = None, until = None, mac = None, venue = None, org = None, columns = None):
+        filters = []
+        for col, value in [ ('mac', mac), ('venue', venue), ('org', org) ]:
+            if (value != None):
+                filters.append((col, '=', value))
+        frames = []
+        for fn in self.files(resolution, since, until):
+            table = pyarrow.parquet.read_table(fn, columns=columns, filters=(filters or None))
+            frames.append(table.to_pandas())
+        if (len(frames) == 0):
+            return pandas.DataFrame(columns=(columns or [ 'time' ] + TS_TAGS))
+        df = pandas.concat(frames, ignore_index=True)
+        if (since != None):
+            df = df[df['time'] >= pandas.Timestamp(since)]
+        if (until != None):
+            df = df[df['time'] <= pandas.Timestamp(until)]
+        return df.sort_values([ 'time', 'mac' ], ignore_index=True)
+
+    # Column of a metric at a resolution: rollups keep gauges as avg/min/max
+    def column(self, metric, resolution, stat = "avg"):
+        if (resolution != "raw" and metric in TS_GAUGES):
+            return "%s_%s" % (metric, stat)
+        return metric
+
+    # A metric over time per group (by is mac, name, venue, org, model or
+    # firmware), aggregated with how across the group: a DataFrame indexed
+    # by time with one column per group
+    def aggregate(self, metric, by = "venue", resolution = "1h", since = None, until = None, how = "mean", **filters):
+        col = self.column(metric, resolution)
+        df = self.query(resolution, since, until, columns=[ 'time', 'mac', by, col ] if by != "mac" else [ 'time', 'mac', col ], **filters)
+        return df.groupby([ 'time', by ])[col].agg(how).unstack(by)
+
+    # Change of a metric over the range per group: the group's mean at the
+    # last sample time minus its mean at the first
+    def growth(self, metric, by = "mac", resolution = "1h", since = None, until = None, **filters):
+        series = self.aggregate(metric, by, resolution, since, until, "mean", **filters)
+        return (series.ffill().iloc[-1] - series.bfill().iloc[0]).sort_values(ascending=False)
+
+    # Load the snapshots of a manifest (see collector.Manifest) not yet in
+    # the store, e.g. those taken before it existed
+    def backfill(self, manifest):
+        done = set()
+        raw_dir = os.path.join(self.root, "raw")
+        if (os.path.isdir(raw_dir)):
+            for day in os.listdir(raw_dir):
+                done.update([ fn[:-len(".parquet")] for fn in os.listdir(os.path.join(raw_dir, day)) ])
+        count = 0
+        for snapshot in manifest.snapshots():
+            if (snapshot['prefix'] in done or 'online-devices' not in snapshot['tables']):
+                continue
+            df = manifest.read_table(snapshot, 'online-devices').reindex(columns=TS_TAGS + TS_GAUGES + TS_LAST)
+            self.append(df, datetime.fromisoformat(snapshot['time']), snapshot['prefix'])
+            count += 1
+        return count
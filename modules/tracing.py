@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+# Profiling of collection runs. A Profiler records spans (name, category,
+# wall start and duration, and the CPU time of the thread that ran them)
+# for the phases of a run and each device's stats fetch and parsing, then
+# writes them as a Chrome trace (open it in chrome://tracing or
+# ui.perfetto.dev) and summarizes them: time per phase split into CPU and
+# waiting (network and locks), throughput, and the slowest devices
+
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+# Spans shorter than this are only counted, not traced one by one (in seconds)
+TRACE_MIN_SPAN = 0.0005
+
+# Categories: phases of the run, and the per device spans
+PHASE = "phase"
+FETCH = "fetch"
+PARSE = "parse"
+
+class Profiler:
+    # Init a profiler, timing starts now
+    def __init__(self):
+        self.start   = time.perf_counter()
+        self.lock    = threading.Lock()
+        self.events  = []
+        self.threads = {}
+        self.totals  = {}
+
+    # Trace thread id of the calling thread, or of a named lane (e.g. for
+    # spans timed on another process)
+    def tid(self, lane = None):
+        ident = lane or threading.get_ident()
+        with self.lock:
+            if (ident not in self.threads):
+                self.threads[ident] = (len(self.threads) + 1, lane or threading.current_thread().name)
+            return self.threads[ident][0]
+
+    # Record a span that started at wall time start (a perf_counter()) and
+    # used cpu seconds of its thread's time, on the calling thread's lane
+    # unless one is given
+    def add(self, name, cat, start, end, cpu, lane = None, **args):
+        tid = self.tid(lane)
+        with self.lock:
+            tot = self.totals.setdefault((cat, name if cat == PHASE else cat), [ 0, 0.0, 0.0 ])
+            tot[0] += 1
+            tot[1] += end - start
+            tot[2] += cpu
+            if (end - start >= TRACE_MIN_SPAN):
+                args['cpu_ms'] = round(cpu * 1000, 3)
+                self.events.append({ 'name': name, 'cat': cat, 'ph': "X", 'pid': 1, 'tid': tid,
+                                     'ts': round((start - self.start) * 1e6, 1),
+                                     'dur': round((end - start) * 1e6, 1), 'args': args })
+
+    # Count spans that were only timed in total (e.g. many tiny ones)
+    def total(self, name, cat, count, secs, cpu):
+        with self.lock:
+            tot = self.totals.setdefault((cat, name), [ 0, 0.0, 0.0 ])
+            tot[0] += count
+            tot[1] += secs
+            tot[2] += cpu
+
+    # Time the enclosed block as a span
+    @contextmanager
+    def span(self, name, cat = PHASE, **args):
+        start = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield args
+        finally:
+            self.add(name, cat, start, time.perf_counter(), time.thread_time() - cpu, **args)
+
+    # Iterate over a generator, timing each step as a span of the given name
+    # (e.g. the page fetches of a paginated listing)
+    def iterate(self, items, name, cat = PHASE):
+        items = iter(items)
+        while True:
+            start = time.perf_counter()
+            cpu = time.thread_time()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            self.add(name, cat, start, time.perf_counter(), time.thread_time() - cpu)
+            yield item
+
+    # Write the Chrome trace to fn
+    def write(self, fn):
+        with self.lock:
+            events = list(self.events)
+            for tid, tname in self.threads.values():
+                events.append({ 'name': "thread_name", 'ph': "M", 'pid': 1, 'tid': tid, 'args': { 'name': tname } })
+        events.append({ 'name': "process_name", 'ph': "M", 'pid': 1, 'tid': 0, 'args': { 'name': "collector" } })
+        with open(fn, "w") as f:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': "ms" }, f)
+
+    # Summary table of the run: phases by wall time, with their CPU and
+    # waiting time, the per device spans, and the slowest devices
+    def summary(self, top = 10):
+        wall = time.perf_counter() - self.start
+        lines = [ "%-34s %6s %9s %9s %9s %6s" % ("Phase", "Count", "Wall s", "CPU s", "Wait s", "% run") ]
+        with self.lock:
+            totals = sorted(self.totals.items(), key=lambda x: -x[1][1])
+            events = [ x for x in self.events if x['cat'] != PHASE ]
+        for (cat, name), (count, secs, cpu) in totals:
+            label = name if cat == PHASE else "%s (per device, all threads)" % cat
+            lines.append("%-34s %6d %9.2f %9.2f %9.2f %6.1f" % (label[:34], count, secs, cpu, secs - cpu, 100 * secs / wall))
+
+        fetch = self.totals.get((FETCH, FETCH))
+        if (fetch):
+            # Throughput over the devices phase if there was one
+            secs = self.totals.get((PHASE, "devices"), [ 0, wall ])[1]
+            lines.append("")
+            lines.append("Devices: %d in %.2f s (%.1f devices/sec), fetch wait %.2f s vs CPU %.2f s across threads"
+                         % (fetch[0], secs, fetch[0] / secs, fetch[1] - fetch[2], fetch[2]))
+            per_dev = {}
+            for x in events:
+                per_dev.setdefault(x['args'].get('mac', x['name']), {})[x['cat']] = x['dur'] / 1000
+            slowest = sorted(per_dev.items(), key=lambda x: -sum(x[1].values()))[:top]
+            if (len(slowest) > 0):
+                lines.append("Slowest devices (ms):")
+                lines.append("   %-14s %9s %9s" % ("mac", FETCH, PARSE))
+                for mac, spans in slowest:
+                    lines.append("   %-14s %9.1f %9.1f" % (mac, spans.get(FETCH, 0), spans.get(PARSE, 0)))
+        return "\n".join(lines)